@@ -10,6 +10,8 @@ import time
 import platform
 from os.path import expanduser
 
+from pebblecomm import apng
+from pebblecomm import logsink
 from pebblecomm import pebble as libpebble
 
 from PblCommand import PblCommand
@@ -164,6 +166,11 @@ class PblInstallCommand(LibPebbleCommand):
         parser.add_argument('--direct', action='store_true', help='Install directly on watch. Default is to send the'
                 'complete bundle to the phone and have it send the pieces of the bundle to the watch. '
                 'WARNING: This option won\'t work for PBWs with javascript in them.')
+        parser.add_argument('--putbytes-window', type=int, default=1, help='Number of chunks to send ahead of '
+                'the watch\'s acknowledgements when installing directly. Halved automatically if the watch rejects '
+                'a chunk. Default is 1 (wait for each chunk to be acknowledged).')
+        parser.add_argument('--probe-chunk-size', action='store_true', help='When installing directly, try '
+                'larger chunks first and keep the largest size the watch accepts.')
 
     def run(self, args):
         LibPebbleCommand.run(self, args)
@@ -172,6 +179,9 @@ class PblInstallCommand(LibPebbleCommand):
             logging.error("Could not find bundle <{}> for install.".format(args.bundle_path))
             return 1
 
+        self.pebble.set_putbytes_window(args.putbytes_window)
+        self.pebble.set_putbytes_probe(args.probe_chunk_size)
+
         if args.logs:
             post_event("app_log_view", virtual=self.virtual_pebble)
             self.pebble.app_log_enable()
@@ -284,9 +294,24 @@ class PblScreenshotCommand(LibPebbleCommand):
     name = 'screenshot'
     help = 'take a screenshot of the pebble'
 
+    def configure_subparser(self, parser):
+        LibPebbleCommand.configure_subparser(self, parser)
+        parser.add_argument('--stream', action='store_true', help='Keep taking screenshots until interrupted '
+                '(or --frames/--duration is reached).')
+        parser.add_argument('--fps', type=float, default=None, help='With --stream, the most screenshots to take '
+                'per second. Default is as many as the connection allows.')
+        parser.add_argument('--frames', type=int, default=None, help='With --stream, stop after this many screenshots.')
+        parser.add_argument('--duration', type=float, default=None, help='With --stream, stop after this many seconds.')
+        parser.add_argument('--output', type=str, default=None, help='With --stream, where to save the screenshots: '
+                'a directory for one PNG per screenshot, or a *.png file for an animated PNG. '
+                'Default is a new pebble-screenshots_<date> directory.')
+
     def run(self, args):
         LibPebbleCommand.run(self, args)
 
+        if args.stream:
+            return self.stream(args)
+
         logging.info("Taking screenshot...")
         def progress_callback(amount):
             logging.info("%.2f%% done..." % (amount*100.0))
@@ -328,6 +353,38 @@ class PblScreenshotCommand(LibPebbleCommand):
                          "manually if you want to see what it looks like ("
                          "it has still been saved, however).")
 
+    def stream(self, args):
+        output = args.output or time.strftime("pebble-screenshots_%Y-%m-%d_%H-%M-%S")
+        if output.lower().endswith(".png"):
+            writer = apng.AnimatedPngWriter(output)
+            save = writer.add_frame
+        else:
+            writer = None
+            if not os.path.isdir(output):
+                os.makedirs(output)
+            def save(timestamp, image):
+                name = time.strftime("pebble-screenshot_%Y-%m-%d_%H-%M-%S", time.localtime(timestamp))
+                image.save(os.path.join(output, "%s.%03d.png" % (name, int(timestamp * 1000) % 1000)))
+
+        logging.info("Taking screenshots ... Ctrl-C to stop.")
+        stream = self.pebble.screenshot_stream(args.fps)
+        start = time.time()
+        count = 0
+        frames = stream.frames(args.frames, args.duration)
+        try:
+            for timestamp, image in frames:
+                save(timestamp, image)
+                count += 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            frames.close()
+            if writer is not None:
+                writer.close()
+
+        elapsed = time.time() - start
+        logging.info("Saved %d screenshots to %s (%.2f per second)" % (count, output, count / elapsed if elapsed else 0))
+
 
 class PblCoreDumpCommand(LibPebbleCommand):
     name = 'coredump'
@@ -338,6 +395,14 @@ class PblCoreDumpCommand(LibPebbleCommand):
         parser.add_argument('--generate', action='store_true', help='If specified, generate a core dump image on the '
                 'watch. Wait for the watch to reboot and issue the coredump command again without --generate to '
                 'then fetch it.')
+        parser.add_argument('--resume', action='store_true', help='Save the coredump to --output as it arrives, and '
+                'request it again if the transfer drops, keeping the data already received. If all attempts fail, '
+                'run the command again with the same --output to carry on.')
+        parser.add_argument('--output', type=str, default=None, help='With --resume, the file to save the coredump '
+                'to. Default is pebble-coredump.bin. It must not already exist, unless it is from a download that '
+                'did not finish.')
+        parser.add_argument('--attempts', type=int, default=5, help='With --resume, how many times to request the '
+                'coredump before giving up. Default is 5.')
 
     def run(self, args):
         LibPebbleCommand.run(self, args)
@@ -352,13 +417,19 @@ class PblCoreDumpCommand(LibPebbleCommand):
         def progress_callback(amount):
             logging.info("%.2f%% done..." % (amount*100.0))
 
+        if args.resume:
+            name = self.pebble.download_coredump(args.output or "pebble-coredump.bin", progress_callback,
+                                                 args.attempts)
+            logging.info("Core dump saved to %s" % name)
+            return
+
         blob = self.pebble.coredump(progress_callback)
         name = time.strftime("pebble-coredump_%Y-%m-%d_%H-%M-%S.bin")
         if len(blob) == 0:
             logging.error("Error fetching core dump")
             return
         try:
-            with open(name, 'w') as f:
+            with open(name, 'wb') as f:
                 f.write(blob)
         except:
             raise
@@ -370,12 +441,56 @@ class PblLogsCommand(LibPebbleCommand):
     name = 'logs'
     help = 'Continuously displays logs from the watch'
 
+    sinks = {
+        'console': lambda path: logsink.ConsoleSink(),
+        'jsonl': logsink.JsonLinesSink,
+        'binary': logsink.BinaryLogSink,
+    }
+
     def configure_subparser(self, parser):
         LibPebbleCommand.configure_subparser(self, parser)
+        parser.add_argument('--sink', choices=sorted(self.sinks), default=None, help='Write log messages (firmware '
+                'and app) through a queue to the console, a JSON Lines file or a binary log file, instead of '
+                'printing them as they arrive.')
+        parser.add_argument('--output', type=str, default=None, help='The file the jsonl or binary sink appends '
+                'to. Default is pebble-logs.jsonl or pebble-logs.bin.')
+        parser.add_argument('--level', type=self.log_level, default=None, help='Only show messages at least this '
+                'severe: E, W, I, D or V, or a number from 0 to 255.')
+        parser.add_argument('--uuid', action='append', default=None, help='Only show log messages from the app '
+                'with this UUID. May be given more than once.')
+        parser.add_argument('--filename', action='append', default=None, help='Only show log messages from source '
+                'files matching this pattern (e.g. "main.c" or "*.c"). May be given more than once.')
+        parser.add_argument('--queue-size', type=int, default=10000, help='With --sink, how many messages may wait '
+                'to be written before new ones are dropped. Default is 10000.')
+
+    @staticmethod
+    def log_level(value):
+        try:
+            return libpebble.LogRecord.parse_level(value)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
 
     def run(self, args):
         LibPebbleCommand.run(self, args)
-        self.tail()
+        if args.level is not None:
+            self.pebble.set_log_level(args.level)
+
+        if args.sink is None and args.uuid is None and args.filename is None:
+            self.tail()
+            return
+
+        sink = args.sink or 'console'
+        output = args.output or {'jsonl': 'pebble-logs.jsonl', 'binary': 'pebble-logs.bin'}.get(sink)
+        log_filter = logsink.LogFilter(uuids=args.uuid, filenames=args.filename)
+        self.pebble.set_print_pbl_logs(False)
+        self.pebble.set_print_app_logs(False)
+        pipeline = logsink.LogPipeline(self.pebble, [self.sinks[sink](output)], log_filter, maxsize=args.queue_size)
+        try:
+            self.tail()
+        finally:
+            pipeline.close()
+        if output:
+            logging.info("Log messages saved to %s" % output)
 
 class PblReplCommand(LibPebbleCommand):
     name = 'repl'
@@ -0,0 +1,432 @@
+import codec
+import collections
+import heapq
+import logging as log
+import select
+import time
+
+import WebSocketPebble
+from pebble import AppBankStatus, AppMetadata, BlobDB, Pebble, PebbleBundle, PebbleError, PutBytesClient, ScreenshotSync
+
+# libpebble targets Python 2, which has no asyncio. This module provides the
+# same model on top of select(): one PebbleEventLoop drives any number of
+# AsyncPebble connections from a single thread, requests return PebbleFutures,
+# and multi-step operations are written as generator coroutines that yield
+# futures (finish with `raise Return(value)`).
+
+
+class Return(Exception):
+    """Raised by a coroutine to finish with a value."""
+
+    def __init__(self, value=None):
+        self.value = value
+
+
+class PebbleFuture(object):
+    """The eventual result of an operation run on a PebbleEventLoop."""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise PebbleError(None, "Result is not ready yet")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, fn):
+        if self._done:
+            self._loop.call_soon(fn, self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        if self._done:
+            return
+        self._done = True
+        self._result = result
+        self._exception = exception
+        for fn in self._callbacks:
+            self._loop.call_soon(fn, self)
+        self._callbacks = []
+
+
+class PebbleEventLoop(object):
+    """A select() based loop that multiplexes many AsyncPebble connections."""
+
+    def __init__(self):
+        self._readers = {}
+        self._ready = collections.deque()
+        self._timers = []
+        self._timer_seq = 0
+
+    def add_reader(self, fd, fn):
+        self._readers[fd] = fn
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def call_soon(self, fn, *args):
+        self._ready.append((fn, args))
+
+    def call_later(self, delay, fn, *args):
+        """Run fn(*args) after delay seconds. Returns a handle for cancel_timer()."""
+        self._timer_seq += 1
+        timer = [time.time() + delay, self._timer_seq, fn, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        # Cancelled timers stay in the heap and are skipped when they expire
+        timer[2] = None
+
+    def sleep(self, delay):
+        future = PebbleFuture(self)
+        self.call_later(delay, future.set_result, None)
+        return future
+
+    def spawn(self, gen):
+        """Run a generator coroutine on the loop. Returns a future for its result."""
+        future = PebbleFuture(self)
+
+        def step(value=None, exception=None):
+            try:
+                if exception is not None:
+                    yielded = gen.throw(exception)
+                else:
+                    yielded = gen.send(value)
+            except Return as r:
+                future.set_result(r.value)
+            except StopIteration:
+                future.set_result(None)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                yielded.add_done_callback(wakeup)
+
+        def wakeup(yielded):
+            if yielded.exception() is not None:
+                step(exception=yielded.exception())
+            else:
+                step(yielded.result())
+
+        self.call_soon(step)
+        return future
+
+    def gather(self, futures):
+        """A future for the list of results of all futures, in order."""
+        combined = PebbleFuture(self)
+        futures = list(futures)
+        results = [None] * len(futures)
+        remaining = [len(futures)]
+
+        def collect(index, future):
+            if future.exception() is not None:
+                combined.set_exception(future.exception())
+                return
+            results[index] = future.result()
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                combined.set_result(results)
+
+        for index, future in enumerate(futures):
+            future.add_done_callback(lambda f, index=index: collect(index, f))
+        if not futures:
+            combined.set_result(results)
+        return combined
+
+    def run_once(self, timeout=None):
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            delay = max(0, self._timers[0][0] - time.time())
+            timeout = delay if timeout is None else min(timeout, delay)
+
+        if self._readers:
+            readable, _, _ = select.select(self._readers.keys(), [], [], timeout)
+            for fd in readable:
+                if fd in self._readers:
+                    self._readers[fd]()
+        elif timeout:
+            time.sleep(timeout)
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, fn, args = heapq.heappop(self._timers)
+            if fn is not None:
+                self._ready.append((fn, args))
+
+        for _ in xrange(len(self._ready)):
+            fn, args = self._ready.popleft()
+            fn(*args)
+
+    def run_until_complete(self, future):
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+
+class _WSResponse(object):
+    """Stands in for WSClient so phone -> sdk responses resolve a future."""
+
+    def __init__(self, future):
+        self._future = future
+
+    def handle_response(self, topic, response):
+        self._future.set_result((topic, response))
+
+
+class AsyncPebble(Pebble):
+    """
+    A Pebble connection driven by a PebbleEventLoop instead of a reader thread.
+
+    It reuses Pebble's transports, framing and endpoint parsers. Requests return
+    PebbleFutures; run them with loop.run_until_complete(), or yield them from a
+    coroutine started with loop.spawn(). Only QEMU and websocket connections can
+    be multiplexed.
+    """
+
+    timeout = 10
+
+    def __init__(self, loop, id=None):
+        super(AsyncPebble, self).__init__(id)
+        self._loop = loop
+        # Futures for operations the correlator doesn't know about -> fn(error)
+        # that fails the operation, for disconnect()
+        self._operations = {}
+
+    def init_reader(self):
+        if self._connection_type not in ('qemu', 'websocket'):
+            raise PebbleError(self.id, "AsyncPebble only supports qemu and websocket connections")
+        if self._connection_type == 'qemu':
+            # Reads must never block the loop; the socket is only read when select() says so
+            self._ser.timeout = 0
+        self._loop.add_reader(self._ser.fileno(), self._on_readable)
+
+    def disconnect(self):
+        self._loop.remove_reader(self._ser.fileno())
+        super(AsyncPebble, self).disconnect()
+        error = PebbleError(self.id, "Disconnected")
+        operations, self._operations = self._operations, {}
+        for fail in operations.values():
+            fail(error)
+
+    def _track(self, future, fail):
+        """Have disconnect() call fail(error) if future is still pending."""
+        self._operations[future] = fail
+        future.add_done_callback(lambda f: self._operations.pop(f, None))
+
+    def _on_readable(self):
+        try:
+            # A QEMU read never blocks, so drain every buffered packet; a
+            # websocket read takes a whole frame, so read one per wakeup.
+            while True:
+                source, endpoint, resp = self._recv_message()
+                self._handle_message(source, endpoint, resp)
+                if self._connection_type != 'qemu' or resp is None:
+                    break
+        except Exception as e:
+            log.error("Lost connection to Pebble: %s" % e)
+            self.disconnect()
+
+    def _expect(self, endpoint, timeout=None, key=None):
+        """A future for the next (parsed) response on endpoint carrying key."""
+        future = PebbleFuture(self._loop)
+        waiter_key = (self.endpoints[endpoint], key)
+        self._responses.add(waiter_key, future)
+
+        def expire():
+            self._responses.discard(waiter_key, future)
+            future.set_exception(PebbleError(self.id, "Timed out waiting for %s response" % endpoint))
+
+        timer = self._loop.call_later(timeout or self.timeout, expire)
+        future.add_done_callback(lambda f: self._loop.cancel_timer(timer))
+        return future
+
+    def _request(self, endpoint, data, async=False, timeout=None):
+        if async:
+            self._send_message(endpoint, data)
+            return None
+        # Wait for the response before sending so a fast reply can't be missed
+        future = self._expect(endpoint, timeout, self._correlation_key(self.endpoints[endpoint], data))
+        self._send_message(endpoint, data)
+        return future
+
+    def get_versions(self):
+        return self._request("VERSION", "\x00")
+
+    def ping(self, cookie=0xDEC0DE):
+        return self._request("PING", codec.ping.pack(0, cookie))
+
+    def blob_db_insert(self, db, key, value):
+        return self._request("BLOB_DB", BlobDB(db).insert(key, value))
+
+    def blob_db_delete(self, db, key):
+        return self._request("BLOB_DB", BlobDB(db).delete(key))
+
+    def blob_db_clear(self, db):
+        return self._request("BLOB_DB", BlobDB(db).clear())
+
+    def screenshot(self, progress_callback=None):
+        """A future for the screenshot as a png.Image."""
+        future = PebbleFuture(self._loop)
+        # Drive the session from our own handler so errors fail the future
+        session = ScreenshotSync(self, "SCREENSHOT", progress_callback or (lambda amount: None), register=False)
+
+        def finish(result=None, exception=None):
+            self.unregister_endpoint("SCREENSHOT", callback)
+            self._loop.cancel_timer(timer)
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+        def callback(endpoint, data):
+            try:
+                session.message_callback(endpoint, data)
+                if session.is_complete():
+                    finish(session.get_image())
+            except Exception as e:
+                finish(exception=e)
+
+        timer = self._loop.call_later(ScreenshotSync.timeout, finish, None,
+                                      PebbleError(self.id, "Timed out waiting for screenshot"))
+        self.register_endpoint("SCREENSHOT", callback)
+        self._track(future, lambda error: finish(exception=error))
+        self._send_message("SCREENSHOT", "\x00")
+        return future
+
+    def _put_bytes(self, client):
+        """Start a PutBytes transfer; the future fails with client.error if it does."""
+        future = PebbleFuture(self._loop)
+
+        def done(client):
+            self._loop.cancel_timer(timer[0])
+            if client._done:
+                future.set_result(True)
+            else:
+                future.set_exception(PebbleError(self.id, client.error))
+
+        def check_activity():
+            if time.time() - client._last_response >= client.timeout:
+                client.timed_out()
+            if not client._finished.is_set():
+                timer[0] = self._loop.call_later(client.timeout, check_activity)
+
+        def fail(error):
+            if not client._finished.is_set():
+                client.fail(error._message)
+
+        timer = [self._loop.call_later(client.timeout, check_activity)]
+        client.add_done_callback(done)
+        self._track(future, fail)
+        client.init()
+        return future
+
+    def _fetch_watch_version_info(self):
+        if self.watch_fw_version is None:
+            self._set_watch_version_info((yield self.get_versions()))
+
+    def install_app(self, pbw_path, launch_on_install=True, direct=False):
+        """A future that completes once the app bundle (*.pbw) is installed."""
+        if not direct and self._connection_type == 'websocket':
+            return self._loop.spawn(self._install_bundle_ws(pbw_path))
+        return self._loop.spawn(self._install_app_pebble_protocol(pbw_path, launch_on_install))
+
+    def _install_bundle_ws(self, bundle_path):
+        # The phone's status response doesn't say which install it is for
+        if isinstance(self._ws_client, _WSResponse):
+            raise PebbleError(self.id, "Another install is waiting for the phone")
+        future = PebbleFuture(self._loop)
+        previous, self._ws_client = self._ws_client, _WSResponse(future)
+        timer = self._loop.call_later(90, future.set_exception,
+                                      PebbleError(self.id, "Timed out waiting for the phone to install %s" % bundle_path))
+        self._track(future, future.set_exception)
+        try:
+            with open(bundle_path, 'rb') as f:
+                self._ser.write(f.read(), ws_cmd=WebSocketPebble.WS_CMD_BUNDLE_INSTALL)
+            topic, response = yield future
+        finally:
+            self._loop.cancel_timer(timer)
+            self._ws_client = previous
+        if topic != 'status' or response != 0:
+            raise PebbleError(self.id, "Failed to install %s (response %s)" % (bundle_path, response))
+        raise Return(True)
+
+    def _install_app_pebble_protocol(self, pbw_path, launch_on_install):
+        yield self._loop.spawn(self._fetch_watch_version_info())
+
+        bundle = PebbleBundle(pbw_path, self.get_watch_hardware())
+        if not bundle.is_app_bundle():
+            raise PebbleError(self.id, "This is not an app bundle")
+        app_metadata = bundle.get_app_metadata()
+        app_uuid = app_metadata['uuid'].bytes
+
+        if self.watch_fw_version[0] >= 3:
+            metadata = AppMetadata(self, app_metadata['uuid'], app_metadata['flags'],
+                                   app_metadata['icon_resource_id'], app_metadata['app_version_major'],
+                                   app_metadata['app_version_minor'], app_metadata['sdk_version_major'],
+                                   app_metadata['sdk_version_minor'], 0, 0, app_metadata['app_name'])
+            resp = yield self.blob_db_insert("APP", app_uuid, metadata.pack())
+            if resp != "SUCCESS":
+                raise PebbleError(self.id, "Failed to insert app metadata: %s" % resp)
+
+            # Launching the app makes the watch fetch it
+            app_fetch = self._expect("APP_FETCH", timeout=30)
+            self.launcher_message(app_uuid, "RUNNING", uuid_is_string=False, async=True)
+            command, fetch_uuid, index = codec.app_fetch_request.unpack((yield app_fetch))
+            self._send_message("APP_FETCH", codec.app_fetch_response.pack(1, 1)) # APP_FETCH_INSTALL_RESPONSE, SUCCESS
+            has_cookie = True
+        else:
+            yield self._request("APP_MANAGER", codec.int8.pack(0x02) + app_uuid)
+            apps = yield self._request("APP_MANAGER", "\x01")
+            if not isinstance(apps, AppBankStatus):
+                raise PebbleError(self.id, "could not obtain app list; try again")
+            used = set(app["index"] for app in apps["apps"])
+            free = [i for i in xrange(apps["banks"]) if i not in used]
+            if not free:
+                raise PebbleError(self.id, "All %d app banks are full" % apps["banks"])
+            index = free[0]
+            has_cookie = False
+
+        parts = [("BINARY", bundle.get_app_path())]
+        if bundle.has_resources():
+            parts.append(("RESOURCES", bundle.get_resource_path()))
+        if bundle.get_worker_info() is not None:
+            parts.append(("WORKER", bundle.get_worker_path()))
+        for transfer_type, path in parts:
+            client = PutBytesClient(self, index, transfer_type, bundle.zip.read(path), has_cookie=has_cookie)
+            try:
+                yield self._put_bytes(client)
+            except PebbleError as e:
+                raise PebbleError(self.id, "Failed to send %s/%s: %s" % (pbw_path, path, e._message))
+
+        if not has_cookie:
+            yield self._loop.sleep(2)
+            self._add_app(index)
+            yield self._loop.sleep(2)
+            if launch_on_install:
+                launched = self._expect("LAUNCHER")
+                self.launcher_message(app_uuid, "RUNNING", uuid_is_string=False, async=True)
+                yield launched
+
+        raise Return(True)
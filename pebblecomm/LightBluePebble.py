@@ -6,7 +6,8 @@ import Queue
 import re
 import socket
 from multiprocessing import Process
-from struct import unpack
+
+import codec
 
 class LightBluePebbleError(Exception):
     def __init__(self, id, message):
@@ -150,7 +151,7 @@ class LightBluePebble(object):
 
             if (rec_data is not None) and (len(rec_data) == 4):
                 # check the Stream Multiplexing Layer message and get the length of the data to read
-                size, endpoint = unpack("!HH", rec_data)
+                size, endpoint = codec.frame_header.unpack(rec_data)
                 resp = ''
                 while len(resp) < size:
                     try:
@@ -1,5 +1,5 @@
 from WebSocketPebble import *
-from struct import pack, unpack
+import codec
 import logging
 
 WS_PROXY_URL = "wss://ws-proxy.getpebble.com/tool"
@@ -18,14 +18,14 @@ class ProxyWebSocketPebble(WebSocketPebble):
    def login(self):
        token = self.account.get_access_token().encode('ascii')
        logging.debug("Sending auth token " + token)
-       data = pack('b', len(token)) + token
+       data = codec.int8.pack(len(token)) + token
 
        self.write(data, ws_cmd = WS_CMD_PROXY_AUTHENTICATION)
        self.read()
 
    def handle_cmd(self, ws_cmd, data):
        if ws_cmd == WS_CMD_PROXY_AUTHENTICATION:
-           status = unpack('!b', data[1])[0]
+           status, = codec.int8.unpack_from(data, 1)
            if len(data) == 2 and status == 0x00:
                logger.info("Auth success")
            else:
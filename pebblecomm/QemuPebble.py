@@ -1,11 +1,10 @@
 import errno
 import sys
 import logging
-import struct
+import codec
 import time
 import socket
 import select
-import os
 
 # These protocol IDs are defined in qemu_serial.h in the tintin project
 QemuProtocol_SPP = 1                    # Send SPP data (used for Pebble protocol)
@@ -29,11 +28,13 @@ class QemuPebble(object):
         self.timeout = timeout
         self.connect_timeout = connect_timeout
         self.socket = None
-        self.hdr_format = "!HHH"
-        self.footer_format = "!H"
-        self.hdr_size = struct.calcsize(self.hdr_format)
-        self.footer_size = struct.calcsize(self.footer_format)
+        self.hdr = codec.qemu_packet_header
+        self.footer = codec.qemu_packet_footer
+        self.hdr_size = self.hdr.size
+        self.footer_size = self.footer.size
         self.max_packet_size = QEMU_MAX_DATA_LEN + self.hdr_size + self.footer_size
+        # Largest Pebble Protocol message (header included) that fits in one packet
+        self.max_message_size = QEMU_MAX_DATA_LEN
         self.assembled_data = ''
         self.trace_enabled = False
 
@@ -54,24 +55,31 @@ class QemuPebble(object):
                 time.sleep(0.1)
 
         if not connected:
-            logging.error("Unable to connect to emulator at %s:%s. Is it running?" % (self.host,
-                            self.port))
-            os._exit(-1)
+            raise socket.error(errno.ECONNREFUSED, "Unable to connect to emulator at %s:%s. Is it running?" %
+                               (self.host, self.port))
 
 
         logging.info("Connected to emulator at %s:%s" % (self.host, self.port))
 
 
+    # write() also takes the payload as a list of strings
+    write_accepts_lists = True
+
     def write(self, payload, protocol=QemuProtocol_SPP):
+        if not isinstance(payload, (list, tuple)):
+            payload = [payload]
 
-        # Append header and footer to the payload
-        data = (struct.pack(self.hdr_format, QEMU_HEADER_SIGNATURE, protocol, len(payload))
-                    + payload + struct.pack(self.footer_format, QEMU_FOOTER_SIGNATURE))
+        # Put the header and footer around the payload, copying it only once
+        data = ''.join([self.hdr.pack(QEMU_HEADER_SIGNATURE, protocol, sum(len(part) for part in payload))]
+                       + list(payload) + [self.footer.pack(QEMU_FOOTER_SIGNATURE)])
 
-        self.socket.send(data)
+        self.socket.sendall(data)
         if self.trace_enabled:
             logging.debug('send>>> ' + data.encode('hex'))
 
+    def fileno(self):
+        return self.socket.fileno()
+
     def read(self):
         """
         retval:   (source, topic, response, data)
@@ -83,6 +91,11 @@ class QemuPebble(object):
             if source is 'qemu', then topic is the QemuProtocol_.* enum
 
         """
+        # Hand out any packet already reassembled before waiting for more data
+        packet = self._next_packet()
+        if packet is not None:
+            return packet
+
         # socket timeouts for asynchronous operation is normal.  In this
         # case we shall return all None to let the caller know.
         try:
@@ -95,18 +108,25 @@ class QemuPebble(object):
 
         data = self.socket.recv(self.max_packet_size)
         if not data:
-            logging.error("emulator disconnected")
-            os._exit(-1)
+            # Left to the reader to handle, which may be an event loop with other work
+            raise socket.error(errno.ECONNRESET, "Emulator disconnected")
 
         if self.trace_enabled:
             logging.debug('rcv<<< ' + data.encode('hex'))
 
         self.assembled_data += data
 
+        packet = self._next_packet()
+        if packet is not None:
+            return packet
+
+        # If we broke out, we don't have a complete packet yet
+        return (None, None, None, None)
+
+    def _next_packet(self):
         # Look for a complete packet
         while len(self.assembled_data) >= self.hdr_size:
-            (signature, protocol, data_len) = struct.unpack(self.hdr_format,
-                                                      self.assembled_data[0:self.hdr_size])
+            (signature, protocol, data_len) = self.hdr.unpack_from(self.assembled_data)
             if signature != QEMU_HEADER_SIGNATURE:
                 self.assembled_data = self.assembled_data[1:]
                 logging.debug("Skipping garbage byte")
@@ -133,8 +153,7 @@ class QemuPebble(object):
             else:
                 return ('qemu', protocol, data, data)
 
-        # If we broke out, we don't have a complete packet yet
-        return (None, None, None, None)
+        return None
 
     def close(self):
         """ Closes the socket connection. """
@@ -1,9 +1,10 @@
 import errno
+import os
 import sys
 import logging
 from websocket import *
-from struct import unpack
-from struct import pack
+
+import codec
 
 # This file contains the libpebble websocket client.
 # Based on websocket.py from:
@@ -22,8 +23,39 @@ WS_CMD_TIMELINE = 0x0c
 WS_CMD_PROXY_CONNECTION_UPDATE = 0x08
 WS_CMD_PROXY_AUTHENTICATION = 0x09
 
+# _xor_tables[k] maps each byte to itself XOR k, for str.translate(); built as needed
+_xor_tables = [None] * 256
+
+def _xor_table(k):
+    if _xor_tables[k] is None:
+        _xor_tables[k] = ''.join(chr(i ^ k) for i in xrange(256))
+    return _xor_tables[k]
+
+def mask_into(buf, offset, mask_key, data):
+    """
+    Write data, XORed with the 4 byte mask_key repeated as frames from a client
+    must be (RFC 6455, section 5.3), into the bytearray buf at offset. Every
+    fourth byte gets the same key byte, so each of those four slices is one
+    str.translate(); websocket's ABNF.mask() goes a byte at a time in Python.
+    """
+    for i in xrange(4):
+        buf[offset + i:offset + len(data):4] = data[i::4].translate(_xor_table(ord(mask_key[i])))
+
+def mask(mask_key, data):
+    buf = bytearray(len(data))
+    mask_into(buf, 0, mask_key, data)
+    return str(buf)
+
 class WebSocketPebble(WebSocket):
 
+    # The websocket frame itself is not the limit; the Pebble Protocol header's
+    # 16 bit length field is. What the watch accepts behind the phone is
+    # unknown until probed.
+    max_message_size = 4 + 0xFFFF
+
+    # write() also takes the payload as a list of strings
+    write_accepts_lists = True
+
 ######## libPebble Bridge Methods #########
 
     def write(self, payload, opcode = ABNF.OPCODE_BINARY, ws_cmd = WS_CMD_PHONE_TO_WATCH):
@@ -39,18 +71,34 @@ class WebSocketPebble(WebSocket):
                     log.debug("LightBlue process has shutdown (queue write)")
 
         """
-        # Append command byte to the payload:
-        payload = pack("B", ws_cmd) + payload
-        frame = ABNF.create_frame(payload, opcode)
-        if self.get_mask_key:
-            frame.get_mask_key = self.get_mask_key
-        data = frame.format()
-
-        sent = 0
-        while sent < len(data):
-            sent += self.sock.send(data[sent:])
-            if traceEnabled:
-                logging.debug('send>>> ' + data.encode('hex'))
+        # Put the command byte in front of the payload, joining any list of parts once
+        if isinstance(payload, (list, tuple)):
+            payload = ''.join([codec.websocket_command.pack(ws_cmd)] + list(payload))
+        else:
+            payload = codec.websocket_command.pack(ws_cmd) + payload
+        data = self._frame(payload, opcode)
+
+        self.sock.sendall(data)
+        if traceEnabled:
+            logging.debug('send>>> ' + str(data).encode('hex'))
+
+    def _frame(self, payload, opcode):
+        """ payload as a single, masked websocket frame (RFC 6455, section 5.2), in a bytearray """
+        length = len(payload)
+        # The shortest length encoding, as the RFC requires. websocket-client's ABNF.format() gives
+        # 125 byte payloads a 16 bit length; every other size is framed the same as it would be.
+        if length <= 125:
+            header = codec.websocket_frame.pack(0x80 | opcode, 0x80 | length)
+        elif length <= 0xFFFF:
+            header = codec.websocket_frame_16.pack(0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = codec.websocket_frame_64.pack(0x80 | opcode, 0x80 | 127, length)
+        mask_key = (self.get_mask_key or os.urandom)(4)
+        frame = bytearray(len(header) + len(mask_key) + length)
+        frame[:len(header)] = header
+        frame[len(header):len(header) + len(mask_key)] = mask_key
+        mask_into(frame, len(header) + len(mask_key), mask_key, payload)
+        return frame
 
     def read(self):
         """
@@ -87,7 +135,7 @@ class WebSocketPebble(WebSocket):
         except (socket.timeout, WebSocketTimeoutException):
             return (None, None, None, None)
 
-        ws_cmd = unpack('!b',data[0])[0]
+        ws_cmd, = codec.int8.unpack_from(data)
         return self.handle_cmd(ws_cmd, data)
 
     def handle_cmd(self, ws_cmd, data):
@@ -104,7 +152,7 @@ class WebSocketPebble(WebSocket):
             return ('watch', 'Pebble Protocol', pp_data, pp_data)
         elif ws_cmd==WS_CMD_STATUS:
             logging.debug("Status: %s" % repr(data[1:]))
-            status = unpack("I", data[1:5])[0]
+            status, = codec.websocket_status.unpack_from(data, 1)
             return ('ws', 'status', status, data[1:5])
         elif ws_cmd==WS_CMD_PHONE_INFO:
             logging.debug("Phone info: %s" % repr(data[1:]))
@@ -1,3 +1,4 @@
 from pebble import *
 from WebSocketPebble import WebSocketPebble
 from LightBluePebble import LightBluePebble
+from AsyncPebble import AsyncPebble, PebbleEventLoop
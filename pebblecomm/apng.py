@@ -0,0 +1,96 @@
+import io
+import struct
+
+import png
+
+# Animated PNG (APNG) output for screenshot streams. pypng only writes still
+# images, so each frame is encoded with it and its image data is moved into
+# APNG frame chunks: https://wiki.mozilla.org/APNG_Specification
+
+
+class AnimatedPngWriter(object):
+    """
+    Writes png.Image frames of the same size to an animated PNG.
+
+    Each frame is shown until the next one's timestamp, so a frame is only
+    written once the next arrives (or on close()). Browsers and most image
+    viewers play APNGs; others show the first frame.
+    """
+
+    acTL = struct.Struct("!II")
+    fcTL = struct.Struct("!IIIIIHHBB")
+
+    # Longest a frame can be shown for, in milliseconds (fcTL uses 16 bits)
+    MAX_DELAY_MS = 0xFFFF
+
+    def __init__(self, path, last_frame_delay=1.0):
+        self.last_frame_delay = last_frame_delay
+        self.frame_count = 0
+        self._file = open(path, 'wb')
+        self._sequence = 0
+        self._size = None
+        self._actl_offset = None
+        # (timestamp, image data) of the frame waiting for the next one
+        self._pending = None
+
+    def add_frame(self, timestamp, image):
+        size, header, data = self._encode(image)
+        if self._size is None:
+            self._write_header(size, header)
+        elif size != self._size:
+            raise ValueError("Frame is %dx%d but the animation is %dx%d" % (size + self._size))
+
+        if self._pending is not None:
+            self._write_frame(self._pending[1], timestamp - self._pending[0])
+        self._pending = (timestamp, data)
+
+    def close(self):
+        if self._pending is not None:
+            self._write_frame(self._pending[1], self.last_frame_delay)
+            self._pending = None
+        if self._size is not None:
+            png.write_chunk(self._file, 'IEND')
+            # Now that we know how many frames there are, fill in acTL
+            self._file.seek(self._actl_offset)
+            png.write_chunk(self._file, 'acTL', self.acTL.pack(self.frame_count, 0))
+        self._file.close()
+
+    def _encode(self, image):
+        """ Returns (width, height), the chunks before the image data, and the image data """
+        encoded = io.BytesIO()
+        image.save(encoded)
+        header = []
+        data = []
+        for chunk_type, chunk_data in png.Reader(bytes=encoded.getvalue()).chunks():
+            if chunk_type == 'IHDR':
+                size = struct.unpack_from("!II", chunk_data)
+            if chunk_type == 'IDAT':
+                data.append(chunk_data)
+            elif chunk_type != 'IEND':
+                header.append((chunk_type, chunk_data))
+        return size, header, ''.join(data)
+
+    def _write_header(self, size, header):
+        self._size = size
+        self._file.write(png._signature)
+        for chunk_type, chunk_data in header:
+            png.write_chunk(self._file, chunk_type, chunk_data)
+            if chunk_type == 'IHDR':
+                # acTL has to come before the first IDAT; close() fills it in
+                self._actl_offset = self._file.tell()
+                png.write_chunk(self._file, 'acTL', self.acTL.pack(0, 0))
+
+    def _write_frame(self, data, delay):
+        delay_ms = min(max(0, int(round(delay * 1000))), self.MAX_DELAY_MS)
+        width, height = self._size
+        png.write_chunk(self._file, 'fcTL', self.fcTL.pack(
+            self._sequence, width, height, 0, 0, delay_ms, 1000, 0, 0))
+        self._sequence += 1
+
+        # The first frame is the default image, which still-image viewers show
+        if self.frame_count == 0:
+            png.write_chunk(self._file, 'IDAT', data)
+        else:
+            png.write_chunk(self._file, 'fdAT', struct.pack("!I", self._sequence) + data)
+            self._sequence += 1
+        self.frame_count += 1
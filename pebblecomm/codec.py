@@ -0,0 +1,144 @@
+import struct
+
+# The layouts of Pebble Protocol messages (and of the transports that carry
+# them), compiled once. Passing a format string to pack()/unpack() looks it up
+# in struct's small cache on every call, and recompiles it when that cache
+# churns. Read fields in place with unpack_from(data, offset) instead of
+# slicing, and write them into a preallocated buffer with pack_into().
+#
+# Variable-length parts (strings, keys, values) follow the fixed fields and
+# are appended to what these pack.
+
+
+# Single fields
+int8 = struct.Struct("!b")
+uint8 = struct.Struct("!B")
+uint16 = struct.Struct("!H")
+uint32 = struct.Struct("!I")
+
+# Pebble Protocol frame: payload length, endpoint
+frame_header = struct.Struct("!HH")
+
+# TIME: command, timestamp (set_time and get_time responses)
+time_message = struct.Struct("!bL")
+# TIME: command, timestamp, UTC offset in minutes, length of the time zone name that follows
+time_set_utc = struct.Struct("!bIhb")
+
+# SYSTEM_MESSAGE: command, message type (and an argument, for some)
+system_message = struct.Struct("!bb")
+system_message_argument = struct.Struct("!bbb")
+
+# PING: command, cookie. Responses may have an idle flag after it.
+ping = struct.Struct("!bL")
+
+# APP_MANAGER: command, app id, bank index (remove)
+app_remove = struct.Struct("!bII")
+# APP_MANAGER: command, bank index (add)
+app_add = struct.Struct("!bI")
+# APP_MANAGER bank status response, after the response type: number of banks, apps installed
+app_bank_status = struct.Struct("!II")
+# APP_MANAGER: one installed app: id, index, name, company, flags, version
+app_bank_entry = struct.Struct("!II32s32sIH")
+# APP_MANAGER app description response, after the response type: version, name, company
+app_description = struct.Struct("H32s32s")
+
+# APP_FETCH: command, app uuid, app id
+app_fetch_request = struct.Struct("<B16sI")
+# APP_FETCH: command, result
+app_fetch_response = struct.Struct("BB")
+
+# VERSION: one firmware: timestamp, version, commit, is recovery, hardware platform, metadata version
+firmware_version = struct.Struct("!i32s8s?Bb")
+# VERSION: bootloader timestamp, hardware version, serial number
+watch_hardware = struct.Struct("!L9s12s")
+
+# PHONE_VERSION: command, -1, session capabilities, remote capabilities, response version, major, minor, bugfix
+phone_version = struct.Struct("!biIIbbbb")
+
+# LOGS and APP_LOGS: timestamp, level, message length, line number (then the filename and message)
+log_header = struct.Struct("!IBBH")
+# LOG_DUMP: command, generation, cookie
+log_dump_request = struct.Struct("!BBI")
+# LOG_DUMP: response type, cookie (then a log message)
+log_dump_response = struct.Struct("!BI")
+
+# SCREENSHOT: response code, version, width, height
+screenshot_header = struct.Struct("!BIII")
+
+# COREDUMP: command, transaction id
+coredump_request = struct.Struct("!BB")
+# COREDUMP: command, transaction id, response code, total length
+coredump_info = struct.Struct("!BBBI")
+# COREDUMP: command, transaction id, byte offset (then the data)
+coredump_data = struct.Struct("!BBI")
+
+# AUDIO start packet: packet id, session id, encoder id, sample rate, bit rate
+audio_start = struct.Struct("<BHBIH")
+
+# FACTORY_SETTINGS: command, length of the setting name that follows
+factory_setting_request = struct.Struct("!BB")
+
+# PUTBYTES init: command, length, transfer type, cookie
+putbytes_init = struct.Struct("!BIBI")
+# PUTBYTES init: command, length, transfer type, bank index (then the filename)
+putbytes_init_file = struct.Struct("!BIBB")
+# PUTBYTES put: command, token, chunk length (then the chunk); commit: command, token, CRC
+putbytes_put = struct.Struct("!bII")
+putbytes_commit = struct.Struct("!bII")
+# PUTBYTES abort and install: command, token. Responses are a result and a token too.
+putbytes_token = struct.Struct("!bI")
+
+# BLOB_DB insert and delete: command, token, database, key length (then the key)
+blob_db_key = struct.Struct("<BHBB")
+# BLOB_DB insert: value length (then the value)
+blob_db_value_length = struct.Struct("<H")
+# BLOB_DB clear: command, token, database
+blob_db_clear = struct.Struct("<BHB")
+# BLOB_DB token, in requests (after the command) and responses
+blob_db_token = struct.Struct("<H")
+# BLOB_DB response: token, result
+blob_db_response = struct.Struct("<HB")
+
+# APPLICATION_MESSAGE tuple: key, and the length of its data
+app_message_key = struct.Struct("<L")
+app_message_length = struct.Struct("<H")
+app_message_tuple_count = struct.Struct("B")
+
+# Timeline attribute: id, length (then the content)
+timeline_attribute = struct.Struct("<BH")
+# Timeline action: id, type, number of attributes
+timeline_action = struct.Struct("<BBB")
+# Timeline item: id, parent, timestamp, duration, type, flags, layout, data length, attribute and action counts
+timeline_item = struct.Struct("<16s16sIHBHBHBB")
+# A bare pin: id, parent, timestamp, duration, type, flags, pin and view layouts, attribute and action counts
+timeline_pin = struct.Struct("<16s16sIHBHBBBB")
+# EXTENSIBLE_NOTIFS (2.x firmware): command, add, flags, id, ANCS id, timestamp, layout,
+# attribute and action counts
+notification = struct.Struct("<BBIIIIBBB")
+
+# BLOB_DB APP entries: uuid, flags, icon, app version, sdk version, background color, template, name
+app_metadata = struct.Struct("<16sIIBBBBBB96s")
+app_metadata_placeholder = struct.Struct("<16sIIHHBB96s")
+
+# QEMU protocol messages to the emulator
+qemu_tap = struct.Struct("!bb")
+qemu_bluetooth_connection = struct.Struct("!b")
+qemu_compass = struct.Struct("!Ib")
+qemu_battery = struct.Struct("!bb")
+qemu_accel_header = struct.Struct("!b")
+qemu_accel_sample = struct.Struct("!hhh")
+qemu_accel_response = struct.Struct("!H")
+qemu_button = struct.Struct("!b")
+qemu_vibration = struct.Struct("!b")
+
+# QEMU transport packet: signature, protocol, length (then the data and a footer signature)
+qemu_packet_header = struct.Struct("!HHH")
+qemu_packet_footer = struct.Struct("!H")
+
+# WebSocket transport: command (then the data); status replies are a native uint32
+websocket_command = struct.Struct("B")
+websocket_status = struct.Struct("I")
+# WebSocket frame header: flags and opcode, mask flag and length (or 126/127, then a 16/64 bit length)
+websocket_frame = struct.Struct("!BB")
+websocket_frame_16 = struct.Struct("!BBH")
+websocket_frame_64 = struct.Struct("!BBQ")
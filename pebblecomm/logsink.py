@@ -0,0 +1,205 @@
+import fnmatch
+import json
+import logging as log
+import os
+import Queue
+import struct
+import sys
+import threading
+import time
+import uuid
+
+from pebble import AppLogRecord, LogRecord, Pebble
+
+# A pipeline that takes log records off the reader thread: LogPipeline queues
+# LOGS and APP_LOGS records (bounded, so a slow sink can't eat all memory) and
+# a worker thread filters them and hands them to sinks in batches.
+
+
+class LogFilter(object):
+    """
+    Matches log records by app UUID, level and filename.
+
+    UUIDs are compared on the raw bytes and levels on the header, so only a
+    filename filter needs anything decoded. Firmware (LOGS) records have no
+    UUID and never match a UUID filter.
+    """
+
+    def __init__(self, uuids=None, max_level=None, filenames=None):
+        self.uuids = set(uuid.UUID(str(u)).bytes for u in uuids) if uuids else None
+        self.max_level = LogRecord.parse_level(max_level) if max_level is not None else None
+        self.filenames = list(filenames) if filenames else None
+
+    def matches(self, record):
+        if self.uuids is not None:
+            if not isinstance(record, AppLogRecord) or record.data[:AppLogRecord.UUID_LENGTH] not in self.uuids:
+                return False
+        if self.max_level is not None and record.level > self.max_level:
+            return False
+        if self.filenames is not None:
+            if not any(fnmatch.fnmatch(record.filename, pattern) for pattern in self.filenames):
+                return False
+        return True
+
+
+class LogPipeline(object):
+    """
+    Sends a Pebble's log records to sinks on a worker thread.
+
+    The reader thread only queues each record with the time it arrived. When
+    the queue (maxsize records) is full, new records are dropped and counted
+    in `dropped`, or with block=True the reader thread waits, pushing back on
+    the watch connection. Sinks get lists of (time, record) of up to
+    batch_size records through write_batch(), and flush() when the queue runs
+    dry.
+    """
+
+    def __init__(self, pebble, sinks, log_filter=None, maxsize=10000, batch_size=256, block=False):
+        self.pebble = pebble
+        self.sinks = sinks
+        self.log_filter = log_filter
+        self.batch_size = batch_size
+        self.block = block
+        self.dropped = 0
+        self._queue = Queue.Queue(maxsize)
+        self._worker = threading.Thread(target=self._run)
+        self._worker.setDaemon(True)
+        self._worker.start()
+        self.pebble.register_endpoint("LOGS", self.message_callback)
+        self.pebble.register_endpoint("APP_LOGS", self.message_callback)
+
+    def message_callback(self, endpoint, record):
+        if record is None:
+            # Filtered out by level before it was decoded
+            return
+        try:
+            self._queue.put((time.time(), record), self.block)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """ Stop taking records, write out the ones queued and close the sinks """
+        self.pebble.unregister_endpoint("LOGS", self.message_callback)
+        self.pebble.unregister_endpoint("APP_LOGS", self.message_callback)
+        self._queue.put(None)
+        self._worker.join()
+        for sink in self.sinks:
+            sink.close()
+        if self.dropped:
+            log.warn("Dropped %d log messages that arrived faster than they could be written" % self.dropped)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            done = batch[-1] is None
+            if done:
+                batch.pop()
+            if self.log_filter is not None:
+                batch = [entry for entry in batch if self.log_filter.matches(entry[1])]
+            if batch:
+                for sink in self.sinks:
+                    sink.write_batch(batch)
+            if done or self._queue.empty():
+                for sink in self.sinks:
+                    sink.flush()
+            if done:
+                return
+
+
+class ConsoleSink(object):
+    """ Prints records the way `pebble logs` always has, one write per batch """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def write_batch(self, batch):
+        self.stream.write(''.join("%s\n" % record for _, record in batch))
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+
+
+class JsonLinesSink(object):
+    """ Writes one JSON object per record """
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+
+    @staticmethod
+    def to_dict(received, record):
+        fields = {
+            'received': received,
+            'timestamp': record.timestamp,
+            'level': record.str_level,
+            'filename': record.filename,
+            'line': record.line_number,
+            'message': record.message,
+        }
+        if isinstance(record, AppLogRecord):
+            fields['uuid'] = str(record.uuid)
+        return fields
+
+    def write_batch(self, batch):
+        self._file.write(''.join(json.dumps(self.to_dict(received, record)) + "\n" for received, record in batch))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class BinaryLogSink(object):
+    """
+    Writes records undecoded: after the magic, each record is the time it was
+    received, its endpoint and its length (<dHH), then the raw payload. Read
+    it back with read_binary_log().
+    """
+
+    MAGIC = "PBLLOG\x01"
+    record_header = struct.Struct("<dHH")
+
+    endpoints = {LogRecord: Pebble.endpoints["LOGS"], AppLogRecord: Pebble.endpoints["APP_LOGS"]}
+
+    def __init__(self, path):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab')
+        if new:
+            self._file.write(self.MAGIC)
+
+    def write_batch(self, batch):
+        parts = []
+        for received, record in batch:
+            parts.append(self.record_header.pack(received, self.endpoints[type(record)], len(record.data)))
+            parts.append(record.data)
+        self._file.write(''.join(parts))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_binary_log(path):
+    """ Yields (time received, LogRecord or AppLogRecord) from a BinaryLogSink file """
+    record_types = dict((v, k) for k, v in BinaryLogSink.endpoints.iteritems())
+    header = BinaryLogSink.record_header
+    with open(path, 'rb') as f:
+        if f.read(len(BinaryLogSink.MAGIC)) != BinaryLogSink.MAGIC:
+            raise ValueError("%s is not a binary log" % path)
+        while True:
+            data = f.read(header.size)
+            if len(data) < header.size:
+                return
+            received, endpoint, length = header.unpack(data)
+            yield received, record_types[endpoint](f.read(length))
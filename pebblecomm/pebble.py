@@ -2,6 +2,7 @@
 
 import atexit
 import binascii
+import codec
 import collections
 import datetime
 import glob
@@ -11,14 +12,15 @@ import logging as log
 import os
 import PebbleUtil as util
 import png
+import Queue
 import random
 import re
-import sh
 import signal
 import socket
 import speex
 import stm32_crc
 import struct
+import symbols
 import threading
 import time
 import traceback
@@ -30,7 +32,13 @@ import zipfile
 
 from AppStore import AppStoreClient
 from collections import OrderedDict
-from struct import pack, unpack
+from struct import pack
+
+try:
+    # Optional; only used to speed up screenshot decoding
+    import numpy
+except ImportError:
+    numpy = None
 
 DEFAULT_PEBBLE_ID = None #Triggers autodetection on unix-like systems
 DEFAULT_WEBSOCKET_PORT = 9000
@@ -227,23 +235,95 @@ class PebbleBundle(object):
         return self.get_real_path(self.get_worker_info()['name'])
 
 
-class ScreenshotSync():
+class PebbleProtocolReassembler(object):
+    """
+    Splits the byte stream received from a transport into Pebble Protocol frames.
+
+    Incoming data is written into a single preallocated bytearray that is used
+    as a ring buffer: frames are handed out as memoryviews into it, the read
+    offset simply moves past them, and the unread tail is only moved back to
+    the front when there is not enough room left at the end of the buffer.
+
+    Payload views are only valid until the next call to feed().
+    """
+
+    header = codec.frame_header
+    initial_capacity = 8192
+
+    def __init__(self, capacity=initial_capacity):
+        self._buffer = bytearray(capacity)
+        self._read_offset = 0
+        self._write_offset = 0
+
+    def __len__(self):
+        return self._write_offset - self._read_offset
+
+    def feed(self, data):
+        size = len(data)
+        if self._write_offset + size > len(self._buffer):
+            self._make_room(size)
+        self._buffer[self._write_offset:self._write_offset + size] = data
+        self._write_offset += size
+
+    def _make_room(self, size):
+        pending = len(self)
+        capacity = len(self._buffer)
+        if pending + size <= capacity:
+            # Compact: move the unread tail to the start of the buffer
+            self._buffer[0:pending] = self._buffer[self._read_offset:self._write_offset]
+        else:
+            while capacity < pending + size:
+                capacity *= 2
+            buffer = bytearray(capacity)
+            buffer[0:pending] = self._buffer[self._read_offset:self._write_offset]
+            self._buffer = buffer
+        self._read_offset = 0
+        self._write_offset = pending
+
+    def frames(self):
+        """ Yields (endpoint, payload) for each complete frame; payload is a memoryview """
+        view = memoryview(self._buffer)
+        while self._write_offset - self._read_offset >= self.header.size:
+            size, endpoint = self.header.unpack_from(self._buffer, self._read_offset)
+            start = self._read_offset + self.header.size
+            if self._write_offset - start < size:
+                return
+            self._read_offset = start + size
+            if self._read_offset == self._write_offset:
+                # Buffer drained, so the next frame can start at the front again
+                self._read_offset = self._write_offset = 0
+            yield endpoint, view[start:start + size]
+
+
+class ScreenshotSync(object):
     timeout = 60
     SCREENSHOT_OK = 0
     SCREENSHOT_MALFORMED_COMMAND = 1
     SCREENSHOT_OOM_ERROR = 2
     SCREENSHOT_ALREADY_IN_PROGRESS = 3
 
-    def __init__(self, pebble, endpoint, progress_callback):
+    def __init__(self, pebble, endpoint, progress_callback, register=True):
         self.marker = threading.Event()
-        self.data = ''
-        self.have_read_header = False
-        self.length_received = 0
         self.progress_callback = progress_callback
-        self.version = None
         self.pebble = pebble
         self.endpoint = endpoint
-        self.pebble.register_endpoint(self.endpoint, self.message_callback)
+        # Sized from the header and kept across reset() while the size is the same
+        self.buffer = bytearray()
+        self.reset()
+        if register:
+            self.pebble.register_endpoint(self.endpoint, self.message_callback)
+
+    def reset(self):
+        """ get ready to receive another screenshot """
+        self.marker.clear()
+        self.have_read_header = False
+        self.length_received = 0 # in bytes
+        self.version = None
+
+    @property
+    def data(self):
+        """ the image data received so far, without copying it """
+        return memoryview(self.buffer)[:self.length_received]
 
     # Received a reply message from the watch. We expect several of these...
     def message_callback(self, endpoint, data):
@@ -251,17 +331,16 @@ class ScreenshotSync():
             data = self.read_header(data)
             self.have_read_header = True
 
-        self.data += data
-        if self.version == 1:
-            self.length_received += len(data) * 8 # in bits
-        else:
-            self.length_received += len(data)
-        self.progress_callback(float(self.length_received)/self.total_length)
-        if self.length_received >= self.total_length:
+        # Anything past the size given by the header is ignored
+        end = min(self.length_received + len(data), len(self.buffer))
+        self.buffer[self.length_received:end] = data[:end - self.length_received]
+        self.length_received = end
+        self.progress_callback(float(self.length_received)/len(self.buffer))
+        if self.length_received >= len(self.buffer):
             self.marker.set()
 
     def read_header(self, data):
-        image_header = struct.Struct("!BIII")
+        image_header = codec.screenshot_header
         header_len = image_header.size
         header_data = data[:header_len]
         data = data[header_len:]
@@ -286,48 +365,64 @@ class ScreenshotSync():
         if self.total_length == 0:
             raise PebbleError(None, "Received a malformed message from the watch."
                 "Response code is {}, but image size is {}".format(response_code, self.total_length))
-        
+
+        if self.version == 1:
+            size = (self.total_length + 7) / 8
+        else:
+            size = self.total_length
+        if len(self.buffer) != size:
+            # A new buffer rather than a resize, which memoryviews of the old one would prevent
+            self.buffer = bytearray(size)
+
         return data
 
+    # Pixels for each byte of screenshot data, one byte per (sub)pixel.
+    # v1 is 1 bit per pixel, least significant bit first; v2 is one pixel per
+    # byte, 2 bits each of red, green and blue below 2 ignored bits.
+    PIXELS_V1 = tuple(''.join(chr(byte >> bit & 0b1) for bit in xrange(8)) for byte in xrange(256))
+    PIXELS_V2 = tuple(chr(byte >> 4 & 0b11) + chr(byte >> 2 & 0b11) + chr(byte & 0b11) for byte in xrange(256))
+
+    def get_pixels(self):
+        """ returns the image as one byte per (sub)pixel, row after row """
+        if numpy is not None:
+            data = numpy.frombuffer(self.buffer, dtype=numpy.uint8, count=self.length_received)
+            if self.version == 1:
+                pixels = numpy.unpackbits(data).reshape(-1, 8)[:, ::-1]
+            else:
+                pixels = numpy.dstack((data >> 4 & 0b11, data >> 2 & 0b11, data & 0b11))
+            return pixels.tostring()
+
+        table = ScreenshotSync.PIXELS_V1 if self.version == 1 else ScreenshotSync.PIXELS_V2
+        data = self.buffer
+        if self.length_received < len(data):
+            data = data[:self.length_received]
+        return ''.join(map(table.__getitem__, data))
+
     def get_data_array(self):
         """ splits data in pure binary into a 2D array of pixels of length N """
-        # break data into bytes
-        data_bytes_iter = (ord(ch) for ch in self.data)
-
+        pixels = self.get_pixels()
         if self.version == 1:
-            # separate each byte into 8 one-bit entries - IE, 0xf0 --> [1,1,1,1,0,0,0,0]
-            data_pixels_iter = (byte >> bit_order & 0b1
-                for byte in data_bytes_iter for bit_order in xrange(8))
+            row_length = self.width
         else:
-            data_pixels_iter = itertools.chain(*(((byte >> 4) & 0b11, (byte >> 2) & 0b11, (byte) & 0b11)
-                for byte in data_bytes_iter))
+            row_length = self.width * 3
+        # the last row may be partial; keep it anyway
+        return [bytearray(pixels[start:start + row_length])
+                for start in xrange(0, len(pixels), row_length)]
+
+    def is_complete(self):
+        return self.marker.is_set()
 
-        # pack 1-d bit array of size w*h into h arrays of size w, pad w/ zeros
-        output_bitmap = []
+    def get_image(self):
         if self.version == 1:
-            subpixels_per_pixel = 1
+            mode = 'L;1'
         else:
-            subpixels_per_pixel = 3
-        while True:
-            try:
-                new_row = []
-                for _ in xrange(self.width * subpixels_per_pixel):
-                    new_row.append(data_pixels_iter.next())
-                output_bitmap.append(new_row)
-            except StopIteration:
-                # add part of the last row anyway
-                if new_row:
-                    output_bitmap.append(new_row)
-                return output_bitmap
+            mode = 'RGB;2'
+        return png.from_array(self.get_data_array(), mode=mode)
 
     def get_data(self):
         try:
             self.marker.wait(timeout=self.timeout)
-            if self.version == 1:
-                mode = 'L;1'
-            else:
-                mode = 'RGB;2'
-            return png.from_array(self.get_data_array(), mode=mode)
+            return self.get_image()
         except:
             traceback.print_exc()
             raise PebbleError(None, "Timed out... Is the Pebble phone app connected/direct BT connection up?")
@@ -335,6 +430,109 @@ class ScreenshotSync():
             self.pebble.unregister_endpoint(self.endpoint, self.message_callback)
 
 
+class ScreenshotStream(object):
+    """
+    Captures screenshots continuously, at up to `fps` frames per second.
+
+    The next screenshot is requested as soon as the current one has been
+    received (and is due), so the watch sends it while the current one is
+    decoded. Two ScreenshotSync sessions take turns receiving and decoding.
+
+    The stream only listens for screenshots while frames() is iterated, and
+    can be used as a context manager that closes it.
+    """
+
+    def __init__(self, pebble, fps=None, progress_callback=None):
+        self.pebble = pebble
+        self.interval = 1.0 / fps if fps else 0
+        progress_callback = progress_callback or (lambda amount: None)
+        self._free = [ScreenshotSync(pebble, "SCREENSHOT", progress_callback, register=False)
+                      for _ in xrange(2)]
+        # (time received, session) for each complete screenshot, or a PebbleError
+        self._ready = Queue.Queue()
+        self._receiving = None
+        self._last_request = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def message_callback(self, endpoint, data):
+        session = self._receiving
+        if session is None:
+            return
+        try:
+            session.message_callback(endpoint, data)
+        except PebbleError as e:
+            self._receiving = None
+            self._ready.put(e)
+            return
+        if session.is_complete():
+            self._receiving = None
+            self._ready.put((time.time(), session))
+
+    def frames(self, count=None, duration=None):
+        """
+        Yields (timestamp, png.Image) for each screenshot until `count` have
+        been taken or `duration` seconds have passed (or forever). The stream
+        is closed afterwards.
+        """
+        end = time.time() + duration if duration else None
+        taken = 0
+        self.pebble.register_endpoint("SCREENSHOT", self.message_callback)
+        try:
+            self._request()
+            while True:
+                timestamp, session = self._next()
+                taken += 1
+                more = (count is None or taken < count) and (end is None or timestamp < end)
+                requested = False
+                if more and time.time() >= self._last_request + self.interval:
+                    self._request()
+                    requested = True
+
+                image = session.get_image()
+                self._free.append(session)
+                yield timestamp, image
+
+                if not more:
+                    break
+                if not requested:
+                    time.sleep(max(0, self._last_request + self.interval - time.time()))
+                    self._request()
+        finally:
+            self.close()
+
+    def close(self):
+        # Let a screenshot that is still on its way finish, so its data
+        # isn't taken for the start of the next one
+        if self._receiving is not None:
+            try:
+                self._next()
+            except PebbleError:
+                pass
+        self.pebble.unregister_endpoint("SCREENSHOT", self.message_callback)
+
+    def _request(self):
+        session = self._free.pop()
+        session.reset()
+        self._receiving = session
+        self._last_request = time.time()
+        self.pebble._send_message("SCREENSHOT", "\x00")
+
+    def _next(self):
+        try:
+            result = self._ready.get(timeout=ScreenshotSync.timeout)
+        except Queue.Empty:
+            self._receiving = None
+            raise PebbleError(None, "Timed out waiting for a screenshot")
+        if isinstance(result, PebbleError):
+            raise result
+        return result
+
+
 class CoreDumpSync():
     timeout_sec = 180
 
@@ -355,7 +553,7 @@ class CoreDumpSync():
 
     def __init__(self, pebble, endpoint, progress_callback):
         self.marker = threading.Event()
-        self.data = ''
+        self.buffer = bytearray()
         self.have_read_header = False
         self.length_received = 0
         self.progress_callback = progress_callback
@@ -371,11 +569,8 @@ class CoreDumpSync():
             self.have_read_header = True
             return
 
-        data_header = struct.Struct("!BBI")
-        header_len = data_header.size
-        header_data = data[:header_len]
-        data = data[header_len:]
-        op_code, transaction_id, byte_offset = data_header.unpack(header_data)
+        op_code, transaction_id, byte_offset = codec.coredump_data.unpack_from(data)
+        data = data[codec.coredump_data.size:]
 
         if op_code != CoreDumpSync.COREDUMP_CMD_RSP_CORE_DUMP_IMAGE_DATA:
             self.error_code = -1
@@ -390,7 +585,9 @@ class CoreDumpSync():
             raise PebbleError(None, "Expected next data with byte offset 0x%x but got byte offset 0x%x" %
                               (self.length_received, byte_offset))
 
-        self.data += data
+        # Written in place; anything past the length given by the header is ignored
+        end = min(byte_offset + len(data), self.total_length)
+        self.buffer[byte_offset:end] = data[:end - byte_offset]
         self.length_received += len(data)
         print "received 0x%x bytes, length received: 0x%x" % (len(data), self.length_received)
         self.progress_callback(float(self.length_received) / self.total_length)
@@ -398,17 +595,13 @@ class CoreDumpSync():
             self.marker.set()
 
     def read_header(self, data):
-        core_dump_header = struct.Struct("!BBBI")
-        header_len = core_dump_header.size
-        header_data = data[:header_len]
-        data = data[header_len:]
-        op_code, transaction_id, response_code, self.total_length = \
-            core_dump_header.unpack(header_data)
+        op_code, transaction_id, response_code, self.total_length = codec.coredump_info.unpack_from(data)
 
         if response_code == self.response_codes["DOES_NOT_EXIST"]:
             raise PebbleError(None, "No coredumps found on watch")
 
         print "total length of core dump: 0x%x" % (self.total_length)
+        self.buffer = bytearray(self.total_length)
 
         if op_code != 1:
             self.error_code = -1
@@ -432,29 +625,231 @@ class CoreDumpSync():
             self.marker.wait(timeout=self.timeout_sec)
             if self.length_received < self.total_length:
                 raise PebbleError(None, "Timed out... Is the Pebble phone app connected/direct BT connection up?")
-            return self.data
+            return self.buffer
         except:
             print "Got Error"
             raise PebbleError(None, "Timed out... Is the Pebble phone app connected/direct BT connection up?")
         finally:
             self.pebble.unregister_endpoint(self.endpoint, self.message_callback)
 
+class CoreDumpDownload(object):
+    """
+    Downloads the watch's coredump into a file, picking up again after drops.
+
+    Data is written in place as it arrives, into a file preallocated (sparse)
+    to the full size, and the last good offset is checkpointed to
+    <path>.checkpoint. The watch always sends a coredump from the start, so
+    after a gap or a timeout it is requested again under a new transaction
+    id: data below the last good offset is checked against what was saved
+    rather than rewritten, gaps there are skipped over, and only a gap above
+    it fails the attempt, so each attempt gets further than the last. Running
+    again with the same path carries on from the checkpoint.
+    """
+
+    # Seconds without any coredump data before an attempt is given up on
+    timeout_sec = 30
+
+    # Seconds the endpoint has to be quiet before the next attempt, so the
+    # watch has finished sending the abandoned one
+    settle_sec = 2
+
+    # Save the checkpoint after every this many bytes
+    checkpoint_interval = 64 * 1024
+
+    info_header = codec.coredump_info
+    data_header = codec.coredump_data
+
+    def __init__(self, pebble, path, progress_callback, attempts=5):
+        self.pebble = pebble
+        self.path = path
+        self.checkpoint_path = path + ".checkpoint"
+        self.progress_callback = progress_callback
+        self.attempts = attempts
+        self.total_length = None
+        self.received = 0
+        self.error = None
+        self.fatal = False
+        self.done = threading.Event()
+        self._transaction_id = CoreDumpSync.COREDUMP_TRANSACTION_ID
+        self._expected_offset = None
+        self._last_activity = time.time()
+        self._file = None
+        self._load_checkpoint()
+
+    def run(self):
+        """ Download the coredump. Returns the path it was saved to. """
+        if os.path.exists(self.path) and self.total_length is None:
+            raise PebbleError(None, "%s already exists and there is no checkpoint to resume it from" % self.path)
+        self._file = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+        self.pebble.register_endpoint("COREDUMP", self.message_callback)
+        try:
+            for attempt in xrange(self.attempts):
+                if attempt:
+                    log.warn("Coredump transfer stopped at 0x%x of 0x%x bytes (%s); requesting it again" %
+                             (self.received, self.total_length or 0, self.error))
+                    self._wait_until_quiet()
+                if self._attempt():
+                    self._verify()
+                    return self.path
+                if self.fatal:
+                    break
+            raise PebbleError(None, "Failed to fetch coredump: %s" % self.error)
+        finally:
+            self.pebble.unregister_endpoint("COREDUMP", self.message_callback)
+            self._save_checkpoint()
+            self._file.close()
+
+    def _attempt(self):
+        self._transaction_id = (self._transaction_id + 1) & 0xff
+        self._expected_offset = None
+        self._last_activity = time.time()
+        self.error = None
+        self.fatal = False
+        self.done.clear()
+        self.pebble._send_message("COREDUMP", codec.coredump_request.pack(CoreDumpSync.COREDUMP_CMD_REQ_CORE_DUMP_IMAGE,
+                                                                          self._transaction_id))
+        while not self.done.wait(1):
+            if time.time() - self._last_activity > self.timeout_sec:
+                self.error = "timed out"
+                break
+        # Stop writing for this attempt; anything still on its way is stale
+        self._transaction_id = (self._transaction_id + 1) & 0xff
+        return self.error is None
+
+    def _wait_until_quiet(self):
+        while time.time() - self._last_activity < self.settle_sec:
+            time.sleep(self.settle_sec)
+
+    def _fail(self, error, fatal=False):
+        self.error = error
+        self.fatal = fatal
+        self.done.set()
+
+    # Errors are recorded rather than raised, which would take down the reader thread
+    def message_callback(self, endpoint, data):
+        self._last_activity = time.time()
+        if self.done.is_set() or len(data) < 2:
+            return
+        op_code, transaction_id = codec.coredump_request.unpack_from(data)
+        if transaction_id != self._transaction_id:
+            # Left over from an abandoned attempt
+            return
+
+        if op_code == CoreDumpSync.COREDUMP_CMD_RSP_CORE_DUMP_IMAGE_INFO and len(data) >= self.info_header.size:
+            return self._read_info(data)
+        if op_code != CoreDumpSync.COREDUMP_CMD_RSP_CORE_DUMP_IMAGE_DATA or len(data) < self.data_header.size:
+            return self._fail("Pebble responded with an invalid message (opcode %d)" % op_code)
+        if self._expected_offset is None:
+            return self._fail("Pebble sent coredump data before its size")
+
+        _, _, byte_offset = self.data_header.unpack_from(data)
+        if byte_offset > self.received:
+            # Skipped over data we don't have saved
+            return self._fail("expected data at offset 0x%x but got offset 0x%x" % (self.received, byte_offset))
+
+        data = data[self.data_header.size:self.data_header.size + self.total_length - byte_offset]
+        self._expected_offset = byte_offset + len(data)
+        self._store(byte_offset, data)
+        self.progress_callback(float(self.received) / self.total_length)
+        if self._expected_offset >= self.total_length:
+            self.done.set()
+
+    def _read_info(self, data):
+        _, _, response_code, total_length = self.info_header.unpack_from(data)
+        if response_code == CoreDumpSync.response_codes["DOES_NOT_EXIST"]:
+            return self._fail("No coredumps found on watch", fatal=True)
+        if response_code == CoreDumpSync.response_codes["ALREADY_IN_PROGRESS"]:
+            return self._fail("a coredump transfer is already in progress")
+        if response_code != CoreDumpSync.response_codes["COREDUMP_OK"]:
+            return self._fail("Pebble responded with nonzero response code %d" % response_code, fatal=True)
+
+        if total_length != self.total_length:
+            if self.total_length is not None:
+                log.warn("Coredump on the watch is 0x%x bytes, not 0x%x; starting again" %
+                         (total_length, self.total_length))
+            self.total_length = total_length
+            self.received = 0
+            self._file.truncate(0)
+        # Sparse where the filesystem allows; filled in as data arrives
+        self._file.truncate(total_length)
+        self._expected_offset = 0
+        if self.total_length == 0:
+            self.done.set()
+
+    def _store(self, offset, data):
+        # Data we already have is compared rather than rewritten
+        overlap = max(0, min(len(data), self.received - offset))
+        if overlap:
+            self._file.seek(offset)
+            if self._file.read(overlap) != data[:overlap]:
+                log.warn("Coredump data at 0x%x differs from what was saved; replacing it" % offset)
+                self.received = offset
+                overlap = 0
+        if overlap < len(data):
+            self._file.seek(offset + overlap)
+            self._file.write(data[overlap:])
+            before = self.received
+            self.received = offset + len(data)
+            if before / self.checkpoint_interval != self.received / self.checkpoint_interval:
+                self._save_checkpoint()
+
+    def _verify(self):
+        self._file.flush()
+        size = os.fstat(self._file.fileno()).st_size
+        if self.received != self.total_length or size != self.total_length:
+            raise PebbleError(None, "Coredump is incomplete: have 0x%x of 0x%x bytes, file is 0x%x bytes" %
+                              (self.received, self.total_length, size))
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path) or not os.path.exists(self.path):
+            return
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if os.path.getsize(self.path) != checkpoint['total_length']:
+            # Not the file this checkpoint was saved for
+            return
+        self.total_length = checkpoint['total_length']
+        self.received = checkpoint['received']
+
+    def _save_checkpoint(self):
+        if self.total_length is None:
+            return
+        if self.received >= self.total_length:
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+            return
+        self._file.flush()
+        with open(self.checkpoint_path, 'w') as f:
+            json.dump({'total_length': self.total_length, 'received': self.received}, f)
+
 class AudioSync():
 
     MSG_ID_START = 0x01
     MSG_ID_DATA = 0x02
     MSG_ID_STOP = 0x03
 
-    def __init__(self, pebble, endpoint, timeout=60):
+    def __init__(self, pebble, endpoint, timeout=60, filename=None):
+        """
+        If filename is given, frames are written to it as an Ogg Speex file as
+        they arrive rather than kept in memory. timeout is how long to wait
+        without hearing from the watch.
+        """
         self.timeout = timeout
         self.marker = threading.Event()
         self.recording = False
+        self.filename = filename
+        self.writer = None
+        # Guards writer, which the reader thread writes and get_data() may close
+        self.writer_lock = threading.Lock()
+        self.frames = []
+        self.last_packet_time = time.time()
         self.pebble = pebble
         self.endpoint = endpoint
         self.pebble.register_endpoint(self.endpoint, self.packet_callback)
 
     def packet_callback(self, endpoint, data):
-        packet_id, = unpack('B', data[0])
+        self.last_packet_time = time.time()
+        packet_id, = codec.uint8.unpack_from(data)
         if packet_id == AudioSync.MSG_ID_START:
             self.process_start_packet(data)
         elif packet_id == AudioSync.MSG_ID_DATA:
@@ -463,33 +858,54 @@ class AudioSync():
             self.process_stop_packet(data)
 
     def process_start_packet(self, data):
-        _, _, encoder_id, self.sample_rate, _ = unpack('<BHBIH', data[:10])
+        _, _, encoder_id, self.sample_rate, _ = codec.audio_start.unpack_from(data)
         if encoder_id == 1:
             print 'Receiving audio data... Encoded with Speex {}'.format(data[10:30].strip())
         self.frames = []
+        if self.filename is not None:
+            self.close_writer()
+            with self.writer_lock:
+                self.writer = speex.OggSpeexWriter(self.filename, self.sample_rate)
         self.recording = True
 
     def process_data_packet(self, data):
         index = 4
-        while index < len(data):
-            frame_length, = unpack('B', data[index])
-            index += 1
-            if self.recording:
-                self.frames.append(data[index:index + frame_length])
-            index += frame_length
+        with self.writer_lock:
+            while index < len(data):
+                frame_length, = codec.uint8.unpack_from(data, index)
+                index += 1
+                if self.writer is not None:
+                    self.writer.write_frame(data[index:index + frame_length])
+                elif self.recording:
+                    self.frames.append(data[index:index + frame_length])
+                index += frame_length
 
     def process_stop_packet(self, data):
-        self.marker.set()
+        self.close_writer()
         self.recording = False
+        self.marker.set()
+
+    def close_writer(self):
+        with self.writer_lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
 
     def get_data(self):
+        """
+        Wait for the recording to finish. Returns its frames (empty when they
+        were written to filename) and sample rate.
+        """
         try:
-            self.marker.wait(self.timeout)
+            # Recordings can be long; only give up once the watch goes quiet
+            while not self.marker.wait(1):
+                if time.time() - self.last_packet_time > self.timeout:
+                    raise PebbleError(None, "Timed out... Is the Pebble phone app connected/direct BT connection up?")
             return self.frames, self.sample_rate
-        except:
-            raise PebbleError(None, "Timed out... Is the Pebble phone app connected/direct BT connection up?")
         finally:
             self.pebble.unregister_endpoint(self.endpoint, self.packet_callback)
+            # Whatever was received is kept, even if the recording didn't finish
+            self.close_writer()
 
 
 class EndpointSync():
@@ -513,6 +929,81 @@ class EndpointSync():
         finally:
             self.pebble.unregister_endpoint(self.endpoint, self.callback)
 
+class ResponseSync(object):
+    """Waits (with a timeout) for the response a ResponseCorrelator hands it."""
+
+    def __init__(self, correlator, key, timeout=10):
+        self.marker = threading.Event()
+        self.correlator = correlator
+        self.key = key
+        self.timeout = timeout
+        self.error = None
+
+    def set_result(self, data):
+        self.data = data
+        self.marker.set()
+
+    def set_exception(self, error):
+        self.error = error
+        self.marker.set()
+
+    def get_data(self):
+        if not self.marker.wait(timeout=self.timeout):
+            self.correlator.discard(self.key, self)
+            raise PebbleError(None, "Timed out... Is the Pebble phone app connected/direct BT connection up?")
+        if self.error is not None:
+            raise self.error
+        return self.data
+
+class ResponseCorrelator(object):
+    """
+    Hands each response to the request waiting for it.
+
+    Waiters are keyed by (endpoint, key), where key is the cookie or token the
+    response echoes from its request, or None for endpoints without one. Waiters
+    sharing a key are answered oldest first.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+
+    def add(self, key, waiter):
+        with self._lock:
+            self._waiters.setdefault(key, collections.deque()).append(waiter)
+
+    def discard(self, key, waiter):
+        with self._lock:
+            waiters = self._waiters.get(key)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[key]
+
+    def resolve(self, key, data):
+        """Pass data to the oldest waiter for key. Returns False if nothing was waiting."""
+        with self._lock:
+            waiters = self._waiters.get(key)
+            if not waiters:
+                return False
+            waiter = waiters.popleft()
+            if not waiters:
+                del self._waiters[key]
+        waiter.set_result(data)
+        return True
+
+    def waiting(self, key):
+        """True if a request is waiting for a response with key."""
+        with self._lock:
+            return key in self._waiters
+
+    def fail_all(self, error):
+        with self._lock:
+            waiters, self._waiters = self._waiters, {}
+        for queue in waiters.values():
+            for waiter in queue:
+                waiter.set_exception(error)
+
 class QemuEndpointSync():
     timeout = 10
 
@@ -539,6 +1030,254 @@ class PebbleError(Exception):
     def __str__(self):
         return "%s (ID:%s)" % (self._message, self._id)
 
+class Record(object):
+    """
+    A parsed response, with its fields in __slots__ rather than a dict per
+    message. Records can still be read like the dicts they replaced:
+    record['name'], 'name' in record, keys(), items() and get().
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in self.__slots__ else default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.__slots__]
+
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other.items())
+        except AttributeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % item for item in self.items()))
+
+class FirmwareVersion(Record):
+    """ One firmware's entry in a VERSION response """
+
+    __slots__ = ('timestamp', 'version', 'commit', 'is_recovery', 'hardware_platform', 'metadata_ver')
+
+    layout = codec.firmware_version
+
+    @classmethod
+    def unpack_from(cls, data, offset=0):
+        fw = cls(*cls.layout.unpack_from(data, offset))
+        fw.version = fw.version.replace("\x00", "")
+        fw.commit = fw.commit.replace("\x00", "")
+        return fw
+
+class WatchVersions(Record):
+    """ A VERSION response: the normal and recovery firmware and the hardware """
+
+    __slots__ = ('normal_fw', 'recovery_fw', 'bootloader_timestamp', 'hw_version', 'serial', 'btmac')
+
+    hardware = codec.watch_hardware
+    HARDWARE_OFFSET = 95
+    BTMAC_OFFSET = 120
+
+    @classmethod
+    def unpack(cls, data):
+        normal_fw = FirmwareVersion.unpack_from(data, 1)
+        recovery_fw = FirmwareVersion.unpack_from(data, 1 + FirmwareVersion.layout.size)
+        bootloader_timestamp, hw_version, serial = cls.hardware.unpack_from(data, cls.HARDWARE_OFFSET)
+        btmac_hex = binascii.hexlify(data[cls.BTMAC_OFFSET:cls.BTMAC_OFFSET + 6])
+        btmac = ":".join([btmac_hex[i:i+2].upper() for i in reversed(xrange(0, 12, 2))])
+        return cls(normal_fw, recovery_fw, bootloader_timestamp, hw_version.replace("\x00", ""), serial, btmac)
+
+class AppBankEntry(Record):
+    """ An installed app in an app bank status response """
+
+    __slots__ = ('id', 'index', 'name', 'company', 'flags', 'version')
+
+    layout = codec.app_bank_entry
+
+    @classmethod
+    def unpack_from(cls, data, offset=0):
+        app = cls(*cls.layout.unpack_from(data, offset))
+        app.name = app.name.replace("\x00", "")
+        app.company = app.company.replace("\x00", "")
+        return app
+
+class AppBankStatus(Record):
+    """ An app bank status response: how many banks there are and the apps in them """
+
+    __slots__ = ('banks', 'apps')
+
+class LogRecord(object):
+    """
+    A log message from the watch, decoded only as far as it is used.
+
+    It holds the raw payload. The fixed header is unpacked when a field is
+    first read, and the filename and message are decoded only if asked for,
+    so records that are filtered out or never printed cost next to nothing.
+    """
+
+    __slots__ = ('data', 'offset', '_header', '_filename', '_message')
+
+    header = codec.log_header
+    FILENAME_LENGTH = 16
+
+    log_levels = {
+            0: "*",
+            1: "E",
+            50: "W",
+            100: "I",
+            200: "D",
+            250: "V"
+    }
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+        self._header = None
+        self._filename = None
+        self._message = None
+
+    @classmethod
+    def parse_level(cls, level):
+        """
+        level as a number: given a number (or a string of digits) from 0 to
+        255, or a letter from log_levels in either case. Raises ValueError
+        for anything else.
+        """
+        if isinstance(level, basestring):
+            if level.isdigit():
+                level = int(level)
+            else:
+                levels = dict((v, k) for k, v in cls.log_levels.iteritems())
+                if level.upper() not in levels:
+                    raise ValueError("Unknown log level %r; use a number from 0 to 255 or one of %s" %
+                                     (level, ", ".join(cls.log_levels[k] for k in sorted(cls.log_levels) if k)))
+                level = levels[level.upper()]
+        if not isinstance(level, (int, long)) or not 0 <= level <= 255:
+            raise ValueError("Log levels are numbers from 0 to 255, not %r" % (level,))
+        return level
+
+    @staticmethod
+    def raw_level(data, offset=0):
+        """ the level of the log message in data, without decoding anything else """
+        return ord(data[offset + 4])
+
+    def _fields(self):
+        if self._header is None:
+            self._header = self.header.unpack_from(self.data, self.offset)
+        return self._header
+
+    @property
+    def timestamp(self):
+        return self._fields()[0]
+
+    @property
+    def level(self):
+        return self._fields()[1]
+
+    @property
+    def str_level(self):
+        return self.log_levels.get(self.level, "?")
+
+    @property
+    def line_number(self):
+        return self._fields()[3]
+
+    @property
+    def filename(self):
+        if self._filename is None:
+            start = self.offset + self.header.size
+            name = self.data[start:start + self.FILENAME_LENGTH].split("\0")[0]
+            self._filename = name.decode('utf-8', 'ignore')
+        return self._filename
+
+    @property
+    def message(self):
+        if self._message is None:
+            start = self.offset + self.header.size + self.FILENAME_LENGTH
+            self._message = self.data[start:start + self._fields()[2]].decode('utf-8', 'ignore')
+        return self._message
+
+    def __str__(self):
+        return "{} {} {} {} {}".format(self.timestamp, self.str_level, self.filename.encode('utf-8'),
+                                       self.line_number, self.message.encode('utf-8'))
+
+class AppLogRecord(LogRecord):
+    """ An app's log message: a LogRecord after the app's UUID """
+
+    __slots__ = ()
+
+    UUID_LENGTH = 16
+
+    def __init__(self, data):
+        super(AppLogRecord, self).__init__(data, self.UUID_LENGTH)
+
+    @property
+    def uuid(self):
+        return uuid.UUID(bytes=self.data[:self.UUID_LENGTH])
+
+    def __str__(self):
+        return "{} {}:{} {}".format(self.str_level, self.filename.encode('utf-8'), self.line_number,
+                                    self.message.encode('utf-8'))
+
+LogEvent = collections.namedtuple('LogEvent', 'name uuid fields record')
+
+class LogTrigger(object):
+    """
+    Watches app log messages (APP_LOGS, not the firmware's own LOGS) for one
+    kind of event, such as a crash.
+
+    A message is only decoded and searched with the regex if one of the
+    markers (plain byte strings) is in its raw payload, so most messages cost
+    a substring search or two. A match becomes a LogEvent named name, with
+    the regex's named groups as its fields.
+    """
+
+    def __init__(self, name, markers, pattern):
+        self.name = name
+        self.markers = markers
+        self.regex = re.compile(pattern)
+
+    def match(self, record):
+        data = record.data
+        for marker in self.markers:
+            if marker in data:
+                break
+        else:
+            return None
+        m = self.regex.search(record.message)
+        if m is None:
+            return None
+        return LogEvent(self.name, record.uuid, m.groupdict(), record)
+
 class Pebble(object):
     """
     A connection to a Pebble watch; data and commands may be sent
@@ -572,15 +1311,33 @@ class Pebble(object):
             "AUDIO": 10000, # New in 3.x
     }
 
-    log_levels = {
-            0: "*",
-            1: "E",
-            50: "W",
-            100: "I",
-            200: "D",
-            250: "V"
+    # Header of every Pebble Protocol message: payload length, endpoint
+    header = codec.frame_header
+
+    # Largest message (header included) known to be accepted by every watch
+    # when the transport doesn't tell us better: a 2000 byte PutBytes chunk.
+    DEFAULT_MAX_MESSAGE_SIZE = 2013
+
+    # Message sizes tried, largest first, when probing for a larger maximum
+    PROBE_MAX_MESSAGE_SIZES = (16384, 8192, 4096)
+
+    # Endpoints whose responses echo a field of the request (the ping cookie,
+    # the BlobDB token), so concurrent requests get their own responses:
+    # endpoint -> (Struct, offset in request, offset in response)
+    correlation_keys = {
+            "PING": (codec.uint32, 1, 1),
+            "BLOB_DB": (codec.blob_db_token, 1, 0),
     }
 
+    log_levels = LogRecord.log_levels
+
+    # The message the firmware logs for an app when it crashes. Only APP_LOGS messages are searched; add
+    # triggers for other app log messages with add_log_trigger().
+    log_triggers = [
+        LogTrigger('crash', ('App fault!',),
+                   r'App fault! (?P<uuid>{[0-9a-fA-F\-]+}) PC: (?P<pc>\S+) LR: (?P<lr>\S+)'),
+    ]
+
 
     @staticmethod
     def AutodetectDevice():
@@ -633,9 +1390,28 @@ class Pebble(object):
         self._qemu_internal_endpoint_handlers = {
             QemuPebble.QemuProtocol_VibrationNotification: self._qemu_vibration_notification,
         }
-        self.pebble_protocol_reassembly_buffer = ''
+        self.pebble_protocol_reassembler = PebbleProtocolReassembler()
+        self._responses = ResponseCorrelator()
+        self._correlation_keys = dict((self.endpoints[name], key) for name, key in self.correlation_keys.iteritems())
+        # endpoint id -> compiled handler chain (see _compile_endpoint), for endpoints with something to run
+        self._endpoint_chains = {}
+        for endpoint in set(self._internal_endpoint_handlers) | set(self._correlation_keys):
+            self._compile_endpoint(endpoint)
         self.watch_fw_version = None
         self.watch_hardware = None
+        self.putbytes_window = 1
+        self.putbytes_probe = False
+        self.print_pbl_logs = False
+        self.print_app_logs = True
+        # Log messages less severe (numerically higher) than this are dropped undecoded
+        self.log_level = 255
+        self._symbolicator = symbols.Symbolicator()
+        # ((directory, appinfo.json mtime), app UUID) of the project crashes are symbolicated for
+        self._crash_project = None
+        self._log_triggers = list(self.log_triggers)
+        self._log_event_handlers = [self._crash_event]
+        self._max_message_size = self.DEFAULT_MAX_MESSAGE_SIZE
+        self._max_message_size_probed = False
 
     def init_reader(self):
         try:
@@ -650,8 +1426,9 @@ class Pebble(object):
             raise
 
     def get_watch_version_info(self):
-        version_info = self.get_versions()
+        self._set_watch_version_info(self.get_versions())
 
+    def _set_watch_version_info(self, version_info):
         fw_version = version_info['normal_fw']['version']
 
         # remove the v and split on '.' and '-'
@@ -711,6 +1488,7 @@ class Pebble(object):
             key = self.endpoints[endpoint_name]
             if key in self._internal_endpoint_handlers:
                 del self._internal_endpoint_handlers[key]
+                self._compile_endpoint(key)
 
         WebSocketPebble.enableTrace(False)
         self._ser = WebSocketPebble.create_connection(host, port, timeout=1, connect_timeout=5)
@@ -724,6 +1502,8 @@ class Pebble(object):
         self._ser = QemuPebble.QemuPebble(host, port, timeout=1, connect_timeout=5)
         self._ser.enable_trace(True)
         self._ser.connect()
+        # QEMU hands its packets straight to the firmware, so its limit is the watch's
+        self._max_message_size = self._ser.max_message_size
         self.init_reader()
 
     def _exit_signal_handler(self, *args):
@@ -738,63 +1518,89 @@ class Pebble(object):
         except:
             pass
 
+    def _compile_endpoint(self, endpoint):
+        """
+        Rebuild the chain run for each message on endpoint; needed whenever its
+        handlers change. A chain is (handlers given the raw payload, internal
+        parser or None, handlers given the parsed payload, whether responses
+        carry a correlation key).
+        """
+        handlers = self._endpoint_handlers.get(endpoint, ())
+        parser = self._internal_endpoint_handlers.get(endpoint)
+        correlated = endpoint in self._correlation_keys
+        if not handlers and parser is None and not correlated:
+            self._endpoint_chains.pop(endpoint, None)
+        else:
+            # Replaced whole, so the reader thread always sees a consistent chain
+            self._endpoint_chains[endpoint] = (tuple(h.fn for h in handlers if not h.preprocess),
+                                               parser,
+                                               tuple(h.fn for h in handlers if h.preprocess),
+                                               correlated)
+
     def _parse_received_pebble_protocol_data(self):
-        while True:
-            if len(self.pebble_protocol_reassembly_buffer) < 4:
-                return
-            header = self.pebble_protocol_reassembly_buffer[0:4]
-            tail = self.pebble_protocol_reassembly_buffer[4:]
-            size, endpoint = unpack("!HH", header)
-            if len(tail) < size:
-                return
-            payload = tail[0:size]
-            self.pebble_protocol_reassembly_buffer = self.pebble_protocol_reassembly_buffer[4 + size:]
+        chains = self._endpoint_chains
+        for endpoint, payload_view in self.pebble_protocol_reassembler.frames():
+            # Handlers parse payloads as strings, so take the one copy here
+            payload = payload_view.tobytes()
+
+            chain = chains.get(endpoint)
+            if chain is None:
+                # Nothing handles this endpoint, but a request may be waiting for it
+                self._responses.resolve((endpoint, None), payload)
+                continue
+            raw_handlers, parser, handlers, correlated = chain
+            if correlated:
+                key = (endpoint, self._correlation_key(endpoint, payload, response=True))
+            else:
+                key = (endpoint, None)
 
-            for handler in self._endpoint_handlers.get(endpoint, []):
-                if not handler.preprocess:
-                    handler.fn(endpoint, payload)
+            for fn in raw_handlers:
+                fn(endpoint, payload)
 
-            if endpoint in self._internal_endpoint_handlers:
-                payload = self._internal_endpoint_handlers[endpoint](endpoint, payload)
+            if parser is not None:
+                payload = parser(endpoint, payload)
 
-            for handler in self._endpoint_handlers.get(endpoint, []):
-                if handler.preprocess:
-                    handler.fn(endpoint, payload)
+            for fn in handlers:
+                fn(endpoint, payload)
 
-    def _reader(self):
-        try:
-            while self._alive:
-                source, endpoint, resp = self._recv_message()
-                #reading message if socket is closed causes exceptions
+            self._responses.resolve(key, payload)
+
+    def _handle_message(self, source, endpoint, resp):
+        if resp is None or source is None:
+            # ignore message
+            pass
 
-                if resp is None or source is None:
-                    # ignore message
-                    pass
+        elif source == 'ws':
+            if endpoint in ['status', 'phoneInfo']:
+                # phone -> sdk message
+                self._ws_client.handle_response(endpoint, resp)
+            elif endpoint == 'log':
+                log.info(resp)
+            elif endpoint == 'watchConnectionStatusUpdate':
+                watch_connected = resp
+                if watch_connected and self._app_log_enabled:
+                    self.app_log_enable()
 
-                elif source == 'ws':
-                    if endpoint in ['status', 'phoneInfo']:
-                        # phone -> sdk message
-                        self._ws_client.handle_response(endpoint, resp)
-                    elif endpoint == 'log':
-                        log.info(resp)
-                    elif endpoint == 'watchConnectionStatusUpdate':
-                        watch_connected = resp
-                        if watch_connected and self._app_log_enabled:
-                            self.app_log_enable()
+        elif source == 'qemu':
+            if endpoint in self._qemu_internal_endpoint_handlers:
+                resp = self._qemu_internal_endpoint_handlers[endpoint](endpoint, resp)
 
-                elif source == 'qemu':
-                    if endpoint in self._qemu_internal_endpoint_handlers:
-                        resp = self._qemu_internal_endpoint_handlers[endpoint](endpoint, resp)
+            if endpoint in self._qemu_endpoint_handlers and resp is not None:
+                self._qemu_endpoint_handlers[endpoint](endpoint, resp)
 
-                    if endpoint in self._qemu_endpoint_handlers and resp is not None:
-                        self._qemu_endpoint_handlers[endpoint](endpoint, resp)
+        elif source == 'watch':
+            self.pebble_protocol_reassembler.feed(resp)
+            self._parse_received_pebble_protocol_data()
 
-                elif source == 'watch':
-                    self.pebble_protocol_reassembly_buffer += resp
-                    self._parse_received_pebble_protocol_data()
+        else:
+            raise ValueError('Unknown source "%s"' % source)
 
-                else:
-                    raise ValueError('Unknown source "%s"' % source)
+    def _reader(self):
+        try:
+            while self._alive:
+                #reading message if socket is closed causes exceptions
+                source, endpoint, resp = self._recv_message()
+                self._handle_message(source, endpoint, resp)
 
         except Exception as e:
             import traceback
@@ -817,18 +1623,63 @@ class Pebble(object):
         return d
 
     def _build_message(self, endpoint, data):
-        return pack("!HH", len(data), endpoint)+data
+        return self.header.pack(len(data), endpoint)+data
 
     def _send_message(self, endpoint, data, callback = None):
+        """
+        Send data, a string or a list of strings that make up the payload, to
+        endpoint. Transports that set write_accepts_lists are handed the header
+        and the parts as a list, so they join everything (their own framing
+        included) only once; others get the message as one string.
+        """
         if endpoint not in self.endpoints:
             raise PebbleError(self.id, "Invalid endpoint specified")
 
-        msg = self._build_message(self.endpoints[endpoint], data)
+        if isinstance(data, (list, tuple)):
+            parts = [self.header.pack(sum(len(part) for part in data), self.endpoints[endpoint])]
+            parts.extend(data)
+        else:
+            parts = [self.header.pack(len(data), self.endpoints[endpoint]), data]
 
         if DEBUG_PROTOCOL:
-            log.debug('>>> ' + msg.encode('hex'))
+            log.debug('>>> ' + ''.join(parts).encode('hex'))
 
-        self._ser.write(msg)
+        if getattr(self._ser, 'write_accepts_lists', False):
+            self._ser.write(parts)
+        else:
+            self._ser.write(''.join(parts))
+
+    def _correlation_key(self, endpoint, data, response=False):
+        if endpoint not in self._correlation_keys:
+            return None
+        key, request_offset, response_offset = self._correlation_keys[endpoint]
+        try:
+            return key.unpack_from(data, response_offset if response else request_offset)[0]
+        except struct.error:
+            return None
+
+    def _expect(self, endpoint_name, timeout=10, key=None):
+        """
+        Returns a ResponseSync for the next response on endpoint_name (carrying
+        key, for endpoints listed in correlation_keys).
+        """
+        waiter = ResponseSync(self._responses, (self.endpoints[endpoint_name], key), timeout)
+        self._responses.add(waiter.key, waiter)
+        return waiter
+
+    def _request(self, endpoint_name, data, async=False, timeout=10):
+        """
+        Send a message and return its (parsed) response, or None if async.
+
+        We start waiting before sending, so a quick response can't be missed.
+        """
+        if async:
+            self._send_message(endpoint_name, data)
+            return None
+        key = self._correlation_key(self.endpoints[endpoint_name], data)
+        waiter = self._expect(endpoint_name, timeout, key)
+        self._send_message(endpoint_name, data)
+        return waiter.get_data()
 
     def _recv_message(self):
         if self._connection_type != 'serial':
@@ -847,7 +1698,7 @@ class Pebble(object):
                 return (None, None, None)
             elif len(data) < 4:
                 raise PebbleError(self.id, "Malformed response with length "+str(len(data)))
-            size, _ = unpack("!HH", data)
+            size, _ = self.header.unpack(data)
             resp = data + self._ser.read(size)
             endpoint = 'Pebble Protocol'
             source = 'watch'
@@ -865,6 +1716,7 @@ class Pebble(object):
         endpoint = self.endpoints[endpoint_name]
         handler = self._EndpointHandler(func, preprocess)
         self._endpoint_handlers.setdefault(endpoint, []).append(handler)
+        self._compile_endpoint(endpoint)
 
     def unregister_endpoint(self, endpoint_name, func=None, preprocess=True):
         if endpoint_name not in self.endpoints:
@@ -881,6 +1733,7 @@ class Pebble(object):
                 self._endpoint_handlers[endpoint].remove(self._EndpointHandler(func, preprocess))
             except ValueError:
                 pass
+        self._compile_endpoint(endpoint)
 
     def register_qemu_endpoint(self, endpoint_id, func):
         self._qemu_endpoint_handlers[endpoint_id] = func
@@ -901,14 +1754,28 @@ class Pebble(object):
         self._send_message("MUSIC_CONTROL", self._pack_message_data(16, parts))
 
     def screenshot(self, progress_callback):
+        # Listen before asking, so a quick reply can't be missed
+        session = ScreenshotSync(self, "SCREENSHOT", progress_callback)
         self._send_message("SCREENSHOT", "\x00")
-        return ScreenshotSync(self, "SCREENSHOT", progress_callback).get_data()
+        return session.get_data()
+
+    def screenshot_stream(self, fps=None, progress_callback=None):
+        """Returns a ScreenshotStream; iterate over its frames() to take screenshots."""
+        return ScreenshotStream(self, fps, progress_callback)
 
     def coredump(self, progress_callback):
         session = CoreDumpSync(self, "COREDUMP", progress_callback);
-        self._send_message("COREDUMP", "%c%c" % (CoreDumpSync.COREDUMP_CMD_REQ_CORE_DUMP_IMAGE, CoreDumpSync.COREDUMP_TRANSACTION_ID))
+        self._send_message("COREDUMP", codec.coredump_request.pack(CoreDumpSync.COREDUMP_CMD_REQ_CORE_DUMP_IMAGE,
+                                                                   CoreDumpSync.COREDUMP_TRANSACTION_ID))
         return session.get_data()
 
+    def download_coredump(self, path, progress_callback, attempts=5):
+        """
+        Fetch the coredump into a file, requesting it again (up to `attempts`
+        times) if the transfer drops. See CoreDumpDownload.
+        """
+        return CoreDumpDownload(self, path, progress_callback, attempts).run()
+
     def get_versions(self, async = False):
 
         """
@@ -916,19 +1783,14 @@ class Pebble(object):
         (firmware, bootloader, etc) running on the watch.
         """
 
-        self._send_message("VERSION", "\x00")
-
-        if not async:
-            return EndpointSync(self, "VERSION").get_data()
+        return self._request("VERSION", "\x00", async=async)
 
 
     def list_apps_by_uuid(self, async=False):
         """Returns the apps installed on the Pebble as a list of Uuid objects."""
 
-        data = pack("b", 0x05)
-        self._send_message("APP_MANAGER", data)
-        if not async:
-            return EndpointSync(self, "APP_MANAGER").get_data()
+        data = codec.int8.pack(0x05)
+        return self._request("APP_MANAGER", data, async=async)
 
     def describe_app_by_uuid(self, uuid, uuid_is_string=True, async = False):
         """Returns a dictionary that describes the installed app with the given uuid."""
@@ -939,17 +1801,12 @@ class Pebble(object):
             uuid = uuid.bytes
         # else, assume it's a byte array
 
-        data = pack("b", 0x06) + str(uuid)
-        self._send_message("APP_MANAGER", data)
-
-        if not async:
-            return EndpointSync(self, "APP_MANAGER").get_data()
+        data = codec.int8.pack(0x06) + str(uuid)
+        return self._request("APP_MANAGER", data, async=async)
 
     def current_running_uuid(self, async = False):
-        data = pack("b", 0x07)
-        self._send_message("APP_MANAGER", data)
-        if not async:
-            return EndpointSync(self, "APP_MANAGER").get_data()
+        data = codec.int8.pack(0x07)
+        return self._request("APP_MANAGER", data, async=async)
 
 
     def get_appbank_status(self, async = False):
@@ -960,21 +1817,16 @@ class Pebble(object):
         This is particularly useful when trying to locate a
         free app-bank to use when installing a new watch-app.
         """
-        self._send_message("APP_MANAGER", "\x01")
-
+        apps = self._request("APP_MANAGER", "\x01", async=async)
         if not async:
-            apps = EndpointSync(self, "APP_MANAGER").get_data()
-            return apps if type(apps) is dict else { 'apps': [] }
+            return apps if isinstance(apps, AppBankStatus) else AppBankStatus(0, [])
 
     def remove_app(self, appid, index, async=False):
 
         """Remove an installed application from the target app-bank."""
 
-        data = pack("!bII", 2, appid, index)
-        self._send_message("APP_MANAGER", data)
-
-        if not async:
-            return EndpointSync(self, "APP_MANAGER").get_data()
+        data = codec.app_remove.pack(2, appid, index)
+        return self._request("APP_MANAGER", data, async=async)
 
     def remove_app_by_uuid(self, uuid_to_remove, uuid_is_string=True, async = False):
         """Remove an installed application by UUID. Returns a string indicating status."""
@@ -985,28 +1837,21 @@ class Pebble(object):
             uuid_to_remove = uuid_to_remove.bytes
         # else, assume it's a byte array
 
-        data = pack("b", 0x02) + str(uuid_to_remove)
-        self._send_message("APP_MANAGER", data)
-
-        if not async:
-            return EndpointSync(self, "APP_MANAGER").get_data()
+        data = codec.int8.pack(0x02) + str(uuid_to_remove)
+        return self._request("APP_MANAGER", data, async=async)
 
     def get_time(self, async = False):
 
         """Retrieve the time from the Pebble's RTC."""
 
-        self._send_message("TIME", "\x00")
-
-        if not async:
-            return EndpointSync(self, "TIME").get_data()
+        return self._request("TIME", "\x00", async=async)
 
     def record(self, name="recording"):
 
         """Decode and store audio data streamed from Pebble"""
 
         try:
-            frames, sample_rate = AudioSync(self, "AUDIO").get_data()
-            speex.store_data(frames, name, sample_rate)
+            AudioSync(self, "AUDIO", filename=name).get_data()
             print "Recording stored in", name
         except PebbleError as e:
             print e
@@ -1015,7 +1860,7 @@ class Pebble(object):
 
         """Set the time stored in the target Pebble's RTC."""
 
-        data = pack("!bL", 2, timestamp)
+        data = codec.time_message.pack(2, timestamp)
         self._send_message("TIME", data)
 
     def set_time_utc(self, timestamp, tz_name=None, tz_offset_minutes=None):
@@ -1029,7 +1874,7 @@ class Pebble(object):
                 tz_offset_minutes = int(tz_offset / 60)
             tz_name = "UTC%+d" % (tz_offset_minutes / 60)
 
-        data = pack("!bIhb%ds" % len(tz_name), 3, timestamp, tz_offset_minutes, len(tz_name), tz_name)
+        data = codec.time_set_utc.pack(3, timestamp, tz_offset_minutes, len(tz_name)) + tz_name
         self._send_message("TIME", data)
 
 
@@ -1060,7 +1905,7 @@ class Pebble(object):
         self._ws_client = WSClient()
         # The first byte is reserved for future use as a protocol version ID
         #  and must be 0 for now.
-        data = pack("!b", 0)
+        data = codec.int8.pack(0)
         self._ser.write(data, ws_cmd=WebSocketPebble.WS_CMD_PHONE_INFO)
         self._ws_client.listen()
         while not self._ws_client._received and not self._ws_client._error:
@@ -1102,19 +1947,15 @@ class Pebble(object):
 
         client = PutBytesClient(self, first_free, "BINARY", binary)
         client.init()
-        while not client._done and not client._error:
-            time.sleep(0.5)
-        if client._error:
-            raise PebbleError(self.id, "Failed to send application binary %s/pebble-app.bin" % pbw_path)
+        if not client.wait():
+            raise PebbleError(self.id, "Failed to send application binary %s/pebble-app.bin: %s" % (pbw_path, client.error))
 
         # Install the resources
         if resources:
             client = PutBytesClient(self, first_free, "RESOURCES", resources)
             client.init()
-            while not client._done and not client._error:
-                time.sleep(0.5)
-            if client._error:
-                raise PebbleError(self.id, "Failed to send application resources %s/app_resources.pbpack" % pbw_path)
+            if not client.wait():
+                raise PebbleError(self.id, "Failed to send application resources %s/app_resources.pbpack: %s" % (pbw_path, client.error))
 
         # Is there a worker to install?
         worker_info = bundle.get_worker_info()
@@ -1122,10 +1963,8 @@ class Pebble(object):
             binary = bundle.zip.read(bundle.get_worker_path())
             client = PutBytesClient(self, first_free, "WORKER", binary)
             client.init()
-            while not client._done and not client._error:
-                time.sleep(0.5)
-            if client._error:
-                raise PebbleError(self.id, "Failed to send worker binary %s/%s" % (pbw_path, worker_info['name']))
+            if not client.wait():
+                raise PebbleError(self.id, "Failed to send worker binary %s/%s: %s" % (pbw_path, worker_info['name'], client.error))
 
 
         time.sleep(2)
@@ -1161,20 +2000,19 @@ class Pebble(object):
         )
 
         resp = metadata_blob.send()
-        if resp is not "SUCCESS":
+        if resp != "SUCCESS":
             print "Error: " + resp
 
-        # launch application
+        # listen for app fetch, then launch application
+        app_fetch = self._expect("APP_FETCH")
         self.launcher_message(app_metadata['uuid'].bytes, "RUNNING", uuid_is_string=False, async = True)
+        app_fetch = app_fetch.get_data()
 
-        # listen for app fetch
-        app_fetch = EndpointSync(self, "APP_FETCH").get_data()
-
-        command, app_uuid, app_id = unpack("<B16sI", app_fetch)
+        command, app_uuid, app_id = codec.app_fetch_request.unpack(app_fetch)
         uuid_str = str(uuid.UUID(bytes=app_uuid))
 
         # send ACK, no response comes back
-        resp = pack("BB", 1, 1) # APP_FETCH_INSTALL_RESPONSE, SUCCESS
+        resp = codec.app_fetch_response.pack(1, 1) # APP_FETCH_INSTALL_RESPONSE, SUCCESS
         self._send_message("APP_FETCH", resp)
 
         time.sleep(1)
@@ -1208,19 +2046,15 @@ class Pebble(object):
 
         client = PutBytesClient(self, app_id, "BINARY", binary, has_cookie=True)
         client.init()
-        while not client._done and not client._error:
-            time.sleep(0.5)
-        if client._error:
-            raise PebbleError(self.id, "Failed to send application binary %s/pebble-app.bin" % pbw_path)
+        if not client.wait():
+            raise PebbleError(self.id, "Failed to send application binary %s/pebble-app.bin: %s" % (pbw_path, client.error))
 
         # Install the resources
         if resources:
             client = PutBytesClient(self, app_id, "RESOURCES", resources, has_cookie=True)
             client.init()
-            while not client._done and not client._error:
-                time.sleep(0.5)
-            if client._error:
-                raise PebbleError(self.id, "Failed to send application resources %s/app_resources.pbpack" % pbw_path)
+            if not client.wait():
+                raise PebbleError(self.id, "Failed to send application resources %s/app_resources.pbpack: %s" % (pbw_path, client.error))
 
         # Is there a worker to install?
         worker_info = bundle.get_worker_info()
@@ -1228,10 +2062,8 @@ class Pebble(object):
             binary = bundle.zip.read(bundle.get_worker_path())
             client = PutBytesClient(self, app_id, "WORKER", binary, has_cookie=True)
             client.init()
-            while not client._done and not client._error:
-                time.sleep(0.5)
-            if client._error:
-                raise PebbleError(self.id, "Failed to send worker binary %s/%s" % (pbw_path, bundle.get_worker_path()))
+            if not client.wait():
+                raise PebbleError(self.id, "Failed to send worker binary %s/%s: %s" % (pbw_path, bundle.get_worker_path(), client.error))
 
         # If we have not thrown an exception, we succeeded
         return True
@@ -1249,9 +2081,8 @@ class Pebble(object):
             return self.install_app_pebble_protocol(pbw_path, launch_on_install)
 
     def timeline_add_pin(self):
-        fmt = "<16s16sIHBHBBBB"
         pin_id = uuid.uuid4()
-        pin = struct.pack(fmt,
+        pin = codec.timeline_pin.pack(
             pin_id.get_bytes(), # UUID
             "\x00",             # parent id
             int(time.time()),   # timestamp
@@ -1276,8 +2107,7 @@ class Pebble(object):
     def install_app_metadata(self, in_uuid, flags):
         rand_name = uuid.uuid4().get_hex()[0:6] # generate random name
         uuid_bytes = util.convert_to_bytes(in_uuid)
-        app = struct.pack(
-            "<16sIIHHBB96s",
+        app = codec.app_metadata_placeholder.pack(
             uuid_bytes,
             flags,              # info_flags
             0,                  # icon_resource_id
@@ -1310,33 +2140,32 @@ class Pebble(object):
         print reminder.id
         return reminder
 
+    def blob_db_batch(self, db, window=16):
+        """Returns a BlobDBBatch that keeps up to `window` operations on db in flight."""
+        return BlobDBBatch(self, db, window)
+
     def _raw_blob_db_insert(self, db, key, value):
         db = BlobDB(db)
         data = db.insert(key, value)
-        self._send_message("BLOB_DB", data)
-        return EndpointSync(self, "BLOB_DB").get_data()
+        return self._request("BLOB_DB", data)
 
     def _raw_blob_db_delete(self, db, key):
         db = BlobDB(db)
         data = db.delete(key)
-        self._send_message("BLOB_DB", data)
-        return EndpointSync(self, "BLOB_DB").get_data()
+        return self._request("BLOB_DB", data)
 
     def _raw_blob_db_clear(self, db):
         db = BlobDB(db)
         data = db.clear()
-        self._send_message("BLOB_DB", data)
-        return EndpointSync(self, "BLOB_DB").get_data()
+        return self._request("BLOB_DB", data)
 
 
     def send_file(self, file_path, name):
         data = open(file_path, 'r').read()
         client = PutBytesClient(self, 0, "FILE", data, name)
         client.init()
-        while not client._done and not client._error:
-            pass
-        if client._error:
-            raise PebbleError(self.id, "Failed to send file %s" % file_path)
+        if not client.wait():
+            raise PebbleError(self.id, "Failed to send file %s: %s" % (file_path, client.error))
         log.info("File transfer succesful")
 
     def install_firmware(self, pbz_path, recovery=False):
@@ -1355,18 +2184,14 @@ class Pebble(object):
         if resources:
             client = PutBytesClient(self, 0, "SYS_RESOURCES", resources)
             client.init()
-            while not client._done and not client._error:
-                pass
-            if client._error:
-                raise PebbleError(self.id, "Failed to send firmware resources %s/system_resources.pbpack" % pbz_path)
+            if not client.wait():
+                raise PebbleError(self.id, "Failed to send firmware resources %s/system_resources.pbpack: %s" % (pbz_path, client.error))
 
 
         client = PutBytesClient(self, 0, "RECOVERY" if recovery else "FIRMWARE", binary)
         client.init()
-        while not client._done and not client._error:
-            pass
-        if client._error:
-            raise PebbleError(self.id, "Failed to send firmware binary %s/tintin_fw.bin" % pbz_path)
+        if not client.wait():
+            raise PebbleError(self.id, "Failed to send firmware binary %s/tintin_fw.bin: %s" % (pbz_path, client.error))
 
         log.info("Installation successful")
         self.system_message("FIRMWARE_COMPLETE")
@@ -1398,11 +2223,7 @@ class Pebble(object):
         app_message_tuple = amsg.build_tuple(launcher_keys["RUN_STATE_KEY"], "UINT", launcher_key_values[key_value])
         app_message_dict = amsg.build_dict(app_message_tuple)
         packed_message = amsg.build_message(app_message_dict, "PUSH", app_uuid)
-        self._send_message("LAUNCHER", packed_message)
-
-        # wait for either ACK or NACK response
-        if not async:
-            return EndpointSync(self, "LAUNCHER").get_data()
+        return self._request("LAUNCHER", packed_message, async=async)
 
     def app_message_send_tuple(self, app_uuid, key, tuple_datatype, tuple_data):
 
@@ -1474,7 +2295,7 @@ class Pebble(object):
         }
         if command not in commands:
             raise PebbleError(self.id, "Invalid command \"%s\"" % command)
-        data = pack("!bb", 0, commands[command])
+        data = codec.system_message.pack(0, commands[command])
         log.debug("Sending command %s (code %d)" % (command, commands[command]))
         self._send_message("SYSTEM_MESSAGE", data)
 
@@ -1483,11 +2304,8 @@ class Pebble(object):
 
         """Send a 'ping' to the watch to test connectivity."""
 
-        data = pack("!bL", 0, cookie)
-        self._send_message("PING", data)
-
-        if not async:
-            return EndpointSync(self, "PING").get_data()
+        data = codec.ping.pack(0, cookie)
+        return self._request("PING", data, async=async)
 
     def reset(self, prf=False, coredump=False, factory_reset=False):
 
@@ -1515,7 +2333,7 @@ class Pebble(object):
         if self._connection_type == 'qemu':
             self._ser.write(msg, protocol=protocol)
         elif self._connection_type == 'websocket':
-            self._ser.write(pack("B", protocol) + msg, ws_cmd=WebSocketPebble.WS_CMD_PHONESIM_QEMU)
+            self._ser.write([codec.websocket_command.pack(protocol), msg], ws_cmd=WebSocketPebble.WS_CMD_PHONESIM_QEMU)
         else:
             raise Exception("QEMU commands are only supported over qemu and websocket connections")
 
@@ -1525,7 +2343,7 @@ class Pebble(object):
         """Send a tap to the watch running in the emulator"""
         axes = {'x': 0, 'y': 1, 'z': 2}
         axis_int = axes.get(axis)
-        msg = pack('!bb', axis_int, direction);
+        msg = codec.qemu_tap.pack(axis_int, direction)
 
         if DEBUG_PROTOCOL:
             log.debug('>>> ' + msg.encode('hex'))
@@ -1536,7 +2354,7 @@ class Pebble(object):
     def emu_bluetooth_connection(self, connected=True):
 
         """Send a bluetooth connection event to the watch running in the emulator"""
-        msg = pack('!b', connected);
+        msg = codec.qemu_bluetooth_connection.pack(connected)
 
         if DEBUG_PROTOCOL:
             log.debug('>>> ' + msg.encode('hex'))
@@ -1547,7 +2365,7 @@ class Pebble(object):
     def emu_compass(self, heading=0, calib=2):
 
         """Send a compass event to the watch running in the emulator"""
-        msg = pack('!Ib', heading, calib);
+        msg = codec.qemu_compass.pack(heading, calib)
 
         if DEBUG_PROTOCOL:
             log.debug('>>> ' + msg.encode('hex'))
@@ -1558,7 +2376,7 @@ class Pebble(object):
     def emu_battery(self, pct=80, charging=True):
 
         """Send battery info to the watch running in the emulator"""
-        msg = pack('!bb', pct, charging);
+        msg = codec.qemu_battery.pack(pct, charging)
 
         if DEBUG_PROTOCOL:
             log.debug('>>> ' + msg.encode('hex'))
@@ -1611,10 +2429,8 @@ class Pebble(object):
         if len(samples) > MAX_ACCEL_SAMPLES:
             raise Exception("Cannot send %d samples. The max number of accel samples that can be "
                       "sent at a time is %d." % (len(samples), MAX_ACCEL_SAMPLES))
-        msg = pack('!b', len(samples))
-        for sample in samples:
-            sample_data = pack('!hhh', sample[0], sample[1], sample[2])
-            msg += sample_data
+        msg = codec.qemu_accel_header.pack(len(samples)) + \
+            ''.join(codec.qemu_accel_sample.pack(sample[0], sample[1], sample[2]) for sample in samples)
 
         if DEBUG_PROTOCOL:
             log.debug('>>> ' + msg.encode('hex'))
@@ -1623,7 +2439,7 @@ class Pebble(object):
 
         if self._connection_type == 'qemu':
             response = QemuEndpointSync(self, QemuPebble.QemuProtocol_Accel).get_data()
-            samples_avail = struct.unpack("!H", response)
+            samples_avail = codec.qemu_accel_response.unpack(response)
             print "Success: room for %d more samples" % (samples_avail)
 
 
@@ -1635,7 +2451,7 @@ class Pebble(object):
         button_state = 1 << button_id;
         while True:
             # send the press immediately followed by the release
-            msg = pack('!b', button_state);
+            msg = codec.qemu_button.pack(button_state)
 
             if DEBUG_PROTOCOL:
                 log.debug('>>> ' + msg.encode('hex'))
@@ -1677,14 +2493,12 @@ class Pebble(object):
         self._ser.write('\x02%s' % guid, ws_cmd=WebSocketPebble.WS_CMD_TIMELINE)
 
     def _qemu_vibration_notification(self, endpoint, data):
-        on, = unpack("!b", data)
+        on, = codec.qemu_vibration.unpack(data)
         print "Vibration: %s" % ("on" if on else "off")
 
     def request_factory_setting(self, setting, async=False):
-        self._send_message("FACTORY_SETTINGS", pack("!BB", 0x00, len(setting)) + str(setting))
-
-        if not async:
-            return EndpointSync(self, "FACTORY_SETTINGS").get_data()
+        return self._request("FACTORY_SETTINGS", codec.factory_setting_request.pack(0x00, len(setting)) + str(setting),
+                             async=async)
 
     WATCH_MODEL_MAP = {
         0x01: 'pebble_black',
@@ -1707,7 +2521,7 @@ class Pebble(object):
         if color is None:
             return None
         else:
-            model_id, = unpack('!I', color)
+            model_id, = codec.uint32.unpack(color)
             return self.WATCH_MODEL_MAP.get(model_id, None)
 
     def dump_logs(self, generation_number):
@@ -1732,7 +2546,7 @@ class Pebble(object):
                     log.warn("Unable to decode log dump message (length %d is less than 8)" % len(data))
                     return
 
-                response_type, response_cookie = unpack("!BI", data[:5])
+                response_type, response_cookie = codec.log_dump_response.unpack_from(data)
                 if response_type == 0x81:
                     self.done = True
                     return
@@ -1746,7 +2560,8 @@ class Pebble(object):
                     self.done = True
                     return
 
-                timestamp, str_level, filename, linenumber, message = self._pebble._parse_log_response(data[5:])
+                timestamp, str_level, filename, linenumber, message = \
+                    self._pebble._parse_log_response(data[codec.log_dump_response.size:])
 
                 timestamp_str = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
 
@@ -1757,7 +2572,7 @@ class Pebble(object):
 
         import random
         cookie = random.randint(0, pow(2, 32) - 1)
-        self._send_message("LOG_DUMP", pack("!BBI", 0x10, generation_number, cookie))
+        self._send_message("LOG_DUMP", codec.log_dump_request.pack(0x10, generation_number, cookie))
 
         while not client.done:
             time.sleep(1)
@@ -1766,14 +2581,14 @@ class Pebble(object):
     def app_log_enable(self):
         self._app_log_enabled = True
         log.info("Enabling application logging...")
-        self._send_message("APP_LOGS", pack("!B", 0x01))
+        self._send_message("APP_LOGS", codec.uint8.pack(0x01))
 
         self.get_watch_version_info()
 
     def app_log_disable(self):
         self._app_log_enabled = False
         log.info("Disabling application logging...")
-        self._send_message("APP_LOGS", pack("!B", 0x00))
+        self._send_message("APP_LOGS", codec.uint8.pack(0x00))
 
     def disconnect(self):
 
@@ -1781,12 +2596,52 @@ class Pebble(object):
 
         self._alive = False
         self._ser.close()
+        self._responses.fail_all(PebbleError(self.id, "Disconnected"))
+        self._symbolicator.close()
 
     def set_print_pbl_logs(self, value):
         self.print_pbl_logs = value
 
+    def set_print_app_logs(self, value):
+        self.print_app_logs = value
+
+    def set_log_level(self, level):
+        """
+        Drop log messages less severe than level (a number, or a letter from
+        log_levels: E, W, I, D or V) before they are decoded. Raises
+        ValueError for any other level.
+        """
+        self.log_level = LogRecord.parse_level(level)
+
+    def set_putbytes_window(self, window):
+        """Set how many PutBytes chunks may be in flight at once (1 = stop-and-wait)."""
+        self.putbytes_window = max(1, window)
+
+    def set_putbytes_probe(self, value):
+        """Have PutBytes transfers probe for the largest message size the watch accepts."""
+        self.putbytes_probe = value
+
+    def _transport_max_message_size(self):
+        return getattr(self._ser, 'max_message_size', self.DEFAULT_MAX_MESSAGE_SIZE)
+
+    def get_max_transfer_unit(self):
+        """Largest payload that can be sent in a single Pebble Protocol message on this connection."""
+        size = min(self._max_message_size, self._transport_max_message_size())
+        return size - self.header.size
+
+    def set_max_message_size(self, size):
+        self._max_message_size = min(size, self._transport_max_message_size())
+        self._max_message_size_probed = True
+
+    def probe_message_sizes(self):
+        """Message sizes above the current maximum that the transport could carry, largest first."""
+        if self._max_message_size_probed:
+            return []
+        limit = self._transport_max_message_size()
+        return [size for size in self.PROBE_MAX_MESSAGE_SIZES if self._max_message_size < size <= limit]
+
     def _add_app(self, index):
-        data = pack("!bI", 3, index)
+        data = codec.app_add.pack(3, index)
         self._send_message("APP_MANAGER", data)
 
     def _screenshot_response(self, endpoint, data):
@@ -1799,14 +2654,14 @@ class Pebble(object):
         return data
 
     def _factory_setting_response(self, endpoint, data):
-        command_id, = unpack("!B", data[0])
+        command_id, = codec.uint8.unpack_from(data)
         if command_id != 0x01:
             if command_id == 0xFF:
                 log.warning("Failed to request factory setting.")
             return None
         if len(data) < 2:
             return None
-        strlen, = unpack("!B", data[1])
+        strlen, = codec.uint8.unpack_from(data, 1)
         return data[2:2+strlen]
 
 
@@ -1814,62 +2669,79 @@ class Pebble(object):
         # Ping responses can either be 5 bytes or 6 bytes long.
         # The format is [ 1 byte command | 4 byte cookie | 1 byte idle flag (optional) ]
 
-        # We only care about the cookie, so just strip the idle flag before calling unpack
-        restype, retcookie = unpack("!bL", data[0:5])
+        # We only care about the cookie, so any idle flag after it is left unread
+        restype, retcookie = codec.ping.unpack_from(data)
         return retcookie
 
     def _get_time_response(self, endpoint, data):
-        restype, timestamp = unpack("!bL", data)
+        restype, timestamp = codec.time_message.unpack(data)
         return timestamp
 
     def _system_message_response(self, endpoint, data):
         if len(data) == 2:
-            log.info("Got system message %s" % repr(unpack('!bb', data)))
+            log.info("Got system message %s" % repr(codec.system_message.unpack(data)))
         elif len(data) == 3:
-            log.info("Got system message %s" % repr(unpack('!bbb', data)))
+            log.info("Got system message %s" % repr(codec.system_message_argument.unpack(data)))
         else:
             log.info("Got 'unknown' system message...")
 
     def _parse_log_response(self, log_message_data):
-        timestamp, level, msgsize, linenumber = unpack("!IBBH", log_message_data[:8])
-        filename = (log_message_data[8:24].split("\0")[0]).decode('utf-8', 'ignore')
-        message = log_message_data[24:24+msgsize].decode('utf-8', 'ignore')
-
-        str_level = self.log_levels[level] if level in self.log_levels else "?"
-
-        return timestamp, str_level, filename, linenumber, message
+        record = LogRecord(log_message_data)
+        return record.timestamp, record.str_level, record.filename, record.line_number, record.message
 
     def _log_response(self, endpoint, data):
         if (len(data) < 8):
             log.warn("Unable to decode log message (length %d is less than 8)" % len(data))
             return
 
-        if self.print_pbl_logs:
-            timestamp, str_level, filename, linenumber, message = self._parse_log_response(data)
-
-            log.info("{} {} {} {} {}".format(timestamp, str_level, filename, linenumber, message))
+        if LogRecord.raw_level(data) > self.log_level:
+            return None
 
-    def _print_crash_message(self, crashed_uuid, crashed_pc, crashed_lr):
-        # Read the current projects UUID from it's appinfo.json. If we can't do this or the uuid doesn't match
-        # the uuid of the crashed app we don't print anything.
-        import os, sys
-        sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'pebble'))
+        record = LogRecord(data)
+        if self.print_pbl_logs:
+            # Formatted (and decoded) only if the logger is going to output it
+            log.info("%s", record)
+        return record
+
+    def _read_app_uuid(self):
+        # Read the current projects UUID from it's appinfo.json, or None if we can't.
+        import sys
+        pebble_dir = os.path.join(os.path.dirname(__file__), '..', 'pebble')
+        if pebble_dir not in sys.path:
+            sys.path.append(pebble_dir)
         from PblProject import check_current_directory, PebbleProjectException
         try:
             check_current_directory()
         except PebbleProjectException:
             # We're not in the project directory
-            return
+            return None
 
         with open('appinfo.json', 'r') as f:
             try:
                 app_info = json.load(f)
-                app_uuid = uuid.UUID(app_info['uuid'])
+                return uuid.UUID(app_info['uuid'])
             except ValueError as e:
                 log.warn("Could not look up debugging symbols.")
                 log.warn("Failed parsing appinfo.json")
                 log.warn(str(e))
-                return
+                return None
+
+    def _current_app_uuid(self):
+        """ _read_app_uuid(), read again only when the directory or its appinfo.json changes """
+        try:
+            key = (os.getcwd(), os.path.getmtime('appinfo.json'))
+        except OSError:
+            return None
+        if self._crash_project is None or self._crash_project[0] != key:
+            self._crash_project = (key, self._read_app_uuid())
+        return self._crash_project[1]
+
+    def _print_crash_message(self, crashed_uuid, crashed_pc, crashed_lr):
+        # If we can't read the current project's UUID or it doesn't match the uuid of the crashed app we don't
+        # print anything.
+        app_uuid = self._current_app_uuid()
+        if app_uuid is None:
+            return
 
         if (app_uuid != crashed_uuid):
             # Someone other than us crashed, just bail
@@ -1898,8 +2770,11 @@ class Pebble(object):
 
                 result = '???'
             else:
-                result = sh.arm_none_eabi_addr2line(addr_str, exe=app_elf_path,
-                                                    _tty_out=False).strip()
+                try:
+                    result = self._symbolicator.lookup(app_elf_path, addr_str)
+                except (OSError, IOError) as e:
+                    log.warn("Could not look up debugging symbols: %s" % e)
+                    result = '???'
 
             log.warn("%24s %10s %s", register_name + ':', addr_str, result)
 
@@ -1908,59 +2783,66 @@ class Pebble(object):
 
 
     def _app_log_response(self, endpoint, data):
-        if (len(data) < 8):
-            log.warn("Unable to decode log message (length %d is less than 8)" % len(data))
+        if (len(data) < AppLogRecord.UUID_LENGTH + 8):
+            log.warn("Unable to decode log message (length %d is less than %d)" % (len(data), AppLogRecord.UUID_LENGTH + 8))
             return
 
-        app_uuid = uuid.UUID(bytes=data[0:16])
-        timestamp, str_level, filename, linenumber, message = self._parse_log_response(data[16:])
+        if AppLogRecord.raw_level(data, AppLogRecord.UUID_LENGTH) > self.log_level:
+            return None
+
+        record = AppLogRecord(data)
+        if self.print_app_logs:
+            log.info("%s", record)
+
+        for trigger in self._log_triggers:
+            event = trigger.match(record)
+            if event is not None:
+                for fn in self._log_event_handlers:
+                    fn(event)
 
-        log.info("{} {}:{} {}".format(str_level, filename, linenumber, message.encode('utf-8')))
+        return record
 
-        # See if the log message we printed matches the message we print when we crash. If so, try to provide
-        # some additional information by looking up the filename and linenumber for the symbol we crasehd at.
-        m = re.search('App fault! ({[0-9a-fA-F\-]+}) PC: (\S+) LR: (\S+)', message)
-        if m:
-            crashed_uuid_str = m.group(1)
-            crashed_uuid = uuid.UUID(crashed_uuid_str)
+    def _crash_event(self, event):
+        # If an app crashed, try to provide some additional information by looking up the filename and linenumber
+        # for the symbol we crashed at.
+        if event.name == 'crash':
+            self._print_crash_message(uuid.UUID(event.fields['uuid']), event.fields['pc'], event.fields['lr'])
 
-            self._print_crash_message(crashed_uuid, m.group(2), m.group(3))
+    def add_log_trigger(self, trigger):
+        """Watch app log messages for trigger, a LogTrigger, as well as those in log_triggers."""
+        self._log_triggers.append(trigger)
+
+    def register_log_event(self, func):
+        """Call func with a LogEvent when an app log message matches a LogTrigger."""
+        self._log_event_handlers.append(func)
+
+    def unregister_log_event(self, func):
+        self._log_event_handlers.remove(func)
 
     def _appbank_status_response(self, endpoint, data):
         def unpack_uuid(data):
             UUID_FORMAT = "{}{}{}{}-{}{}-{}{}-{}{}-{}{}{}{}{}{}"
-            uuid = unpack("!bbbbbbbbbbbbbbbb", data)
-            uuid = ["%02x" % (x & 0xff) for x in uuid]
+            uuid = ["%02x" % ord(x) for x in data[:16]]
             return UUID_FORMAT.format(*uuid)
-        apps = {}
-        restype, = unpack("!b", data[0])
+        restype, = codec.int8.unpack_from(data)
 
         if restype == 1:
-            apps["banks"], apps_installed = unpack("!II", data[1:9])
-            apps["apps"] = []
+            banks, apps_installed = codec.app_bank_status.unpack_from(data, 1)
+            apps = AppBankStatus(banks, [])
 
-            appinfo_size = 78
-            offset = 9
+            appinfo_size = AppBankEntry.layout.size
+            offset = 1 + codec.app_bank_status.size
             for i in xrange(apps_installed):
-                app = {}
-                try:
-                    app["id"], app["index"], app["name"], app["company"], app["flags"], app["version"] = \
-                            unpack("!II32s32sIH", data[offset:offset+appinfo_size])
-                    app["name"] = app["name"].replace("\x00", "")
-                    app["company"] = app["company"].replace("\x00", "")
-                    apps["apps"] += [app]
-                except:
-                    if offset+appinfo_size > len(data):
-                        log.warn("Couldn't load bank %d; remaining data = %s" % (i,repr(data[offset:])))
-                    else:
-                        raise
+                if offset+appinfo_size > len(data):
+                    log.warn("Couldn't load bank %d; remaining data = %s" % (i,repr(data[offset:])))
+                else:
+                    apps.apps.append(AppBankEntry.unpack_from(data, offset))
                 offset += appinfo_size
 
             return apps
 
         elif restype == 2:
-            message_id = unpack("!I", data[1:])
-            message_id = int(''.join(map(str, message_id)))
+            message_id, = codec.uint32.unpack_from(data, 1)
 
             # FIXME: These response strings only apply to responses to app remove (0x2) commands
             # If you receive a 0x2 message in response to a app install (0x3) message you actually
@@ -1987,7 +2869,7 @@ class Pebble(object):
             return app_install_message[message_id]
 
         elif restype == 5:
-            apps_installed = unpack("!I", data[1:5])[0]
+            apps_installed, = codec.uint32.unpack_from(data, 1)
             uuids = []
 
             uuid_size = 16
@@ -2000,7 +2882,7 @@ class Pebble(object):
 
         elif restype == 6:
             app = {}
-            app["version"], app["name"], app["company"] = unpack("H32s32s", data[1:])
+            app["version"], app["name"], app["company"] = codec.app_description.unpack_from(data, 1)
             app["name"] = app["name"].replace("\x00", "")
             app["company"] = app["company"].replace("\x00", "")
             return app
@@ -2013,35 +2895,7 @@ class Pebble(object):
             return restype
 
     def _version_response(self, endpoint, data):
-        fw_names = {
-                0: "normal_fw",
-                1: "recovery_fw"
-        }
-
-        resp = {}
-        for i in xrange(2):
-            fwver_size = 47
-            offset = i*fwver_size+1
-            fw = {}
-            fw["timestamp"],fw["version"],fw["commit"],fw["is_recovery"], \
-                    fw["hardware_platform"],fw["metadata_ver"] = \
-                    unpack("!i32s8s?Bb", data[offset:offset+fwver_size])
-
-            fw["version"] = fw["version"].replace("\x00", "")
-            fw["commit"] = fw["commit"].replace("\x00", "")
-
-            fw_name = fw_names[i]
-            resp[fw_name] = fw
-
-        resp["bootloader_timestamp"],resp["hw_version"],resp["serial"] = \
-                unpack("!L9s12s", data[95:120])
-
-        resp["hw_version"] = resp["hw_version"].replace("\x00","")
-
-        btmac_hex = binascii.hexlify(data[120:126])
-        resp["btmac"] = ":".join([btmac_hex[i:i+2].upper() for i in reversed(xrange(0, 12, 2))])
-
-        return resp
+        return WatchVersions.unpack(data)
 
     def _application_message_response(self, endpoint, data):
         app_messages = {
@@ -2096,12 +2950,12 @@ class Pebble(object):
         minor = 0
         bugfix = 0
 
-        msg = pack("!biIIbbbb", 1, -1, session, remote, response_vers,
-                   major, minor, bugfix)
+        msg = codec.phone_version.pack(1, -1, session, remote, response_vers,
+                                       major, minor, bugfix)
         self._send_message("PHONE_VERSION", msg);
 
     def _music_control_response(self, endpoint, data):
-        event, = unpack("!b", data)
+        event, = codec.int8.unpack(data)
 
         event_names = {
                 1: "PLAYPAUSE",
@@ -2112,9 +2966,8 @@ class Pebble(object):
         return event_names[event] if event in event_names else None
 
     def _blob_db_response(self, endpoint, data):
-        db = BlobDB()
-        token, resp = unpack("HB", data)
-        return db.interpret_response(resp)
+        token, resp = BlobDB.response.unpack(data)
+        return BlobDB.interpret_response(resp)
 
 
 class AppMessage(object):
@@ -2131,9 +2984,9 @@ class AppMessage(object):
 
         # build the message_tuple
         app_message_tuple = OrderedDict([
-                ("KEY", pack('<L', key)),
+                ("KEY", codec.app_message_key.pack(key)),
                 ("TYPE", tuple_datatypes[data_type]),
-                ("LENGTH", pack('<H', len(data))),
+                ("LENGTH", codec.app_message_length.pack(len(data))),
                 ("DATA", data)
         ])
 
@@ -2147,7 +3000,7 @@ class AppMessage(object):
         tuple_total_bytes = ''.join(item for item in itertools.chain(*tuple_of_tuples.values()))
         # now build the dict
         app_message_dict = OrderedDict([
-                ("TUPLECOUNT", pack('B', tuple_count)),
+                ("TUPLECOUNT", codec.app_message_tuple_count.pack(tuple_count)),
                 ("TUPLE", tuple_total_bytes)
         ])
         return app_message_dict
@@ -2232,7 +3085,23 @@ class PutBytesClient(object):
             "WORKER": 7,
     }
 
-    def __init__(self, pebble, index, transfer_type, buffer, filename="", has_cookie=False):
+    # Header of a put message: command, token, chunk length
+    put_header = codec.putbytes_put
+
+    # Seconds without a response from the watch before wait() gives up
+    timeout = 30
+
+    def __init__(self, pebble, index, transfer_type, buffer, filename="", has_cookie=False, window=None,
+                 probe=None):
+        """
+        window is the number of chunks that may be awaiting an ACK at once. The
+        default of 1 is plain stop-and-wait, which is what older firmware
+        expects; it is taken from Pebble.putbytes_window when not given.
+
+        Chunks are sized to fill the connection's maximum transfer unit. With
+        probe (default Pebble.putbytes_probe) larger messages are tried first,
+        and the largest one the watch accepts is remembered by the Pebble.
+        """
         if len(filename) > 255:
             raise Exception("Filename too long (>255 chars) " + filename)
 
@@ -2243,50 +3112,166 @@ class PutBytesClient(object):
         self._index = index
         self._done = False
         self._error = False
+        self.error = None
+        # Set once the transfer has either completed or failed
+        self._finished = threading.Event()
+        self._done_callbacks = []
+        self._last_response = None
+        self._token = None
         self._filename = filename + '\0'
         self._has_cookie = has_cookie
+        self._window = max(1, window or pebble.putbytes_window)
+        if probe is None:
+            probe = pebble.putbytes_probe
+        # Chunk sizes still to be tried, largest first; the first one is in use
+        self._chunk_sizes = [size - Pebble.header.size - self.put_header.size
+                             for size in (pebble.probe_message_sizes() if probe else [])]
+        self._probing = bool(self._chunk_sizes)
+        self._chunk_sizes.append(pebble.get_max_transfer_unit() - self.put_header.size)
+        # (offset, length) of each chunk sent but not yet ACKed, oldest first
+        self._in_flight = collections.deque()
+        # Token of a transfer we gave up on; its late responses are ignored
+        self._stale_token = None
+        # CRC of the data sent so far, updated as each chunk goes out
+        self._crc = stm32_crc.STM32Crc()
+        # Held while a response or a timeout moves the transfer along, as
+        # timeouts are handled on the thread that waits rather than the reader
+        self._lock = threading.RLock()
 
 
     def init(self):
         self._pebble.register_endpoint("PUTBYTES", self.handle_message)
         if self._has_cookie:
             self._transfer_type = self._transfer_type | (1 << 7)
-            data = pack("!BIBI", 1, len(self._buffer), self._transfer_type, self._index)
+            data = codec.putbytes_init.pack(1, len(self._buffer), self._transfer_type, self._index)
         else:
-            data = pack("!BIBB%ds" % (len(self._filename)), 1, len(self._buffer), self._transfer_type, self._index, self._filename)
+            data = codec.putbytes_init_file.pack(1, len(self._buffer), self._transfer_type, self._index) + self._filename
 
+        self._last_response = time.time()
         self._pebble._send_message("PUTBYTES", data)
         self._state = self.states["WAIT_FOR_TOKEN"]
 
+    def wait(self, timeout=None):
+        """
+        Block until the transfer has finished.
+
+        Returns True if it completed; on failure returns False with the reason in
+        self.error. The transfer is aborted if the watch does not respond for
+        timeout seconds (default PutBytesClient.timeout).
+        """
+        if self._last_response is None:
+            raise PebbleError(self._pebble.id, "PutBytes transfer waited on before init()")
+        timeout = timeout or self.timeout
+        while not self._finished.wait(timeout):
+            with self._lock:
+                # A response may have come in since the wait ended
+                if time.time() - self._last_response >= timeout:
+                    self.timed_out()
+        return self._done
+
+    def timed_out(self):
+        """
+        Called when the watch has not responded for timeout seconds. A message
+        larger than the phone or watch can take may be dropped rather than
+        NACKed, so while probing this steps down to the next chunk size;
+        otherwise the transfer is aborted.
+        """
+        with self._lock:
+            if self._finished.is_set():
+                return
+            if self._probing and self._state == self.states["IN_PROGRESS"] and len(self._chunk_sizes) > 1:
+                self.restart("No response to %d byte chunks" % self._chunk_sizes[0])
+            else:
+                self.abort("Timed out waiting for a response from the watch")
+
+    def add_done_callback(self, fn):
+        """Call fn(client) once the transfer has completed or failed."""
+        if self._finished.is_set():
+            fn(self)
+        else:
+            self._done_callbacks.append(fn)
+
+    def _finish(self):
+        self._finished.set()
+        for fn in self._done_callbacks:
+            fn(self)
+
+    def fail(self, reason):
+        self._pebble.unregister_endpoint("PUTBYTES", self.handle_message)
+        self.error = reason
+        self._error = True
+        self._state = self.states["FAILED"]
+        self._finish()
+
     def wait_for_token(self, resp):
-        res, = unpack("!b", resp[0])
+        if self._stale_token is not None and codec.uint32.unpack_from(resp, 1)[0] == self._stale_token:
+            # Late ACK/NACK for a chunk of the transfer we restarted
+            return
+        res, = codec.int8.unpack_from(resp)
         if res != 1:
             log.error("init failed with code %d" % res)
-            self._error = True
+            self.fail("Watch rejected the transfer (code %d)" % res)
             return
-        self._token, = unpack("!I", resp[1:])
+        self._token, = codec.uint32.unpack_from(resp, 1)
         self._left = len(self._buffer)
+        self._in_flight.clear()
+        self._crc = stm32_crc.STM32Crc()
         self._state = self.states["IN_PROGRESS"]
-        self.send()
+        self.fill_window()
 
     def in_progress(self, resp):
-        res, = unpack("!b", resp[0])
+        res, = codec.int8.unpack_from(resp)
+        # The watch handles chunks in order, so each response is for the oldest one in flight
+        if self._in_flight:
+            offset, length = self._in_flight.popleft()
+            if res == 1 and self._probing and length == self._chunk_sizes[0]:
+                # A full chunk of the size being probed got through, so keep it
+                self._pebble.set_max_message_size(length + self.put_header.size + Pebble.header.size)
+                del self._chunk_sizes[1:]
+                self._probing = False
         if res != 1:
-            self.abort()
+            if len(self._chunk_sizes) > 1 or self._window > 1:
+                self.restart()
+            else:
+                self.abort()
             return
         if self._left > 0:
-            self.send()
+            self.fill_window()
             log.info("Sent %d of %d bytes" % (len(self._buffer)-self._left, len(self._buffer)))
-        else:
+        elif not self._in_flight:
             self._state = self.states["COMMIT"]
             self.commit()
 
+    def restart(self, reason="Chunk rejected"):
+        """
+        Abort the current transfer and start over with smaller chunks if we are
+        still probing, or with half the window otherwise.
+
+        PutBytes chunks carry no offset, so once the watch has rejected a chunk
+        the ones already sent behind it cannot be placed; the only safe way
+        forward is a fresh transfer.
+        """
+        if len(self._chunk_sizes) > 1:
+            del self._chunk_sizes[0]
+        else:
+            self._window = max(1, self._window / 2)
+        log.warn("%s, restarting transfer with %d byte chunks and a window of %d" %
+                 (reason, self._chunk_sizes[0], self._window))
+        self._stale_token = self._token & 0xFFFFFFFF
+        self._pebble._send_message("PUTBYTES", codec.putbytes_token.pack(4, self._stale_token))
+        self._pebble.unregister_endpoint("PUTBYTES", self.handle_message)
+        self.init()
+
+    def fill_window(self):
+        while self._left > 0 and len(self._in_flight) < self._window:
+            self.send()
+
     def commit(self):
-        data = pack("!bII", 3, self._token & 0xFFFFFFFF, stm32_crc.crc32(self._buffer))
+        data = codec.putbytes_commit.pack(3, self._token & 0xFFFFFFFF, self._crc.crc32())
         self._pebble._send_message("PUTBYTES", data)
 
     def handle_commit(self, resp):
-        res, = unpack("!b", resp[0])
+        res, = codec.int8.unpack_from(resp)
         if res != 1:
             self.abort()
             return
@@ -2294,40 +3279,50 @@ class PutBytesClient(object):
         self.complete()
 
     def complete(self):
-        data = pack("!bI", 5, self._token & 0xFFFFFFFF)
+        data = codec.putbytes_token.pack(5, self._token & 0xFFFFFFFF)
         self._pebble._send_message("PUTBYTES", data)
 
     def handle_complete(self, resp):
-        res, = unpack("!b", resp[0])
+        res, = codec.int8.unpack_from(resp)
         if res != 1:
             self.abort()
             return
         self._pebble.unregister_endpoint("PUTBYTES", self.handle_message)
         self._done = True
-
-    def abort(self):
-        msgdata = pack("!bI", 4, self._token & 0xFFFFFFFF)
-        self._pebble._send_message("PUTBYTES", msgdata)
-        self._pebble.unregister_endpoint("PUTBYTES", self.handle_message)
-        self._error = True
+        self._finish()
+
+    def abort(self, reason=None):
+        if self._token is not None:
+            msgdata = codec.putbytes_token.pack(4, self._token & 0xFFFFFFFF)
+            self._pebble._send_message("PUTBYTES", msgdata)
+        if reason is None:
+            reason = {
+                self.states["IN_PROGRESS"]: "Watch rejected a chunk",
+                self.states["COMMIT"]: "Watch rejected the commit, CRC mismatch?",
+                self.states["COMPLETE"]: "Watch rejected the install",
+            }.get(self._state, "Transfer aborted")
+        self.fail(reason)
 
     def send(self):
-        datalen =  min(self._left, 2000)
+        datalen =  min(self._left, self._chunk_sizes[0])
         rg = len(self._buffer)-self._left
-        msgdata = pack("!bII", 2, self._token & 0xFFFFFFFF, datalen)
-        msgdata += self._buffer[rg:rg+datalen]
-        self._pebble._send_message("PUTBYTES", msgdata)
+        chunk = self._buffer[rg:rg+datalen]
+        self._pebble._send_message("PUTBYTES", [self.put_header.pack(2, self._token & 0xFFFFFFFF, datalen), chunk])
+        self._in_flight.append((rg, datalen))
+        self._crc.update(chunk)
         self._left -= datalen
 
     def handle_message(self, endpoint, resp):
-        if self._state == self.states["WAIT_FOR_TOKEN"]:
-            self.wait_for_token(resp)
-        elif self._state == self.states["IN_PROGRESS"]:
-            self.in_progress(resp)
-        elif self._state == self.states["COMMIT"]:
-            self.handle_commit(resp)
-        elif self._state == self.states["COMPLETE"]:
-            self.handle_complete(resp)
+        with self._lock:
+            self._last_response = time.time()
+            if self._state == self.states["WAIT_FOR_TOKEN"]:
+                self.wait_for_token(resp)
+            elif self._state == self.states["IN_PROGRESS"]:
+                self.in_progress(resp)
+            elif self._state == self.states["COMMIT"]:
+                self.handle_commit(resp)
+            elif self._state == self.states["COMPLETE"]:
+                self.handle_complete(resp)
 
 # Attributes and Actions are currently defined outside of Notifications
 # and TimelineItems because they're common to both
@@ -2367,8 +3362,7 @@ class Attribute(object):
         self.content = content
 
     def pack(self):
-        fmt = "<BH" + str(len(self.content)) + "s"
-        return pack(fmt, self.attribute_table[self.id], len(self.content), self.content)
+        return codec.timeline_attribute.pack(self.attribute_table[self.id], len(self.content)) + self.content
 
 class Action(object):
 
@@ -2414,12 +3408,9 @@ class Action(object):
             self.attributes = []
 
     def pack(self):
-        fmt = "<BBB"
         attributes = [Attribute("TITLE", self.title)]
-        data = pack(fmt, self.id, self.action_table[self.type], len(attributes))
-        for attribute in attributes:
-            data += attribute.pack()
-        return data
+        return codec.timeline_action.pack(self.id, self.action_table[self.type], len(attributes)) + \
+            "".join(attribute.pack() for attribute in attributes)
 
 class TimelineItem(object):
 
@@ -2461,9 +3452,8 @@ class TimelineItem(object):
         self.read = read
         self.layout = layout
 
-    def send(self):
+    def pack(self):
         attributes = [Attribute("TITLE", self.title)] + self.attributes
-        header_fmt = "<16s16sIHBHBHBB"
         flags = (
             1 << 0 * self.is_floating +
             1 << 1 * self.visible +
@@ -2475,7 +3465,7 @@ class TimelineItem(object):
         attributes_data = "".join([x.pack() for x in attributes])
         actions_data = "".join([x.pack() for x in self.actions])
 
-        header_data = pack(header_fmt,
+        header_data = codec.timeline_item.pack(
             self.id.bytes,
             self.parent.bytes,
             self.timestamp,
@@ -2487,12 +3477,12 @@ class TimelineItem(object):
             len(attributes),
             len(self.actions))
 
-        data = header_data + attributes_data + actions_data
+        return header_data + attributes_data + actions_data
 
+    def send(self):
         blobdb = BlobDB(self.type)
-        blobdb_data = blobdb.insert(self.id.bytes, data)
-        self.pebble._send_message("BLOB_DB", blobdb_data)
-        return EndpointSync(self.pebble, "BLOB_DB").get_data()
+        blobdb_data = blobdb.insert(self.id.bytes, self.pack())
+        return self.pebble._request("BLOB_DB", blobdb_data)
 
 class Notification(TimelineItem):
     """A custom notification to send to the watch.
@@ -2532,9 +3522,8 @@ class Notification(TimelineItem):
        def send(self, silent=False, utc=True, layout=0x01):
 
            attributes = [Attribute("TITLE", self.title)] + self.attributes
-           header_fmt = "<BBIIIIBBB" # header
            flags = (2 * utc) + silent
-           header_data = pack(header_fmt,
+           header_data = codec.notification.pack(
                0x00,
                0x01, # add notif
                flags, # flags
@@ -2582,12 +3571,9 @@ class AppMetadata(object):
         self.app_face_template_id = app_face_template_id
         self.app_name = app_name
 
-    def send(self):
-        uuid_bytes = util.convert_to_bytes(self.in_uuid)
-
-        data = struct.pack(
-            "<16sIIBBBBBB96s",
-            uuid_bytes,
+    def pack(self):
+        return codec.app_metadata.pack(
+            util.convert_to_bytes(self.in_uuid),
             self.flags,
             self.icon_resource_id,
             self.app_version_major,
@@ -2599,7 +3585,9 @@ class AppMetadata(object):
             self.app_name
         )
 
-        return self.pebble._raw_blob_db_insert("APP", uuid_bytes, data)
+    def send(self):
+        uuid_bytes = util.convert_to_bytes(self.in_uuid)
+        return self.pebble._raw_blob_db_insert("APP", uuid_bytes, self.pack())
 
 class Reminder(TimelineItem):
 
@@ -2621,30 +3609,143 @@ class BlobDB(object):
             "NOTIFICATION": 4
     }
 
+    # Tokens from here up are kept for BlobDBBatch, so a batch's operations
+    # never share a token with one sent on its own
+    BATCH_TOKENS = 0x8000
+
     def __init__(self, db="TEST"):
         self.db_id = self.dbs[db];
 
     def get_token(self):
-        return random.randrange(1, pow(2,16) - 1, 1)
+        return random.randrange(1, self.BATCH_TOKENS, 1)
 
-    def insert(self, key, value):
-        token = self.get_token()
-        data = pack("<BHBB", 0x01, token, self.db_id, len(key)) + str(key) \
-                    + pack("<H", len(value)) + str(value)
+    def insert(self, key, value, token=None):
+        token = token or self.get_token()
+        data = codec.blob_db_key.pack(0x01, token, self.db_id, len(key)) + str(key) \
+                    + codec.blob_db_value_length.pack(len(value)) + str(value)
         return data
 
-    def delete(self, key):
-        token = self.get_token()
-        data = pack("<BHBB", 0x04, token, self.db_id, len(key)) + str(key)
+    def delete(self, key, token=None):
+        token = token or self.get_token()
+        data = codec.blob_db_key.pack(0x04, token, self.db_id, len(key)) + str(key)
         return data
 
-    def clear(self):
-        token = self.get_token()
-        data = pack("<BHB", 0x05, token, self.db_id)
+    def clear(self, token=None):
+        token = token or self.get_token()
+        data = codec.blob_db_clear.pack(0x05, token, self.db_id)
         return data
 
-    def interpret_response(self, code):
-        if (code == 1):
-            return "SUCCESS"
-        else:
-            return "ERROR: %d" % (code)
+    response = codec.blob_db_response
+
+    # Every response code's string, so handling a response allocates nothing
+    responses = dict((code, "ERROR: %d" % code) for code in xrange(256))
+    responses[1] = "SUCCESS"
+
+    @classmethod
+    def interpret_response(cls, code):
+        return cls.responses[code]
+
+class BlobDBBatch(object):
+
+    """
+    Streams BlobDB operations to the watch without waiting for each response.
+
+    Up to `window` operations are outstanding at once, each with its own token;
+    queueing another blocks until a slot frees up. finish() waits for the rest
+    and returns a list with an (operation, key, response) tuple for each
+    operation in the order they were queued, where operation is "insert",
+    "delete" or "clear" (whose key is None) and response is "SUCCESS",
+    "ERROR: <code>" or "ERROR: timed out".
+
+        batch = pebble.blob_db_batch("PIN")
+        for item in items:
+            batch.insert(item.id.bytes, item.pack())
+        results = batch.finish()
+    """
+
+    # Seconds without any response before the outstanding operations are given up on
+    timeout = 10
+
+    class _Pending(object):
+        def __init__(self, batch, index, correlation_key):
+            self.batch = batch
+            self.index = index
+            self.correlation_key = correlation_key
+
+        def set_result(self, data):
+            self.batch._complete(self, data)
+
+        def set_exception(self, error):
+            self.batch._complete(self, "ERROR: %s" % error)
+
+    def __init__(self, pebble, db, window=16):
+        self.pebble = pebble
+        self.blobdb = BlobDB(db)
+        self.window = max(1, window)
+        # (operation, key, response) for each operation queued, in order
+        self.results = []
+        # correlator key -> _Pending
+        self._outstanding = {}
+        self._cond = threading.Condition()
+        self._last_response = time.time()
+        self._token = random.randrange(BlobDB.BATCH_TOKENS, 0x10000)
+
+    def _next_token(self):
+        # Consecutive tokens from the range kept for batches, skipping any
+        # that another batch is still waiting on
+        endpoint = self.pebble.endpoints["BLOB_DB"]
+        while True:
+            self._token = BlobDB.BATCH_TOKENS + (self._token + 1) % (0x10000 - BlobDB.BATCH_TOKENS)
+            if not self.pebble._responses.waiting((endpoint, self._token)):
+                return self._token
+
+    def insert(self, key, value):
+        self._send("insert", key, self.blobdb.insert, key, value)
+
+    def delete(self, key):
+        self._send("delete", key, self.blobdb.delete, key)
+
+    def clear(self):
+        self._send("clear", None, self.blobdb.clear)
+
+    def finish(self):
+        """Wait for every outstanding operation. Returns the results in the order they were queued."""
+        with self._cond:
+            self._wait_for(0)
+        return self.results
+
+    def _send(self, operation, key, build, *args):
+        with self._cond:
+            self._wait_for(self.window - 1)
+            if not self._outstanding:
+                self._last_response = time.time()
+            token = self._next_token()
+            pending = self._Pending(self, len(self.results), (self.pebble.endpoints["BLOB_DB"], token))
+            self._outstanding[pending.correlation_key] = pending
+            self.results.append((operation, key, None))
+            self.pebble._responses.add(pending.correlation_key, pending)
+        self.pebble._send_message("BLOB_DB", build(*args, token=token))
+
+    def _record(self, pending, response):
+        operation, key, _ = self.results[pending.index]
+        self.results[pending.index] = (operation, key, response)
+
+    def _wait_for(self, limit):
+        # Called with _cond held
+        while len(self._outstanding) > limit:
+            remaining = self._last_response + self.timeout - time.time()
+            if remaining <= 0:
+                for pending in self._outstanding.values():
+                    self.pebble._responses.discard(pending.correlation_key, pending)
+                    self._record(pending, "ERROR: timed out")
+                self._outstanding.clear()
+                break
+            self._cond.wait(remaining)
+
+    def _complete(self, pending, result):
+        with self._cond:
+            if self._outstanding.get(pending.correlation_key) is pending:
+                del self._outstanding[pending.correlation_key]
+                self._record(pending, result)
+            self._last_response = time.time()
+            self._cond.notify()
@@ -1,8 +1,13 @@
 from subprocess import call
 import argparse
 import array
+import fnmatch
+import multiprocessing
+import os
 import struct
 import binascii
+import sys
+import zlib
 
 MAX_FRAME_LEN = 255
 MAX_FRAME_COUNT = 255
@@ -10,94 +15,238 @@ MAX_FRAME_COUNT = 255
 bitswap = b''.join(chr(sum(((val >> i) & 1) << (7 - i) for i in range(8))) for val in range(256))
 to_uint_be = lambda data: struct.pack('>I', data)
 
-def create_ogg_packet(bos, eos, granule, serial_no, packet_no, segments):
+def reverse_bits(value):
+    """ reverses the order of the 32 bits of value """
+    return struct.unpack('<I', to_uint_be(value).translate(bitswap))[0]
+
+def ogg_crc(data, crc=0):
+    """
+    The Ogg page checksum of data (a str or bytearray), continuing from crc.
+
+    Ogg uses CRC-32 with polynomial 0x04C11DB7, not reflected and with no final
+    xor. zlib's crc32 is the reflected form of the same polynomial, so feeding
+    it the data with each byte's bits reversed gives the Ogg CRC bit-reversed,
+    and its lookup tables run in C rather than Python.
+    """
+    # buffer() because zlib won't take a bytearray directly
+    crc = zlib.crc32(buffer(data.translate(bitswap)), ~reverse_bits(crc) & 0xffffffff)
+    return reverse_bits(~crc & 0xffffffff)
+
+# All Ogg and Speex header fields are little-endian
+ogg_page_header = struct.Struct('<4sBBqIIIB')   # capture pattern .. number of segments
+speex_header = struct.Struct('<8s20s2iI4iI5i')
+uint32 = struct.Struct('<I')
+
+OGG_CRC_OFFSET = 22
+
+def pack_ogg_page(buf, bos, eos, granule, serial_no, packet_no, segments):
+    """ assembles an Ogg page in the bytearray buf, which is resized to fit, and returns it """
     header_type = (1 << 1) if bos else 0    # b_o_s
     header_type |= (1 << 2) if eos else 0   # e_o_s
 
-    ogg = 'OggS'                            # 4
-    ogg += struct.pack('B', 0)              # 1, version - must be 0
-    ogg += struct.pack('B', header_type)    # 1, Header type
-    ogg += struct.pack('q', granule)        # 8, granule position
-    ogg += struct.pack('I', serial_no)      # 4, bitstream serial no
-    ogg += struct.pack('I', packet_no)      # 4, packet number
-    ogg += struct.pack('i', 0)              # 4, crc - evaluated later
-    ogg += struct.pack('B', len(segments))  # 1, Number of segments
-    for s in segments:                      # add length of each segment
-        ogg += struct.pack('B', len(s))     # 1, length of segment
-    ogg += ''.join(segments)
-
-    # crc = binascii.crc32(ogg) & 0xffffffff  # calulate crc over whole packet
+    header_size = ogg_page_header.size + len(segments)
+    if len(buf) < header_size:
+        buf.extend('\0' * (header_size - len(buf)))
+    buf[header_size:] = ''.join(segments)
+    # the crc is evaluated below, over the page with this field zeroed
+    ogg_page_header.pack_into(buf, 0, 'OggS', 0, header_type, granule, serial_no, packet_no, 0, len(segments))
+    buf[ogg_page_header.size:header_size] = bytearray(map(len, segments))   # length of each segment
 
-    import zlib
-    crc = (~zlib.crc32(ogg.translate(bitswap), -1)) & 0xffffffff
-    crc = to_uint_be(crc).translate(bitswap)
+    uint32.pack_into(buf, OGG_CRC_OFFSET, ogg_crc(buf))
+    return buf
 
-    return ogg[:22] + crc + ogg[26:]
+def create_ogg_packet(bos, eos, granule, serial_no, packet_no, segments):
+    return str(pack_ogg_page(bytearray(), bos, eos, granule, serial_no, packet_no, segments))
 
 def create_speex_header(version, rate, frame_sz):
     bitstream_version  = 4
     mode = 1 if rate == 16000 else 0
     bitrate = 12800 if rate == 16000 else 8000
 
-    version = version[:20]
-    version = version.ljust(20, '\0')
-
-    spx = "Speex   "
-    spx += version
-    spx += struct.pack('i', 1)    # version - must be 1
-    spx += struct.pack('i', 80)   # header size
-    spx += struct.pack('I', rate) # sample rate
-    spx += struct.pack('i', mode) # mode
-    spx += struct.pack('i', bitstream_version)    # mode bitstream version
-    spx += struct.pack('i', 1)    # number of channels
-    spx += struct.pack('i', bitrate)    # bit-rate
-    spx += struct.pack('I', frame_sz)   # frame size (number of PCM16 samples)
-    spx += struct.pack('i', 0)    # variable bit rate (off)
-    spx += struct.pack('i', 1)    # frames per packet 
-    spx += struct.pack('i', 0)    # extra headers
-    spx += struct.pack('i', 0)    # reserved
-    spx += struct.pack('i', 0)    # reserved
-
-    return spx
+    return speex_header.pack(
+        "Speex   ",
+        version,            # truncated or NUL padded to 20 bytes
+        1,                  # version - must be 1
+        80,                 # header size
+        rate,               # sample rate
+        mode,               # mode
+        bitstream_version,  # mode bitstream version
+        1,                  # number of channels
+        bitrate,            # bit-rate
+        frame_sz,           # frame size (number of PCM16 samples)
+        0,                  # variable bit rate (off)
+        1,                  # frames per packet
+        0,                  # extra headers
+        0,                  # reserved
+        0)                  # reserved
 
 def create_vorbis_comment(vendor, user_comments):
-    comment =  struct.pack('I', len(vendor))        # 4, vendor length
-    comment += vendor                               # n, vendor string
-    comment += struct.pack('I', len(user_comments)) # n, user comment list length
+    comment = [uint32.pack(len(vendor)), vendor,        # vendor length, vendor string
+               uint32.pack(len(user_comments))]         # user comment list length
     for u in user_comments:
-        comment += struct.pack('I', len(u))
-        comment += u
+        comment += (uint32.pack(len(u)), u)
 
-    return comment
+    return ''.join(comment)
 
 
-def store_data(frames, filename, rate):
-    frame_sz = (rate / 1000) * 20
+class OggSpeexWriter(object):
+    """
+    Writes Speex frames to an Ogg file as they arrive.
+
+    Frames are gathered into pages of up to MAX_FRAME_COUNT frames. A full
+    page is written (and flushed) as soon as the next frame shows that it
+    isn't the last one, so at most one page is held in memory and everything
+    before it is already on disk.
+    """
+
     version = "1.2rc1"
     serial_no = 0x42E296FC
 
-    spx = create_speex_header(version, rate, frame_sz)
-    ogg = create_ogg_packet(True, False, 0, serial_no, 0, [spx])
-    comment = create_vorbis_comment('Encoded with Speex ' + version, [])
-    ogg += create_ogg_packet(False, False, 0, serial_no, 1, [comment])
-
-    packet_no = 2
-    tot_granules = 0
-    while (len(frames) > 0):
-        packet_frames = min(len(frames), MAX_FRAME_COUNT)
-        last_packet = (len(frames) == packet_frames)
-
-        tot_granules += packet_frames * frame_sz
-        granule_pos = tot_granules - frame_sz
-        
-        ogg += create_ogg_packet(False, last_packet, granule_pos, serial_no, packet_no, frames[:packet_frames])
-        
-        frames = frames[packet_frames:]
-        packet_no += 1
+    def __init__(self, filename, rate):
+        self.filename = filename
+        self.frame_sz = (rate / 1000) * 20
+        self._file = open(filename, 'wb')
+        self._page = bytearray()
+        self._frames = []
+        self._packet_no = 2
+        self._tot_granules = 0
+
+        spx = create_speex_header(self.version, rate, self.frame_sz)
+        comment = create_vorbis_comment('Encoded with Speex ' + self.version, [])
+        self._file.write(create_ogg_packet(True, False, 0, self.serial_no, 0, [spx]))
+        self._file.write(create_ogg_packet(False, False, 0, self.serial_no, 1, [comment]))
+        self._file.flush()
+
+    def write_frame(self, frame):
+        if len(self._frames) == MAX_FRAME_COUNT:
+            self._write_page(False)
+        self._frames.append(frame)
+
+    def close(self):
+        if self._frames:
+            self._write_page(True)
+        self._file.close()
+
+    def _write_page(self, last_packet):
+        self._tot_granules += len(self._frames) * self.frame_sz
+        granule_pos = self._tot_granules - self.frame_sz
+
+        self._file.write(pack_ogg_page(self._page, False, last_packet, granule_pos, self.serial_no,
+                                       self._packet_no, self._frames))
+        self._file.flush()
+        self._frames = []
+        self._packet_no += 1
+
+
+def store_data(frames, filename, rate):
+    writer = OggSpeexWriter(filename, rate)
+    for frame in frames:
+        writer.write_frame(frame)
+    writer.close()
+
+    return filename
+
+
+# Raw frame captures, as converted by `python -m pebblecomm.speex`: the sample
+# rate as a little-endian uint32, then each Speex frame prefixed with its
+# length in one byte, as in AUDIO data packets.
 
+def store_frame_dump(frames, filename, rate):
     with open(filename, 'wb') as f:
-        f.write(ogg)
-        f.close()
+        f.write(uint32.pack(rate))
+        for frame in frames:
+            f.write(chr(len(frame)))
+            f.write(frame)
 
     return filename
 
+def read_frame_dump(filename):
+    """ returns the sample rate of a raw frame capture and a generator of its frames """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < uint32.size:
+        raise ValueError("%s is too short to be a frame capture" % filename)
+    rate, = uint32.unpack_from(data)
+
+    def frames():
+        index = uint32.size
+        while index < len(data):
+            end = index + 1 + ord(data[index])
+            if end > len(data):
+                raise ValueError("%s: frame at offset %d is truncated" % (filename, index))
+            yield data[index + 1:end]
+            index = end
+
+    return rate, frames()
+
+def convert_frame_dump(filename, output):
+    rate, frames = read_frame_dump(filename)
+    # Written under another name until complete, so a capture that fails
+    # part way doesn't leave an .spx that later runs take as converted
+    partial = output + '.tmp'
+    writer = OggSpeexWriter(partial, rate)
+    try:
+        try:
+            for frame in frames:
+                writer.write_frame(frame)
+        finally:
+            writer.close()
+    except Exception:
+        os.remove(partial)
+        raise
+    if os.name == 'nt' and os.path.exists(output):
+        # rename() won't replace a file on Windows
+        os.remove(output)
+    os.rename(partial, output)
+
+    return output
+
+def _convert_job(job):
+    # Runs in a pool worker, so failures are returned rather than raised
+    filename, output = job
+    try:
+        convert_frame_dump(filename, output)
+        return filename, output, None
+    except Exception as e:
+        return filename, output, str(e)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pebblecomm.speex',
+            description='Convert a directory of raw Speex frame captures to Ogg Speex (.spx) files.')
+    parser.add_argument('directory', help='Directory of frame captures')
+    parser.add_argument('--pattern', default='*.frames', help='Captures to convert (default: %(default)s)')
+    parser.add_argument('--output-dir', default=None, help='Where to write the .spx files (default: next to '
+            'each capture)')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='Captures to convert '
+            'at once (default: one per CPU, %(default)s)')
+    parser.add_argument('--force', action='store_true', help='Convert captures that already have a .spx file')
+    args = parser.parse_args(argv)
+
+    output_dir = args.output_dir or args.directory
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    jobs = []
+    for name in sorted(fnmatch.filter(os.listdir(args.directory), args.pattern)):
+        output = os.path.join(output_dir, os.path.splitext(name)[0] + '.spx')
+        if args.force or not os.path.exists(output):
+            jobs.append((os.path.join(args.directory, name), output))
+
+    failures = 0
+    pool = multiprocessing.Pool(max(1, args.jobs))
+    try:
+        for filename, output, error in pool.imap_unordered(_convert_job, jobs):
+            if error is None:
+                print "%s -> %s" % (filename, output)
+            else:
+                failures += 1
+                print >> sys.stderr, "Failed to convert %s: %s" % (filename, error)
+    finally:
+        pool.close()
+        pool.join()
+
+    print "Converted %d of %d captures" % (len(jobs) - failures, len(jobs))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,37 +1,116 @@
-import array
-import sys
+import struct
 
 CRC_POLY = 0x04C11DB7
 
-def process_word(data, crc=0xffffffff):
-    if (len(data) < 4):
-        d_array = array.array('B', data)
-        for x in range(0, 4 - len(data)):
-            d_array.insert(0,0)
-        d_array.reverse()
-        data = d_array.tostring()
+# The STM32 CRC unit consumes little-endian 32 bit words MSB first. Rather than
+# shifting each word through the polynomial bit by bit we use slice-by-8
+# tables: _TABLES[n][b] is the CRC contribution of byte b followed by n zero
+# bytes, so two words can be folded in with eight lookups.
+def _make_tables(count=8):
+    table = []
+    for byte in xrange(256):
+        crc = byte << 24
+        for _ in xrange(8):
+            if crc & 0x80000000:
+                crc = ((crc << 1) ^ CRC_POLY) & 0xffffffff
+            else:
+                crc = (crc << 1) & 0xffffffff
+        table.append(crc)
 
-    d = array.array('I', data)[0]
-    crc = crc ^ d
+    tables = [table]
+    for n in xrange(1, count):
+        prev = tables[n - 1]
+        tables.append([((prev[b] << 8) & 0xffffffff) ^ table[prev[b] >> 24] for b in xrange(256)])
+    return tuple(tuple(t) for t in tables)
 
-    for i in xrange(0, 32):
-        if (crc & 0x80000000) != 0:
-            crc = (crc << 1) ^ CRC_POLY
-        else:
-            crc = (crc << 1)
+_TABLES = _make_tables()
 
-    result = crc & 0xffffffff
-    return result
+# Words are unpacked in blocks of this many to keep the temporary tuples small
+_BLOCK_WORDS = 4096
+
+
+def _process_words(words, crc):
+    t0, t1, t2, t3, t4, t5, t6, t7 = _TABLES
+    count = len(words)
+    for i in xrange(0, count - 1, 2):
+        x = crc ^ words[i]
+        y = words[i + 1]
+        crc = (t7[x >> 24] ^ t6[(x >> 16) & 0xff] ^ t5[(x >> 8) & 0xff] ^ t4[x & 0xff] ^
+               t3[y >> 24] ^ t2[(y >> 16) & 0xff] ^ t1[(y >> 8) & 0xff] ^ t0[y & 0xff])
+    if count & 1:
+        x = crc ^ words[-1]
+        crc = t3[x >> 24] ^ t2[(x >> 16) & 0xff] ^ t1[(x >> 8) & 0xff] ^ t0[x & 0xff]
+    return crc
+
+
+def _process_aligned(data, offset, length, crc):
+    """ Folds length bytes (a multiple of 4) of data starting at offset into crc """
+    end = offset + length
+    while offset < end:
+        words = min(_BLOCK_WORDS, (end - offset) / 4)
+        crc = _process_words(struct.unpack_from('<%dI' % words, data, offset), crc)
+        offset += words * 4
+    return crc
+
+
+def _tail_word(data):
+    # A trailing partial word is zero-padded on the left and read big-endian,
+    # which is what the firmware does with the last 1-3 bytes of a buffer.
+    word = 0
+    for byte in bytearray(data):
+        word = (word << 8) | byte
+    return word
 
-def process_buffer(buf, c = 0xffffffff):
-    word_count = len(buf) / 4
-    if (len(buf) % 4 != 0):
-        word_count += 1
 
-    crc = c
-    for i in xrange(0, word_count):
-        crc = process_word(buf[i * 4 : (i + 1) * 4], crc)
+def process_word(data, crc=0xffffffff):
+    if len(data) < 4:
+        word = _tail_word(data)
+    else:
+        word, = struct.unpack_from('<I', data)
+    return _process_words((word,), crc)
+
+def process_buffer(buf, c = 0xffffffff):
+    aligned = len(buf) - len(buf) % 4
+    crc = _process_aligned(buf, 0, aligned, c)
+    if aligned != len(buf):
+        crc = process_word(buf[aligned:], crc)
     return crc
 
 def crc32(data):
     return process_buffer(data)
+
+
+class STM32Crc(object):
+    """
+    Incremental STM32 CRC.
+
+    Data may be fed to update() in chunks of any size; the result is the same
+    as calling crc32() on the concatenation of all the chunks.
+    """
+
+    def __init__(self, data=None):
+        self._crc = 0xffffffff
+        self._pending = bytearray()
+        self.length = 0
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        self.length += len(data)
+        offset = 0
+        if self._pending:
+            offset = min(4 - len(self._pending), len(data))
+            self._pending += data[0:offset]
+            if len(self._pending) < 4:
+                return
+            self._crc = process_word(self._pending, self._crc)
+            self._pending = bytearray()
+
+        aligned = (len(data) - offset) & ~3
+        self._crc = _process_aligned(data, offset, aligned, self._crc)
+        self._pending = bytearray(data[offset + aligned:])
+
+    def crc32(self):
+        if self._pending:
+            return process_word(self._pending, self._crc)
+        return self._crc
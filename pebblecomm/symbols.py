@@ -0,0 +1,102 @@
+import hashlib
+import logging as log
+import os
+import subprocess
+import threading
+
+# Looks up the source lines of crash addresses in app ELF files. Starting
+# arm-none-eabi-addr2line for every register of every crash stalls whoever
+# asks (the reader thread, for `pebble logs`) when an app crash-loops, so one
+# addr2line process per ELF answers all lookups, and answers are memoized.
+
+ADDR2LINE = 'arm-none-eabi-addr2line'
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ElfSymbols(object):
+    """
+    Source line lookups for one build of an ELF file.
+
+    addr2line reads addresses from stdin when none are given on its command
+    line, and flushes one line of output per address, so it stays running and
+    is fed an address at a time.
+    """
+
+    def __init__(self, path, mtime, digest, addr2line=ADDR2LINE):
+        self.path = path
+        self.mtime = mtime
+        self.digest = digest
+        self.addr2line = addr2line
+        self._process = None
+        self._lines = {}
+
+    def lookup(self, address):
+        """ The 'file:line' for address (a hex string), or '??:0' as addr2line prints it """
+        address = address.lower()
+        if address not in self._lines:
+            self._lines[address] = self._addr2line(address)
+        return self._lines[address]
+
+    def _addr2line(self, address):
+        if self._process is None:
+            self._process = subprocess.Popen([self.addr2line, '-e', self.path], stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE)
+        self._process.stdin.write(address + '\n')
+        self._process.stdin.flush()
+        line = self._process.stdout.readline()
+        if not line:
+            self.close()
+            raise IOError("%s exited while looking up %s" % (self.addr2line, address))
+        return line.strip()
+
+    def close(self):
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process = None
+
+
+class Symbolicator(object):
+    """
+    Keeps an ElfSymbols for each ELF file looked up in.
+
+    An ELF is read again only when its mtime changes, and its lookups are
+    thrown away only if its contents changed too, so rebuilding without
+    changes keeps them.
+    """
+
+    def __init__(self, addr2line=ADDR2LINE):
+        self.addr2line = addr2line
+        self._elves = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, elf_path, address):
+        with self._lock:
+            return self._elf(elf_path).lookup(address)
+
+    def _elf(self, path):
+        mtime = os.path.getmtime(path)
+        elf = self._elves.get(path)
+        if elf is None or elf.mtime != mtime:
+            digest = file_digest(path)
+            if elf is not None and elf.digest == digest:
+                elf.mtime = mtime
+            else:
+                if elf is not None:
+                    log.debug("%s has changed, reloading its symbols" % path)
+                    elf.close()
+                elf = self._elves[path] = ElfSymbols(path, mtime, digest, self.addr2line)
+        return elf
+
+    def close(self):
+        with self._lock:
+            for elf in self._elves.values():
+                elf.close()
+            self._elves.clear()
@@ -0,0 +1,34 @@
+"""
+Stand-ins for a watch connection, shared by the unit tests.
+"""
+
+import struct
+
+
+def frame(endpoint, payload):
+    """ payload as a Pebble Protocol message on endpoint """
+    return struct.pack("!HH", len(payload), endpoint) + payload
+
+
+def deliver(pebble, endpoint, *payloads):
+    """ Have pebble receive payloads on endpoint, as if read off its transport """
+    for payload in payloads:
+        pebble.pebble_protocol_reassembler.feed(frame(endpoint, payload))
+    pebble._parse_received_pebble_protocol_data()
+
+
+class FakeTransport(object):
+    """
+    Stands in for a Pebble's transport, keeping what is written to it.
+    Subclasses answer from write(), through deliver().
+    """
+
+    def __init__(self, pebble):
+        self.pebble = pebble
+        self.sent = []
+
+    def write(self, data):
+        self.sent.append(data)
+
+    def deliver(self, endpoint, *payloads):
+        deliver(self.pebble, endpoint, *payloads)
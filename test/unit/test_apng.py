@@ -0,0 +1,52 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+import png
+
+# Allow us to run even if not at the root libpebble directory.
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir,
+                                        os.pardir))
+sys.path.insert(0, root_dir)
+
+from pebblecomm.apng import AnimatedPngWriter
+
+
+class TestAnimatedPngWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'frames.png')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_frames(self):
+        frames = [png.from_array([[shade] * 4] * 3, mode='L') for shade in (0, 128, 255)]
+        writer = AnimatedPngWriter(self.path, last_frame_delay=2)
+        for timestamp, frame in zip((10.0, 10.5, 10.75), frames):
+            writer.add_frame(timestamp, frame)
+        writer.close()
+
+        chunks = list(png.Reader(filename=self.path).chunks())
+        types = [chunk_type for chunk_type, _ in chunks]
+        self.assertEqual(types[:2], ['IHDR', 'acTL'])
+        self.assertEqual(types[-1], 'IEND')
+        self.assertEqual([struct.unpack("!II", data) for chunk_type, data in chunks if chunk_type == 'acTL'],
+                         [(3, 0)])
+        self.assertEqual([AnimatedPngWriter.fcTL.unpack(data)[5] for chunk_type, data in chunks
+                          if chunk_type == 'fcTL'], [500, 250, 2000])
+        sequence = [struct.unpack_from("!I", data)[0] for chunk_type, data in chunks
+                    if chunk_type in ('fcTL', 'fdAT')]
+        self.assertEqual(sequence, range(len(sequence)))
+
+        # Viewers that don't know APNG see the first frame
+        width, height, pixels, _ = png.Reader(filename=self.path).read()
+        self.assertEqual([list(row) for row in pixels], [[0] * 4] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import unittest
+import uuid
+import zipfile
+
+
+# Allow us to run even if not at the root libpebble directory.
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir,
+                                        os.pardir))
+sys.path.insert(0, root_dir)
+
+from fakes import FakeTransport, frame
+from pebblecomm.AsyncPebble import AsyncPebble, PebbleEventLoop, PebbleFuture, Return
+from pebblecomm.QemuPebble import QemuPebble
+from pebblecomm.WebSocketPebble import WS_CMD_BUNDLE_INSTALL, WS_CMD_PHONE_TO_WATCH
+from pebblecomm.pebble import PebbleBundle, PebbleError, PebbleHardware, PutBytesClient
+
+APP_UUID = uuid.UUID('7a1f3e5c-0b2d-4c6e-8f90-123456789abc')
+APP_HEADER_SIZE = struct.calcsize(''.join(PebbleBundle.STRUCT_DEFINITION))
+
+
+def make_pbw(path, binary):
+    header = struct.pack(''.join(PebbleBundle.STRUCT_DEFINITION), "PBLAPP\0\0", 8, 1, 5, 2, 1, 0,
+                         len(binary), 0, 0, "App", "Co", 0, 0, 0, 0, APP_UUID.bytes)
+    with zipfile.ZipFile(path, 'w') as pbw:
+        pbw.writestr('manifest.json', json.dumps({'application': {'name': 'pebble-app.bin'}}))
+        pbw.writestr('pebble-app.bin', header + binary)
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = PebbleEventLoop()
+
+    def test_callbacks_and_timers(self):
+        """ call_soon runs in order, timers when due, and cancelled timers never """
+        calls = []
+        self.loop.call_later(0.02, calls.append, 'late')
+        cancelled = self.loop.call_later(0.01, calls.append, 'cancelled')
+        self.loop.call_later(0.01, calls.append, 'timer')
+        self.loop.call_soon(calls.append, 'first')
+        self.loop.call_soon(calls.append, 'second')
+        self.loop.cancel_timer(cancelled)
+        self.loop.run_until_complete(self.loop.sleep(0.03))
+        self.assertEqual(calls, ['first', 'second', 'timer', 'late'])
+
+    def test_future(self):
+        future = PebbleFuture(self.loop)
+        self.assertRaises(PebbleError, future.result)
+        results = []
+        future.add_done_callback(lambda f: results.append(f.result()))
+        future.set_result(1)
+        future.set_result(2)
+        self.assertEqual(results, [])  # callbacks run on the loop, not from set_result()
+        self.loop.run_once()
+        self.assertEqual((future.result(), results), (1, [1]))
+        # Callbacks added once it's done still run on the loop
+        future.add_done_callback(lambda f: results.append('late'))
+        self.loop.run_once()
+        self.assertEqual(results, [1, 'late'])
+
+    def test_spawn(self):
+        """ Coroutines get the results of the futures they yield, and their errors raised """
+        def double(value):
+            yield self.loop.sleep(0)
+            raise Return(value * 2)
+
+        def failing():
+            yield self.loop.sleep(0)
+            raise ValueError("failed")
+
+        def caller():
+            first = yield self.loop.spawn(double(1))
+            try:
+                yield self.loop.spawn(failing())
+            except ValueError as e:
+                caught = str(e)
+            raise Return((first, caught))
+
+        self.assertEqual(self.loop.run_until_complete(self.loop.spawn(caller())), (2, "failed"))
+        self.assertRaises(ValueError, self.loop.run_until_complete, self.loop.spawn(failing()))
+
+    def test_gather(self):
+        futures = [PebbleFuture(self.loop) for _ in xrange(3)]
+        for i in (2, 0, 1):
+            self.loop.call_soon(futures[i].set_result, i)
+        self.assertEqual(self.loop.run_until_complete(self.loop.gather(futures)), [0, 1, 2])
+        self.assertEqual(self.loop.run_until_complete(self.loop.gather([])), [])
+
+        futures = [PebbleFuture(self.loop) for _ in xrange(2)]
+        futures[1].set_exception(PebbleError(None, "failed"))
+        self.assertRaises(PebbleError, self.loop.run_until_complete, self.loop.gather(futures))
+
+    def test_reader(self):
+        """ Readers are called when their file descriptor is readable """
+        a, b = socket.socketpair()
+        received = PebbleFuture(self.loop)
+        self.loop.add_reader(a.fileno(), lambda: received.set_result(a.recv(10)))
+        self.loop.call_later(0.01, b.send, "hello")
+        self.assertEqual(self.loop.run_until_complete(received), "hello")
+        self.loop.remove_reader(a.fileno())
+        a.close()
+        b.close()
+
+
+class SocketTransport(object):
+    """
+    Stands in for a QEMU connection: what the watch sends arrives on one end
+    of a socket pair, and what is written to it is kept.
+    """
+
+    def __init__(self):
+        self.watch, self.sock = socket.socketpair()
+        self.sock.setblocking(False)
+        self._fileno = self.sock.fileno()
+        self.sent = []
+
+    def fileno(self):
+        return self._fileno
+
+    def read(self):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error:
+            return None, None, None, None
+        return 'watch', 'Pebble Protocol', data, data
+
+    def write(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        self.sock.close()
+        self.watch.close()
+
+
+class TestAsyncPebble(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = PebbleEventLoop()
+        self.pebble = AsyncPebble(self.loop)
+        self.pebble._ser = self.transport = SocketTransport()
+        self.pebble._connection_type = 'qemu'
+        self.pebble.init_reader()
+
+    def tearDown(self):
+        self.pebble.disconnect()
+
+    def test_requests(self):
+        """ Responses read off the socket resolve the request they answer, in any order """
+        pings = self.loop.gather([self.pebble.ping(1), self.pebble.ping(2)])
+        responses = frame(2001, struct.pack("!bL", 1, 2)) + frame(2001, struct.pack("!bL", 1, 1))
+        self.loop.call_later(0.01, self.transport.watch.send, responses[:7])
+        self.loop.call_later(0.02, self.transport.watch.send, responses[7:])
+        self.assertEqual(self.loop.run_until_complete(pings), [1, 2])
+        self.assertEqual(self.transport.sent, [frame(2001, struct.pack("!bL", 0, 1)),
+                                               frame(2001, struct.pack("!bL", 0, 2))])
+
+    def test_timeout(self):
+        self.pebble.timeout = 0.01
+        self.assertRaises(PebbleError, self.loop.run_until_complete, self.pebble.ping())
+
+    def test_disconnect(self):
+        """ Disconnecting fails every pending operation straight away """
+        futures = [self.pebble.ping(), self.pebble.screenshot(),
+                   self.pebble._put_bytes(PutBytesClient(self.pebble, 1, "BINARY", "data"))]
+        self.loop.run_once(0)
+        self.pebble.disconnect()
+        for future in futures:
+            with self.assertRaises(PebbleError) as raised:
+                self.loop.run_until_complete(future)
+            self.assertEqual(raised.exception._message, "Disconnected")
+
+    def test_emulator_disconnect(self):
+        """ The emulator closing its connection fails what's pending, and nothing else """
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        pebble = AsyncPebble(self.loop)
+        pebble.connect_via_qemu("127.0.0.1:%d" % port)
+        emulator, _ = server.accept()
+        server.close()
+        ping = pebble.ping()
+        self.loop.call_later(0.01, emulator.close)
+        with self.assertRaises(PebbleError) as raised:
+            self.loop.run_until_complete(ping)
+        self.assertEqual(raised.exception._message, "Disconnected")
+
+        # Not being able to connect is an error rather than an exit
+        self.assertRaises(socket.error, QemuPebble('127.0.0.1', port, connect_timeout=0.05).connect)
+
+
+class FastLoop(PebbleEventLoop):
+    """ Doesn't wait out the pauses of the install """
+
+    def sleep(self, delay):
+        return PebbleEventLoop.sleep(self, 0)
+
+
+class AppManagerWatch(FakeTransport):
+    """
+    Stands in for the transport of a 2.x watch with an app in bank 0, answering
+    APP_MANAGER and PUTBYTES requests on the next turn of the loop. Keeps what
+    is written as (endpoint, payload).
+    """
+
+    def __init__(self, loop, pebble):
+        FakeTransport.__init__(self, pebble)
+        self.loop = loop
+
+    def write(self, data):
+        endpoint, payload = struct.unpack_from("!H", data, 2)[0], data[4:]
+        FakeTransport.write(self, (endpoint, payload))
+        reply = None
+        if endpoint == 6000 and payload[0] == "\x01":
+            reply = struct.pack("!bII", 1, 8, 1) + struct.pack("!II32s32sIH", 5, 0, "Watch", "Co", 0, 3)
+        elif endpoint == 6000 and payload[0] == "\x02":
+            reply = struct.pack("!bI", 2, 2)
+        elif endpoint == 48879 and payload[0] != "\x04":
+            reply = struct.pack("!bI", 1, 0x1234)
+        if reply is not None:
+            self.loop.call_soon(self.pebble._handle_message, 'watch', 'Pebble Protocol', frame(endpoint, reply))
+
+
+class WebSocketWatch(FakeTransport):
+    """ Stands in for a websocket connection to the phone, keeping what is written as (data, ws_cmd) """
+
+    def write(self, data, ws_cmd=WS_CMD_PHONE_TO_WATCH):
+        FakeTransport.write(self, (data, ws_cmd))
+
+
+class TestInstall(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_app_manager_install(self):
+        """ 2.x watches are sent the app in the first free bank """
+        pbw = os.path.join(self.tmp, 'app.pbw')
+        binary = "\xAA" * 3000
+        make_pbw(pbw, binary)
+        loop = FastLoop()
+        pebble = AsyncPebble(loop)
+        pebble._ser = watch = AppManagerWatch(loop, pebble)
+        pebble.watch_fw_version = [2, 9]
+        pebble.watch_hardware = PebbleHardware.TINTIN_EV2
+
+        self.assertTrue(loop.run_until_complete(pebble.install_app(pbw, launch_on_install=False)))
+        putbytes = [payload for endpoint, payload in watch.sent if endpoint == 48879]
+        self.assertEqual(struct.unpack_from("!BIBB", putbytes[0]), (1, len(binary) + APP_HEADER_SIZE, 5, 1))
+        self.assertEqual("".join(payload[9:] for payload in putbytes if payload[0] == "\x02")[APP_HEADER_SIZE:], binary)
+        self.assertEqual(watch.sent[-1], (6000, struct.pack("!bI", 3, 1)))
+
+    def test_websocket_install(self):
+        """ The phone installs one bundle at a time, and its client is put back afterwards """
+        pbw = os.path.join(self.tmp, 'app.pbw')
+        make_pbw(pbw, "\xAA" * 100)
+        loop = PebbleEventLoop()
+        pebble = AsyncPebble(loop)
+        pebble._ser = watch = WebSocketWatch(pebble)
+        pebble._connection_type = 'websocket'
+        previous = pebble._ws_client = object()
+
+        first = pebble.install_app(pbw)
+        loop.run_once(0)
+        second = pebble.install_app(pbw)
+        self.assertRaises(PebbleError, loop.run_until_complete, second)
+        pebble._handle_message('ws', 'status', 0)
+        self.assertTrue(loop.run_until_complete(first))
+        self.assertIs(pebble._ws_client, previous)
+        with open(pbw, 'rb') as f:
+            self.assertEqual(watch.sent, [(f.read(), WS_CMD_BUNDLE_INSTALL)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+
+# Allow us to run even if not at the root libpebble directory.
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir,
+                                        os.pardir))
+sys.path.insert(0, root_dir)
+
+from fakes import FakeTransport
+from pebble import LibPebblesCommand
+from pebblecomm.pebble import CoreDumpDownload, Pebble, PebbleError
+
+
+class CoreDumpWatch(FakeTransport):
+    """
+    Stands in for the transport, answering each coredump request with the
+    whole of coredump in chunks. skip(request) gives the index of a chunk to
+    leave out of the reply to that request (counting from 0), or None.
+    """
+
+    def __init__(self, pebble, coredump, chunk_size=1000, skip=lambda request: None):
+        FakeTransport.__init__(self, pebble)
+        self.coredump = coredump
+        self.chunk_size = chunk_size
+        self.skip = skip
+        self.requests = 0
+
+    def write(self, msg):
+        FakeTransport.write(self, msg)
+        _, transaction_id = struct.unpack_from("!BB", msg, 4)
+        skipped = self.skip(self.requests)
+        self.requests += 1
+        replies = [struct.pack("!BBBI", 1, transaction_id, 0, len(self.coredump))]
+        for index, offset in enumerate(xrange(0, len(self.coredump), self.chunk_size)):
+            if index != skipped:
+                replies.append(struct.pack("!BBI", 2, transaction_id, offset) +
+                               self.coredump[offset:offset + self.chunk_size])
+        self.deliver(9000, *replies)
+
+
+class TestCoreDump(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "coredump.bin")
+        self.pebble = Pebble()
+        rand = random.Random(0xc0de)
+        self.coredump = "".join(chr(rand.randrange(256)) for _ in xrange(10500))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def download(self, attempts=5, **watch_args):
+        self.pebble._ser = watch = CoreDumpWatch(self.pebble, self.coredump, **watch_args)
+        download = CoreDumpDownload(self.pebble, self.path, lambda amount: None, attempts)
+        download.settle_sec = 0
+        try:
+            download.run()
+        finally:
+            self.requests = watch.requests
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def checkpoint(self):
+        with open(self.path + ".checkpoint") as f:
+            return json.load(f)
+
+    def test_coredump_sync(self):
+        """ Coredumps are received in place and handed back without a copy """
+        self.pebble._ser = CoreDumpWatch(self.pebble, self.coredump)
+        data = self.pebble.coredump(lambda amount: None)
+        self.assertIsInstance(data, bytearray)
+        self.assertEqual(data, self.coredump)
+
+    def test_command(self):
+        """ `pebble coredump` saves what it fetched byte for byte """
+        self.pebble._ser = CoreDumpWatch(self.pebble, self.coredump)
+        command = LibPebblesCommand.PblCoreDumpCommand()
+        command.pebble = self.pebble
+        args = argparse.Namespace(generate=False, resume=False)
+        run, LibPebblesCommand.LibPebbleCommand.run = LibPebblesCommand.LibPebbleCommand.run, lambda self, args: None
+        cwd = os.getcwd()
+        os.chdir(self.tmp)
+        try:
+            command.run(args)
+        finally:
+            os.chdir(cwd)
+            LibPebblesCommand.LibPebbleCommand.run = run
+        saved, = os.listdir(self.tmp)
+        with open(os.path.join(self.tmp, saved), 'rb') as f:
+            self.assertEqual(f.read(), self.coredump)
+
+    def test_retry_after_gap(self):
+        self.assertEqual(self.download(skip=lambda request: 4 if request == 0 else None), self.coredump)
+        self.assertEqual(self.requests, 2)
+        self.assertFalse(os.path.exists(self.path + ".checkpoint"))
+
+    def test_gap_below_checkpoint(self):
+        """ Later attempts can drop data that an earlier one saved """
+        skip = {0: 6, 1: 2}
+        self.assertEqual(self.download(skip=skip.get), self.coredump)
+        self.assertEqual(self.requests, 2)
+
+    def test_resume(self):
+        """ A later run carries on from the checkpoint, replacing saved data that no longer matches """
+        self.assertRaises(PebbleError, self.download, attempts=1, skip=lambda request: 6)
+        self.assertEqual(self.checkpoint(), {'total_length': len(self.coredump), 'received': 6000})
+
+        # Damage what was saved below the checkpoint
+        with open(self.path, 'r+b') as f:
+            f.seek(2500)
+            f.write("\xff" * 10)
+        self.assertEqual(self.download(), self.coredump)
+        self.assertEqual(self.requests, 1)
+        self.assertFalse(os.path.exists(self.path + ".checkpoint"))
+
+    def test_existing_file(self):
+        """ A file that wasn't being downloaded to is left alone """
+        with open(self.path, 'wb') as f:
+            f.write("earlier coredump")
+        self.assertRaises(PebbleError, self.download)
+        self.assertEqual(self.requests, 0)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), "earlier coredump")
+
+        # Nor is one that doesn't match the checkpoint beside it
+        with open(self.path + ".checkpoint", 'w') as f:
+            json.dump({'total_length': len(self.coredump), 'received': 6000}, f)
+        self.assertRaises(PebbleError, self.download)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), "earlier coredump")
+
+
+if __name__ == '__main__':
+    unittest.main()
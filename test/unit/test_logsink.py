@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import uuid
+
+
+# Allow us to run even if not at the root libpebble directory.
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir,
+                                        os.pardir))
+sys.path.insert(0, root_dir)
+
+from fakes import deliver
+from pebblecomm import logsink
+from pebblecomm.pebble import AppLogRecord, LogRecord, Pebble
+
+APP_UUID = uuid.UUID('7a1f3e5c-0b2d-4c6e-8f90-123456789abc')
+
+
+def log_message(level, filename, line, message, timestamp=1000):
+    return (struct.pack("!IBBH", timestamp, level, len(message), line) +
+            filename.ljust(LogRecord.FILENAME_LENGTH, "\0") + message)
+
+
+class TestLogSink(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pebble = Pebble()
+        self.pebble.set_print_app_logs(False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def receive(self, endpoint, payload):
+        deliver(self.pebble, endpoint, payload)
+
+    def test_filter(self):
+        log_filter = logsink.LogFilter(uuids=[str(APP_UUID)], max_level=100, filenames=["*.c"])
+        self.assertTrue(log_filter.matches(AppLogRecord(APP_UUID.bytes + log_message(50, "main.c", 1, "hi"))))
+        self.assertFalse(log_filter.matches(AppLogRecord(APP_UUID.bytes + log_message(200, "main.c", 1, "hi"))))
+        self.assertFalse(log_filter.matches(AppLogRecord(APP_UUID.bytes + log_message(50, "main.js", 1, "hi"))))
+        self.assertFalse(log_filter.matches(AppLogRecord(uuid.uuid4().bytes + log_message(50, "main.c", 1, "hi"))))
+        self.assertFalse(log_filter.matches(LogRecord(log_message(50, "main.c", 1, "hi"))))
+
+    def test_levels(self):
+        """ Levels are numbers however they are given, and anything else is refused """
+        for level, number in (("W", 50), ("w", 50), ("info", None), ("100", 100), (200, 200), ("256", None),
+                              (-1, None), ("", None)):
+            if number is None:
+                self.assertRaises(ValueError, self.pebble.set_log_level, level)
+            else:
+                self.pebble.set_log_level(level)
+                self.assertEqual(self.pebble.log_level, number)
+                self.assertEqual(logsink.LogFilter(max_level=level).max_level, number)
+
+    def test_pipeline_sinks(self):
+        """ Records reach every sink, in order, and binary logs read back the same """
+        jsonl = os.path.join(self.tmp, "logs.jsonl")
+        binary = os.path.join(self.tmp, "logs.bin")
+        pipeline = logsink.LogPipeline(self.pebble, [logsink.JsonLinesSink(jsonl), logsink.BinaryLogSink(binary)],
+                                       logsink.LogFilter(filenames=["main.c"]), maxsize=4, block=True)
+        for i in xrange(20):
+            self.receive(2006, APP_UUID.bytes + log_message(100, "main.c", i, "message %d" % i))
+        self.receive(2006, APP_UUID.bytes + log_message(100, "other.c", 99, "filtered"))
+        self.receive(2000, log_message(1, "main.c", 7, "firmware"))
+        pipeline.close()
+
+        with open(jsonl) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line['line'] for line in lines], range(20) + [7])
+        self.assertEqual(lines[0]['uuid'], str(APP_UUID))
+        self.assertEqual(lines[0]['message'], "message 0")
+        self.assertNotIn('uuid', lines[-1])
+
+        records = [record for _, record in logsink.read_binary_log(binary)]
+        self.assertEqual([type(record) for record in records], [AppLogRecord] * 20 + [LogRecord])
+        self.assertEqual([str(record) for record in records],
+                         ["I main.c:%d message %d" % (i, i) for i in xrange(20)] + ["1000 E main.c 7 firmware"])
+
+    def test_drops_when_full(self):
+        pipeline = logsink.LogPipeline(self.pebble, [], maxsize=1)
+        pipeline._queue.put(None)  # stops the worker, so the queue fills up
+        pipeline._worker.join()
+        for i in xrange(3):
+            self.receive(2000, log_message(1, "main.c", i, "x"))
+        self.assertEqual(pipeline.dropped, 2)
+
+
+class TestLogRecord(unittest.TestCase):
+
+    def test_lazy_decoding(self):
+        """ Records are decoded a field at a time, as the fields are read """
+        pebble = Pebble()
+        pebble.set_print_pbl_logs(False)
+        pebble.set_log_level("I")
+        records = []
+        pebble.register_endpoint("LOGS", lambda endpoint, record: records.append(record))
+        deliver(pebble, 2000, log_message(200, "debug.c", 1, "dropped"),
+                log_message(50, "main.c", 42, "caf\xc3\xa9 \xff") + "trailing")
+
+        # The debug message is dropped for its level before a record is made
+        dropped, record = records
+        self.assertIsNone(dropped)
+        self.assertEqual((record._header, record._filename, record._message), (None, None, None))
+        self.assertEqual(record.level, 50)
+        self.assertEqual((record._filename, record._message), (None, None))
+        self.assertEqual(record.message, u"caf\xe9 ")
+        self.assertIsNone(record._filename)
+        self.assertEqual((record.filename, record.line_number, record.timestamp), (u"main.c", 42, 1000))
+        self.assertEqual(str(record), "1000 W main.c 42 caf\xc3\xa9 ")
+
+
+if __name__ == '__main__':
+    unittest.main()
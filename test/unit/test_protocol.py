@@ -0,0 +1,402 @@
+import collections
+import os
+import struct
+import sys
+import threading
+import unittest
+
+from websocket import ABNF
+
+
+# Allow us to run even if not at the root libpebble directory.
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir,
+                                        os.pardir))
+sys.path.insert(0, root_dir)
+
+from fakes import FakeTransport, deliver, frame
+from pebblecomm import WebSocketPebble, stm32_crc
+from pebblecomm.pebble import AppLogRecord, BlobDB, LogTrigger, Pebble, PebbleError, PebbleProtocolReassembler, \
+    PutBytesClient
+
+
+class TestReassembler(unittest.TestCase):
+
+    def test_split_frames(self):
+        """ Frames split across several reads are only returned once complete """
+        reassembler = PebbleProtocolReassembler()
+        data = frame(2000, "hello") + frame(2001, "\x01\x00\x00\x00\x01")
+
+        reassembler.feed(data[:3])
+        self.assertEqual(list(reassembler.frames()), [])
+        reassembler.feed(data[3:12])
+        self.assertEqual([(e, p.tobytes()) for e, p in reassembler.frames()],
+                         [(2000, "hello")])
+        reassembler.feed(data[12:])
+        self.assertEqual([(e, p.tobytes()) for e, p in reassembler.frames()],
+                         [(2001, "\x01\x00\x00\x00\x01")])
+        self.assertEqual(len(reassembler), 0)
+
+    def test_compact_and_grow(self):
+        """ Partial frames survive compaction and growth of the ring buffer """
+        reassembler = PebbleProtocolReassembler(capacity=16)
+        payloads = ["x" * n for n in (1, 10, 0, 30, 7, 100)]
+        data = "".join(frame(n, p) for n, p in enumerate(payloads))
+
+        received = []
+        for i in xrange(0, len(data), 5):
+            reassembler.feed(data[i:i + 5])
+            received += [(e, p.tobytes()) for e, p in reassembler.frames()]
+
+        self.assertEqual(received, list(enumerate(payloads)))
+
+
+class TestDispatch(unittest.TestCase):
+
+    def test_handler_chain(self):
+        """ Raw handlers, the internal parser and parsed handlers run in order """
+        pebble = Pebble()
+        calls = []
+        raw = lambda endpoint, data: calls.append(('raw', data))
+        parsed = lambda endpoint, data: calls.append(('parsed', data))
+        pebble.register_endpoint("PING", parsed)
+        pebble.register_endpoint("PING", raw, preprocess=False)
+
+        deliver(pebble, 2001, struct.pack("!bL", 1, 1234))
+        self.assertEqual(calls, [('raw', struct.pack("!bL", 1, 1234)), ('parsed', 1234)])
+
+        pebble.unregister_endpoint("PING", parsed)
+        pebble.unregister_endpoint("PING", raw, preprocess=False)
+        deliver(pebble, 2001, struct.pack("!bL", 1, 1234))
+        self.assertEqual(len(calls), 2)
+
+
+class TestLogTriggers(unittest.TestCase):
+
+    def app_log(self, message):
+        return "\x01" * AppLogRecord.UUID_LENGTH + struct.pack("!IBBH", 0, 1, len(message), 1) + \
+            "main.c".ljust(16, "\0") + message
+
+    def test_events(self):
+        """ Only messages with a trigger's marker are searched, and matches become events """
+        pebble = Pebble()
+        pebble.set_print_app_logs(False)
+        pebble.unregister_log_event(pebble._crash_event)
+        pebble.add_log_trigger(LogTrigger('low_battery', ('battery',), r'battery at (?P<percent>\d+)%'))
+        events = []
+        pebble.register_log_event(events.append)
+
+        messages = ["hello", "battery at 5%", "no battery", "App fault! {%s} PC: 0x10 LR: ???" % ("01" * 16)]
+        deliver(pebble, 2006, *[self.app_log(message) for message in messages])
+
+        self.assertEqual([(event.name, event.fields) for event in events],
+                         [('low_battery', {'percent': '5'}),
+                          ('crash', {'uuid': '{%s}' % ("01" * 16), 'pc': '0x10', 'lr': '???'})])
+        self.assertEqual(events[0].uuid.bytes, "\x01" * 16)
+
+
+class TestRecords(unittest.TestCase):
+
+    def test_appbank_status(self):
+        """ App bank responses read like the dicts they used to be """
+        pebble = Pebble()
+        data = struct.pack("!bII", 1, 8, 2) + struct.pack("!II32s32sIH", 5, 0, "Watch", "Co", 0, 3) + \
+            struct.pack("!II32s32sIH", 6, 1, "Face", "Co", 0, 4)
+        apps = pebble._appbank_status_response(6000, data)
+        self.assertEqual(apps["banks"], 8)
+        self.assertEqual([app["name"] for app in apps["apps"]], ["Watch", "Face"])
+        self.assertEqual(apps["apps"][0],
+                         {"id": 5, "index": 0, "name": "Watch", "company": "Co", "flags": 0, "version": 3})
+        self.assertEqual(apps.apps[1].version, 4)
+        self.assertRaises(KeyError, lambda: apps["missing"])
+
+
+class TestSend(unittest.TestCase):
+
+    def test_parts(self):
+        """ A payload given in parts goes out as the same message """
+        for accepts_lists in (False, True):
+            pebble = Pebble()
+            pebble._ser = FakeTransport(pebble)
+            pebble._ser.write_accepts_lists = accepts_lists
+            pebble._send_message("PING", "\x00\x00\x00\x00\x01")
+            pebble._send_message("PING", ["\x00", "\x00\x00", "\x00\x01"])
+            sent = ["".join(data) for data in pebble._ser.sent]
+            self.assertEqual(sent, [frame(2001, "\x00\x00\x00\x00\x01")] * 2)
+            self.assertEqual(all(isinstance(data, list) for data in pebble._ser.sent), accepts_lists)
+
+    def test_websocket_frame(self):
+        """ Frames are masked with the key, after a header sized for the payload """
+        ws = WebSocketPebble(get_mask_key=lambda length: "\x01\x02\x03\x04")
+        for length, header in ((0, "\x82\x80"), (5, "\x82\x85"), (200, "\x82\xfe\x00\xc8"),
+                               (70000, "\x82\xff" + struct.pack("!Q", 70000))):
+            payload = "".join(chr(i % 251) for i in xrange(length))
+            frame = str(ws._frame(payload, 2))
+            self.assertEqual(frame[:len(header) + 4], header + "\x01\x02\x03\x04")
+            masked = frame[len(header) + 4:]
+            self.assertEqual("".join(chr(ord(c) ^ (i % 4 + 1)) for i, c in enumerate(masked)), payload)
+
+    def test_websocket_frame_boundaries(self):
+        """ Frames match websocket-client's at each length encoding boundary, but for 125 bytes """
+        ws = WebSocketPebble(get_mask_key=lambda length: "\x01\x02\x03\x04")
+        for length in (0, 124, 125, 126, 127, 0xFFFF, 0x10000):
+            payload = "".join(chr(i % 251) for i in xrange(length))
+            previous = ABNF.create_frame(payload, ABNF.OPCODE_BINARY)
+            previous.get_mask_key = ws.get_mask_key
+            expected = previous.format()
+            if length == 125:
+                # websocket-client uses a 16 bit length where 7 bits will do
+                self.assertEqual(expected[:4], "\x82\xfe\x00\x7d")
+                expected = "\x82\xfd" + expected[4:]
+            self.assertEqual(str(ws._frame(payload, ABNF.OPCODE_BINARY)), expected, length)
+
+
+class BlobDBWatch(FakeTransport):
+    """ Stands in for the transport, answering BlobDB requests in reverse order """
+
+    def __init__(self, pebble, window):
+        FakeTransport.__init__(self, pebble)
+        self.window = window
+        self.tokens = []
+        self.most_outstanding = 0
+
+    def write(self, msg):
+        FakeTransport.write(self, msg)
+        self.tokens.append(msg[5:7])
+        self.most_outstanding = max(self.most_outstanding, len(self.tokens))
+        if len(self.tokens) == self.window:
+            self.respond()
+
+    def respond(self):
+        tokens, self.tokens = self.tokens, []
+        self.deliver(45531, *[token + "\x01" for token in reversed(tokens)])
+
+
+class TestBlobDBBatch(unittest.TestCase):
+
+    def test_window_and_results(self):
+        pebble = Pebble()
+        pebble._ser = watch = BlobDBWatch(pebble, 4)
+        batch = pebble.blob_db_batch("PIN", window=4)
+        keys = ["key%d" % i for i in xrange(10)]
+        for key in keys:
+            batch.insert(key, "value")
+        batch.delete(keys[0])
+        batch.clear()
+        watch.respond()
+
+        self.assertEqual(batch.finish(), [("insert", key, "SUCCESS") for key in keys] +
+                         [("delete", keys[0], "SUCCESS"), ("clear", None, "SUCCESS")])
+        self.assertEqual(watch.most_outstanding, 4)
+
+    def test_tokens(self):
+        """ Batches keep to their own tokens, and skip those still being waited on """
+        pebble = Pebble()
+        self.assertTrue(all(BlobDB().get_token() < BlobDB.BATCH_TOKENS for _ in xrange(1000)))
+        batch = pebble.blob_db_batch("PIN")
+        waiter = object()
+        pebble._responses.add((45531, 0x8000), waiter)
+        batch._token = 0xffff
+        self.assertEqual(batch._next_token(), 0x8001)
+        pebble._responses.discard((45531, 0x8000), waiter)
+        batch._token = 0xffff
+        self.assertEqual(batch._next_token(), 0x8000)
+
+
+class PutBytesWatch(FakeTransport):
+    """
+    Stands in for the transport, holding the replies to PutBytes messages
+    until respond() delivers them. reply(payload) gives the result for each
+    chunk: 1 to ACK it, another number to NACK it, or None to drop it.
+    Keeps the payloads of what is written, without the header.
+    """
+
+    def __init__(self, pebble, max_message_size=Pebble.DEFAULT_MAX_MESSAGE_SIZE, reply=lambda payload: 1):
+        FakeTransport.__init__(self, pebble)
+        self.max_message_size = max_message_size
+        self.reply = reply
+        self.replies = []
+        self.token = 0x100
+        self.most_outstanding = 0
+
+    def write(self, data):
+        payload = data[4:]
+        self.sent.append(payload)
+        command, = struct.unpack_from("!B", payload)
+        if command == 1:
+            self.token += 1
+            result, token = 1, self.token
+        elif command == 4:
+            return
+        else:
+            token, = struct.unpack_from("!I", payload, 1)
+            result = self.reply(payload) if command == 2 else 1
+        if result is not None:
+            self.replies.append(struct.pack("!bI", result, token))
+        self.most_outstanding = max(self.most_outstanding, len(self.replies))
+
+    def respond(self, count=None):
+        """ Deliver count replies (default: until there are none left), oldest first """
+        while self.replies and count != 0:
+            self.deliver(48879, self.replies.pop(0))
+            if count is not None:
+                count -= 1
+
+    def transfers(self):
+        """ The data sent under each token, in the order transfers were started """
+        data = collections.OrderedDict()
+        for payload in self.sent:
+            if payload[0] == "\x02":
+                token, length = struct.unpack_from("!II", payload, 1)
+                data[token] = data.get(token, "") + payload[9:]
+        return data.values()
+
+
+class TestPutBytes(unittest.TestCase):
+
+    data = "".join(chr(i % 251) for i in xrange(20000))
+
+    def client(self, watch_args={}, **kwargs):
+        pebble = Pebble()
+        pebble._ser = watch = PutBytesWatch(pebble, **watch_args)
+        client = PutBytesClient(pebble, 1, "BINARY", self.data, **kwargs)
+        client.init()
+        return pebble, watch, client
+
+    def commit_crc(self, watch):
+        commit = [payload for payload in watch.sent if payload[0] == "\x03"][-1]
+        return struct.unpack_from("!I", commit, 5)[0]
+
+    def test_running_crc(self):
+        """ The CRC is taken over each chunk as it is sent, and never over the whole buffer """
+        data = self.data[:5003]
+        pebble = Pebble()
+        pebble._ser = watch = PutBytesWatch(pebble)
+        client = PutBytesClient(pebble, 1, "BINARY", data)
+        crc32, stm32_crc.crc32 = stm32_crc.crc32, None
+        try:
+            client.init()
+            sent = []
+            while watch.replies:
+                watch.respond(1)
+                sent.append(client._crc.length)
+                self.assertEqual(client._crc.crc32(), crc32(data[:client._crc.length]))
+        finally:
+            stm32_crc.crc32 = crc32
+        self.assertTrue(client.wait())
+        self.assertEqual(sent, [2000, 4000, 5003, 5003, 5003, 5003])
+        self.assertEqual(self.commit_crc(watch), stm32_crc.crc32(data))
+
+    def test_window(self):
+        """ Up to window chunks wait for ACKs that arrive late and all together """
+        pebble, watch, client = self.client(window=4)
+        watch.respond(1)
+        while watch.replies:
+            watch.respond(len(watch.replies))
+        self.assertTrue(client.wait())
+        self.assertEqual(watch.most_outstanding, 4)
+        self.assertEqual(watch.transfers(), [self.data])
+        self.assertEqual(self.commit_crc(watch), stm32_crc.crc32(self.data))
+
+    def test_window_slides(self):
+        """ Each ACK frees one slot, and the next chunk goes out straight away """
+        pebble, watch, client = self.client(window=3)
+        self.assertEqual(client._in_flight, collections.deque())
+        watch.respond(1)
+        self.assertEqual(list(client._in_flight), [(0, 2000), (2000, 2000), (4000, 2000)])
+        for acked in xrange(1, 8):
+            watch.respond(1)
+            self.assertEqual(list(client._in_flight), [(offset, 2000) for offset in
+                                                       xrange(2000 * acked, 2000 * min(acked + 3, 10), 2000)])
+            self.assertEqual(len(watch.replies), len(client._in_flight))
+        # The last chunks drain without new ones, and the commit waits for every ACK
+        watch.respond(2)
+        self.assertEqual(watch.sent[-1][0], "\x02")
+        watch.respond(1)
+        self.assertEqual(watch.sent[-1][0], "\x03")
+        watch.respond()
+        self.assertTrue(client.wait())
+        self.assertEqual(watch.most_outstanding, 3)
+
+    def test_nack_mid_window(self):
+        """ A NACK restarts with half the window, ignoring ACKs for the rest of the old transfer """
+        puts = []
+        def reply(payload):
+            puts.append(payload)
+            return 2 if len(puts) == 3 else 1
+        pebble, watch, client = self.client({'reply': reply}, window=4)
+        watch.respond(1)
+        self.assertEqual(len(watch.replies), 4)
+        watch.respond(3)
+        # The abort and new init went out behind three more ACKs for the old transfer
+        self.assertEqual([payload[0] for payload in watch.sent[-2:]], ["\x04", "\x01"])
+        self.assertEqual(len(watch.replies), 4)
+        watch.respond()
+        self.assertTrue(client.wait())
+        self.assertEqual(client._window, 2)
+        self.assertEqual(watch.most_outstanding, 4)
+        self.assertEqual(watch.transfers()[-1], self.data)
+        self.assertEqual(self.commit_crc(watch), stm32_crc.crc32(self.data))
+
+    def test_probe_nack(self):
+        """ Probed sizes the watch NACKs step down, and the accepted size is remembered """
+        pebble, watch, client = self.client({'max_message_size': 16384, 'reply': lambda payload: 1 if len(payload)
+                                             <= 8192 else 3}, probe=True)
+        watch.respond()
+        self.assertTrue(client.wait())
+        self.assertEqual(watch.transfers(), [self.data[:16384 - 13], self.data])
+        self.assertEqual(pebble.get_max_transfer_unit(), 8192 - 4)
+        self.assertEqual(pebble.probe_message_sizes(), [])
+
+    def test_timeout(self):
+        """ wait() aborts a transfer the watch stops responding to """
+        pebble = Pebble()
+        pebble._ser = watch = PutBytesWatch(pebble, reply=lambda payload: None)
+        client = PutBytesClient(pebble, 1, "BINARY", self.data)
+        self.assertRaises(PebbleError, client.wait)
+        client.init()
+        watch.respond()
+        self.assertFalse(client.wait(timeout=0.01))
+        self.assertEqual(client.error, "Timed out waiting for a response from the watch")
+        self.assertEqual(watch.sent[-1], struct.pack("!bI", 4, watch.token))
+
+    def test_probe_timeout(self):
+        """ While probing, chunks that get no response step down to the next size """
+        pebble, watch, client = self.client({'max_message_size': 16384, 'reply': lambda payload: 1 if len(payload)
+                                             <= 4096 else None}, probe=True)
+        watch.respond()
+        for _ in xrange(2):
+            client.timed_out()
+            watch.respond()
+        self.assertTrue(client.wait())
+        self.assertEqual(watch.transfers(), [self.data[:16384 - 13], self.data[:8192 - 13], self.data])
+        self.assertEqual(pebble.get_max_transfer_unit(), 4096 - 4)
+
+        # Once it's down to the last size, no response means failure
+        pebble, watch, client = self.client({'reply': lambda payload: None}, probe=False)
+        watch.respond()
+        client.timed_out()
+        self.assertFalse(client.wait())
+        self.assertEqual(client.error, "Timed out waiting for a response from the watch")
+
+    def test_timeout_race(self):
+        """ Responses and timeouts take turns moving the transfer along """
+        pebble, watch, client = self.client()
+        with client._lock:
+            reader = threading.Thread(target=watch.respond, args=(1,))
+            reader.start()
+            reader.join(0.05)
+            self.assertTrue(reader.is_alive())
+            self.assertEqual(client._state, client.states["WAIT_FOR_TOKEN"])
+        reader.join()
+        self.assertEqual(client._state, client.states["IN_PROGRESS"])
+
+        # A timeout that lost the race to the last response does nothing
+        watch.respond()
+        self.assertTrue(client.wait())
+        sent = len(watch.sent)
+        client.timed_out()
+        self.assertEqual((client._done, client.error, len(watch.sent)), (True, None, sent))
+
+
+if __name__ == '__main__':
+    unittest.main()
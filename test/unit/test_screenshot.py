@@ -0,0 +1,126 @@
+import itertools
+import os
+import random
+import struct
+import sys
+import unittest
+
+
+# Allow us to run even if not at the root libpebble directory.
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir,
+                                        os.pardir))
+sys.path.insert(0, root_dir)
+
+from fakes import FakeTransport
+from pebblecomm import pebble as libpebble
+from pebblecomm.pebble import Pebble, ScreenshotSync
+
+
+class ScreenshotWatch(FakeTransport):
+    """ Stands in for the transport, answering each screenshot request with the next of images """
+
+    def __init__(self, pebble, images, chunk_size=100):
+        FakeTransport.__init__(self, pebble)
+        self.images = list(images)
+        self.chunk_size = chunk_size
+        self.requests = 0
+
+    def write(self, msg):
+        FakeTransport.write(self, msg)
+        self.requests += 1
+        version, width, height, data = self.images.pop(0)
+        response = struct.pack("!BIII", 0, version, width, height) + data
+        self.deliver(8000, *[response[start:start + self.chunk_size]
+                             for start in xrange(0, len(response), self.chunk_size)])
+
+
+def reference_data_array(version, width, data):
+    """ The original decode: a pixel at a time, rows of width (sub)pixels, the last one possibly partial """
+    data_bytes_iter = (ord(ch) for ch in data)
+    if version == 1:
+        pixels = (byte >> bit_order & 0b1 for byte in data_bytes_iter for bit_order in xrange(8))
+        row_length = width
+    else:
+        pixels = itertools.chain(*(((byte >> 4) & 0b11, (byte >> 2) & 0b11, (byte) & 0b11)
+                                   for byte in data_bytes_iter))
+        row_length = width * 3
+    pixels = list(pixels)
+    return [pixels[start:start + row_length] for start in xrange(0, len(pixels), row_length)]
+
+
+class TestScreenshotSync(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(0x5c2e)
+        self.session = ScreenshotSync(Pebble(), "SCREENSHOT", lambda amount: None, register=False)
+
+    def receive(self, version, width, height, data):
+        self.session.reset()
+        self.session.message_callback(8000, struct.pack("!BIII", 0, version, width, height) + data)
+
+    def random_bytes(self, length):
+        return "".join(chr(self.random.randrange(256)) for _ in xrange(length))
+
+    def check_decode(self):
+        # The first two end in a partial row: 40 pixels in rows of 12, and 12 of 15 colour pixels
+        for version, width, height, length in ((1, 12, 3, 5), (2, 5, 3, 12), (2, 144, 168, 144 * 168)):
+            data = self.random_bytes(length)
+            self.receive(version, width, height, data)
+            rows = [list(row) for row in self.session.get_data_array()]
+            self.assertEqual(rows, reference_data_array(version, width, data), (version, width, height))
+
+    def test_decode_tables(self):
+        numpy, libpebble.numpy = libpebble.numpy, None
+        try:
+            self.check_decode()
+        finally:
+            libpebble.numpy = numpy
+
+    @unittest.skipIf(libpebble.numpy is None, "NumPy is not installed")
+    def test_decode_numpy(self):
+        self.check_decode()
+
+    def test_buffer(self):
+        """ Screenshots are received in place, into a buffer kept while the size stays the same """
+        self.receive(2, 4, 2, "\x01" * 8 + "extra")
+        buffer = self.session.buffer
+        self.assertEqual(self.session.data.tobytes(), "\x01" * 8)
+        self.assertIsInstance(self.session.data, memoryview)
+        self.receive(2, 2, 4, "\x02" * 4)
+        self.assertIs(self.session.buffer, buffer)
+        self.assertEqual(self.session.data.tobytes(), "\x02" * 4)
+        self.assertFalse(self.session.is_complete())
+        self.receive(1, 8, 1, "\x03")
+        self.assertEqual(self.session.data.tobytes(), "\x03")
+        self.assertTrue(self.session.is_complete())
+
+
+class TestScreenshotStream(unittest.TestCase):
+
+    def setUp(self):
+        self.pebble = Pebble()
+
+    def handlers(self):
+        return self.pebble._endpoint_handlers.get(8000, [])
+
+    def test_frames(self):
+        images = [(1, 16, 2, byte * 4) for byte in "\x00\xff\x00"]
+        self.pebble._ser = watch = ScreenshotWatch(self.pebble, images)
+        with self.pebble.screenshot_stream() as stream:
+            self.assertEqual(self.handlers(), [])
+            rows = [[list(row) for row in image.rows] for _, image in stream.frames(count=3)]
+        self.assertEqual(rows, [[[bit] * 16] * 2 for bit in (0, 1, 0)])
+        self.assertEqual(watch.requests, 3)
+        self.assertEqual(self.handlers(), [])
+
+    def test_unused_stream(self):
+        """ A stream that is never iterated doesn't keep other screenshots from being taken """
+        self.pebble.screenshot_stream()
+        self.pebble._ser = ScreenshotWatch(self.pebble, [(1, 8, 1, "\x01")])
+        image = self.pebble.screenshot(lambda amount: None)
+        self.assertEqual([list(row) for row in image.rows], [[1, 0, 0, 0, 0, 0, 0, 0]])
+        self.assertEqual(self.handlers(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+import os
+import random
+import shutil
+import StringIO
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+
+# Allow us to run even if not at the root libpebble directory.
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir,
+                                        os.pardir))
+sys.path.insert(0, root_dir)
+
+from fakes import deliver
+from pebblecomm import speex
+from pebblecomm.pebble import AudioSync, Pebble
+
+
+def reference_page_crc(page):
+    """ The original construction: the CRC field bytes as stored in the page """
+    crc = (~zlib.crc32(page.translate(speex.bitswap), -1)) & 0xffffffff
+    return speex.to_uint_be(crc).translate(speex.bitswap)
+
+
+def bitwise_ogg_crc(data):
+    """ Ogg's CRC-32 as specified: polynomial 0x04C11DB7, MSB first, no xors """
+    crc = 0
+    for byte in bytearray(data):
+        crc ^= byte << 24
+        for _ in xrange(8):
+            if crc & 0x80000000:
+                crc = ((crc << 1) ^ 0x04C11DB7) & 0xffffffff
+            else:
+                crc = (crc << 1) & 0xffffffff
+    return crc
+
+
+class TestOggCrc(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(0x0995)
+
+    def random_bytes(self, length):
+        return ''.join(chr(self.random.randrange(256)) for _ in xrange(length))
+
+    def test_matches_reference(self):
+        for length in range(0, 9) + [27, 255, 4001]:
+            data = self.random_bytes(length)
+            self.assertEqual(struct.pack('<I', speex.ogg_crc(data)), reference_page_crc(data), length)
+            self.assertEqual(speex.ogg_crc(data), bitwise_ogg_crc(data), length)
+
+    def test_incremental(self):
+        data = self.random_bytes(1000)
+        crc = 0
+        for start in xrange(0, len(data), 333):
+            crc = speex.ogg_crc(bytearray(data[start:start + 333]), crc)
+        self.assertEqual(crc, speex.ogg_crc(data))
+
+    def test_page_checksum(self):
+        segments = [self.random_bytes(self.random.randrange(1, 255)) for _ in xrange(10)]
+        page = speex.create_ogg_packet(False, True, 200, 0x42E296FC, 2, segments)
+        zeroed = page[:22] + '\0' * 4 + page[26:]
+        self.assertEqual(page[22:26], reference_page_crc(zeroed))
+
+
+def reference_ogg_page(bos, eos, granule, serial_no, packet_no, segments):
+    """ The original construction: the page as a string, then the CRC spliced in """
+    ogg = 'OggS' + struct.pack('<BBqIIiB', 0, (2 if bos else 0) | (4 if eos else 0), granule, serial_no,
+                                packet_no, 0, len(segments))
+    ogg += ''.join(chr(len(segment)) for segment in segments) + ''.join(segments)
+    return ogg[:22] + reference_page_crc(ogg) + ogg[26:]
+
+
+def reference_speex_header(version, rate, frame_sz):
+    """ The original Speex header, for one channel at a constant bit rate """
+    mode = 1 if rate == 16000 else 0
+    bitrate = 12800 if rate == 16000 else 8000
+    return "Speex   " + version[:20].ljust(20, '\0') + struct.pack('<iiIiiiiIiiiii', 1, 80, rate, mode, 4, 1,
+                                                                    bitrate, frame_sz, 0, 1, 0, 0, 0)
+
+
+class TestOggPages(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(0x0916)
+
+    def test_reused_buffer(self):
+        """ Pages packed into one buffer, growing and shrinking, match the original construction """
+        buf = bytearray()
+        for count in (3, 255, 1, 0, 40):
+            segments = [''.join(chr(self.random.randrange(256)) for _ in xrange(self.random.randrange(1, 256)))
+                        for _ in xrange(count)]
+            args = (count == 3, count == 40, self.random.randrange(1 << 40), 0x42E296FC, count, segments)
+            self.assertIs(speex.pack_ogg_page(buf, *args), buf)
+            self.assertEqual(str(buf), reference_ogg_page(*args), count)
+
+    def test_speex_header(self):
+        for rate in (8000, 16000):
+            self.assertEqual(speex.create_speex_header("1.2rc1", rate, rate / 50),
+                             reference_speex_header("1.2rc1", rate, rate / 50))
+
+
+def reference_store_data(frames, rate):
+    """ The whole recording at once, as it used to be written: headers, then pages of up to 255 frames """
+    frame_sz = rate / 1000 * 20
+    serial_no = speex.OggSpeexWriter.serial_no
+    version = speex.OggSpeexWriter.version
+    data = reference_ogg_page(True, False, 0, serial_no, 0, [reference_speex_header(version, rate, frame_sz)])
+    data += reference_ogg_page(False, False, 0, serial_no, 1,
+                               [speex.create_vorbis_comment('Encoded with Speex ' + version, [])])
+    pages = [frames[start:start + speex.MAX_FRAME_COUNT] for start in xrange(0, len(frames), speex.MAX_FRAME_COUNT)]
+    granules = 0
+    for index, page in enumerate(pages):
+        granules += len(page) * frame_sz
+        data += reference_ogg_page(False, index == len(pages) - 1, granules - frame_sz, serial_no, index + 2, page)
+    return data
+
+
+class TestStreamingWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'recording.spx')
+        self.random = random.Random(0x0991)
+        self.frames = [''.join(chr(self.random.randrange(256)) for _ in xrange(self.random.randrange(1, 60)))
+                       for _ in xrange(600)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def saved(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_pages_written_as_they_fill(self):
+        """ Each full page is on disk once the next frame arrives, and the file matches the old output """
+        writer = speex.OggSpeexWriter(self.path, 16000)
+        headers = len(self.saved())
+        for frame in self.frames[:speex.MAX_FRAME_COUNT]:
+            writer.write_frame(frame)
+        self.assertEqual(len(self.saved()), headers)
+        writer.write_frame(self.frames[speex.MAX_FRAME_COUNT])
+        self.assertGreater(len(self.saved()), headers)
+        for frame in self.frames[speex.MAX_FRAME_COUNT + 1:]:
+            writer.write_frame(frame)
+        writer.close()
+        self.assertEqual(self.saved(), reference_store_data(self.frames, 16000))
+
+    def test_recording(self):
+        """ Pebble.record's AudioSync streams frames to the file rather than keeping them """
+        pebble = Pebble()
+        session = AudioSync(pebble, "AUDIO", filename=self.path)
+        deliver(pebble, 10000, struct.pack("<BHBIH", 1, 7, 0, 16000, 0))
+        for start in xrange(0, len(self.frames), 100):
+            batch = self.frames[start:start + 100]
+            deliver(pebble, 10000, struct.pack("<BHB", 2, 7, len(batch)) +
+                    "".join(chr(len(frame)) + frame for frame in batch))
+        # Every full page is already saved before the recording stops
+        self.assertEqual(self.saved(), reference_store_data(self.frames, 16000)[:len(self.saved())])
+        self.assertGreater(len(self.saved()), len(reference_store_data([], 16000)))
+        deliver(pebble, 10000, struct.pack("<BH", 3, 7))
+
+        self.assertEqual(session.get_data(), ([], 16000))
+        self.assertEqual(self.saved(), reference_store_data(self.frames, 16000))
+
+
+class TestBatchConverter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.random = random.Random(0x5bee)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def main(self, *argv):
+        """ Run the converter. Returns its exit code and what it printed to stdout and stderr. """
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            return speex.main(list(argv)), sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def test_convert_directory(self):
+        captures = {}
+        for n in xrange(3):
+            frames = [''.join(chr(self.random.randrange(256)) for _ in xrange(self.random.randrange(1, 60)))
+                      for _ in xrange(300 * n)]
+            speex.store_frame_dump(frames, os.path.join(self.tmp_dir, 'capture%d.frames' % n), 16000)
+            captures['capture%d' % n] = frames
+        with open(os.path.join(self.tmp_dir, 'broken.frames'), 'wb') as f:
+            f.write(struct.pack('<I', 8000) + '\x05abc')
+
+        output_dir = os.path.join(self.tmp_dir, 'spx')
+        code, out, err = self.main(self.tmp_dir, '--output-dir', output_dir, '--jobs', '2')
+        self.assertEqual(code, 1)
+        # Captures are reported as they finish, then the summary
+        lines = out.splitlines()
+        self.assertEqual(sorted(lines[:-1]), ["%s -> %s" % (os.path.join(self.tmp_dir, 'capture%d.frames' % n),
+                                                            os.path.join(output_dir, 'capture%d.spx' % n))
+                                              for n in xrange(3)])
+        self.assertEqual(lines[-1], "Converted 3 of 4 captures")
+        self.assertTrue(err.startswith("Failed to convert %s: " % os.path.join(self.tmp_dir, 'broken.frames')), err)
+
+        for name, frames in captures.items():
+            expected = speex.store_data(frames, os.path.join(self.tmp_dir, name + '.expected'), 16000)
+            with open(os.path.join(output_dir, name + '.spx'), 'rb') as f, open(expected, 'rb') as g:
+                self.assertEqual(f.read(), g.read(), name)
+
+        # Nothing is left of the failed capture, so the next run tries it again
+        self.assertEqual(sorted(os.listdir(output_dir)), ['capture0.spx', 'capture1.spx', 'capture2.spx'])
+        code, out, err = self.main(self.tmp_dir, '--output-dir', output_dir, '--jobs', '2')
+        self.assertEqual((code, out), (1, "Converted 0 of 1 captures\n"))
+        self.assertEqual(len(err.splitlines()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
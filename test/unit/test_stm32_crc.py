@@ -0,0 +1,58 @@
+import os
+import random
+import struct
+import sys
+import unittest
+
+
+# Allow us to run even if not at the root libpebble directory.
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir,
+                                        os.pardir))
+sys.path.insert(0, root_dir)
+
+from pebblecomm import stm32_crc
+
+
+def reference_crc32(data):
+    """ The original bit-by-bit STM32 CRC, one word at a time """
+    crc = 0xffffffff
+    for i in xrange(0, len(data), 4):
+        word = data[i:i + 4]
+        if len(word) < 4:
+            word = word[::-1].ljust(4, '\0')
+        crc ^= struct.unpack('<I', word)[0]
+        for _ in xrange(32):
+            if crc & 0x80000000:
+                crc = ((crc << 1) ^ stm32_crc.CRC_POLY) & 0xffffffff
+            else:
+                crc = (crc << 1) & 0xffffffff
+    return crc
+
+
+class TestSTM32Crc(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(0x5eed)
+
+    def random_bytes(self, length):
+        return ''.join(chr(self.random.randrange(256)) for _ in xrange(length))
+
+    def test_matches_reference(self):
+        for length in range(0, 33) + [1021, 1022, 1023, 1024, 40001]:
+            data = self.random_bytes(length)
+            self.assertEqual(stm32_crc.crc32(data), reference_crc32(data), length)
+
+    def test_incremental(self):
+        data = self.random_bytes(5003)
+        crc = stm32_crc.STM32Crc()
+        offset = 0
+        while offset < len(data):
+            chunk = self.random.randrange(1, 300)
+            crc.update(data[offset:offset + chunk])
+            offset += chunk
+        self.assertEqual(crc.length, len(data))
+        self.assertEqual(crc.crc32(), stm32_crc.crc32(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
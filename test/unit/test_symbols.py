@@ -0,0 +1,77 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+
+# Allow us to run even if not at the root libpebble directory.
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir,
+                                        os.pardir))
+sys.path.insert(0, root_dir)
+
+from pebblecomm import symbols
+
+# Stands in for addr2line: answers each address with the ELF's contents and
+# the address, and records each start in a log next to it.
+FAKE_ADDR2LINE = """#!/bin/sh
+echo started >> "$0.log"
+while read address; do
+    echo "$(cat "$2"):$address"
+done
+"""
+
+
+class TestSymbolicator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addr2line = os.path.join(self.tmp, 'addr2line')
+        with open(self.addr2line, 'w') as f:
+            f.write(FAKE_ADDR2LINE)
+        os.chmod(self.addr2line, stat.S_IRWXU)
+        self.elf = os.path.join(self.tmp, 'pebble-app.elf')
+        self.build('main.c')
+        self.symbolicator = symbols.Symbolicator(self.addr2line)
+
+    def tearDown(self):
+        self.symbolicator.close()
+        shutil.rmtree(self.tmp)
+
+    def build(self, contents, mtime=None):
+        with open(self.elf, 'w') as f:
+            f.write(contents)
+        if mtime is not None:
+            os.utime(self.elf, (mtime, mtime))
+
+    def starts(self):
+        with open(self.addr2line + '.log') as f:
+            return len(f.readlines())
+
+    def test_one_process_and_memoized(self):
+        self.assertEqual(self.symbolicator.lookup(self.elf, '0x1A2'), 'main.c:0x1a2')
+        self.assertEqual(self.symbolicator.lookup(self.elf, '0x300'), 'main.c:0x300')
+        elf = self.symbolicator._elf(self.elf)
+        elf.close()
+        # Already looked up, so addr2line isn't needed again
+        self.assertEqual(self.symbolicator.lookup(self.elf, '0x1a2'), 'main.c:0x1a2')
+        self.assertEqual(self.starts(), 1)
+
+    def test_rebuild(self):
+        now = time.time()
+        self.build('main.c', now - 10)
+        self.assertEqual(self.symbolicator.lookup(self.elf, '0x10'), 'main.c:0x10')
+        # Same contents, newer mtime: the lookups are kept
+        self.build('main.c', now - 5)
+        self.assertEqual(self.symbolicator.lookup(self.elf, '0x10'), 'main.c:0x10')
+        self.assertEqual(self.starts(), 1)
+        # Changed: looked up again in the new build
+        self.build('other.c', now)
+        self.assertEqual(self.symbolicator.lookup(self.elf, '0x10'), 'other.c:0x10')
+        self.assertEqual(self.starts(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()